@@ -8,6 +8,10 @@ from qgis.PyQt.QtWidgets import (
     QLineEdit,
     QPushButton,
     QDockWidget,
+    QDoubleSpinBox,
+    QSpinBox,
+    QComboBox,
+    QCheckBox,
 )
 from qgis.PyQt.QtCore import Qt, QUrl
 from qgis.PyQt.QtGui import QIcon, QDesktopServices
@@ -18,12 +22,13 @@ from qgis.core import (
     QgsGeometry,
     QgsField,
     QgsFields,
-    QgsMapLayer,
     QgsSettings,
 )
 from qgis.gui import QgsMapToolEmitPoint, QgsMapCanvas
 from PyQt5.QtCore import QMetaType, QPoint
-from iscontroller import ISController
+from iscontroller import ISController, create_session
+from render_cache import RenderCache
+from tracing import create_tracer
 from ui.ui_ToolPanel import Ui_ToolPanel
 
 
@@ -58,10 +63,67 @@ class SegMap:
         self.api_token: str = self.settings.value(
             "SegMap/api_token", "demo"
         )
+        self.simplify_tolerance: float = float(self.settings.value(
+            "SegMap/simplify_tolerance", 0.0
+        ))
+        self.output_mode: str = self.settings.value(
+            "SegMap/output_mode", "polygon"
+        )
+        self.image_source: str = self.settings.value(
+            "SegMap/image_source", "canvas"
+        )
+        self.render_scale: float = float(self.settings.value(
+            "SegMap/render_scale", 0.0
+        ))
+        self.ground_resolution: float = float(self.settings.value(
+            "SegMap/ground_resolution", 0.0
+        ))
+        self.window_size: int = int(self.settings.value(
+            "SegMap/window_size", 1024
+        ))
+        self.crop_to_objects: bool = self.settings.value(
+            "SegMap/crop_to_objects", False, type=bool
+        )
+        self.roi_margin: float = float(self.settings.value(
+            "SegMap/roi_margin", 0.5
+        ))
+        self.roi_min_size: int = int(self.settings.value(
+            "SegMap/roi_min_size", 512
+        ))
+        self.history_depth: int = int(self.settings.value(
+            "SegMap/history_depth", 100
+        ))
+        self.history_memory: int = int(self.settings.value(
+            "SegMap/history_memory", 64
+        ))
+        self.preview: str = self.settings.value(
+            "SegMap/preview", "layers"
+        )
+        self.tracing_mode: str = self.settings.value(
+            "SegMap/tracing_mode", "off"
+        )
+        self.tracing_target: str = self.settings.value(
+            "SegMap/tracing_target", ""
+        )
+        self.latency_log: str = self.settings.value(
+            "SegMap/latency_log", ""
+        )
+        self.connect_timeout: float = float(self.settings.value(
+            "SegMap/connect_timeout", 5.0
+        ))
+        self.read_timeout: float = float(self.settings.value(
+            "SegMap/read_timeout", 60.0
+        ))
+        # HTTP session kept across controller rebuilds, so connections stay alive
+        self.session = create_session()
+        self.render_cache = RenderCache()
+        # Created once, its export thread lives until the tracing settings change
+        self.tracer = create_tracer(self.tracing_mode, self.tracing_target)
 
         self.controller: Optional[ISController] = None
         self.model_id: Optional[str] = None
         self.map_tool: Optional[QgsMapToolEmitPoint] = None
+        self.confirm_pending: bool = False
         self.panel: Optional[DockWidget] = None
         self.toolbar: Optional[Any] = None
 
@@ -90,6 +152,9 @@ class SegMap:
     def unload(self) -> None:
         """Remove the plugin from QGIS."""
         self.deactivate_tool()  # Cleanup any existing controller or map tool
+        self.session.close()
+        self.tracer.close()
+        self.render_cache.clear()
         if self.toolbar:
             self.toolbar.clear()
             self.iface.mainWindow().removeToolBar(self.toolbar)
@@ -110,9 +175,91 @@ class SegMap:
         token_label = QLabel("API Token:")
         self.token_input = QLineEdit()
         self.token_input.setEchoMode(QLineEdit.Password)
+        simplify_label = QLabel("Simplify Tolerance (px):")
+        self.simplify_input = QDoubleSpinBox()
+        self.simplify_input.setRange(0.0, 10.0)
+        self.simplify_input.setSingleStep(0.5)
+        connect_timeout_label = QLabel("Connect Timeout (s):")
+        self.connect_timeout_input = QDoubleSpinBox()
+        self.connect_timeout_input.setRange(1.0, 60.0)
+        read_timeout_label = QLabel("Read Timeout (s):")
+        self.read_timeout_input = QDoubleSpinBox()
+        self.read_timeout_input.setRange(1.0, 600.0)
+        output_label = QLabel("Vectorization:")
+        self.output_input = QComboBox()
+        self.output_input.addItem("On server (polygons)", "polygon")
+        self.output_input.addItem("Locally (mask)", "mask")
+        image_source_label = QLabel("Image Source:")
+        self.image_source_input = QComboBox()
+        self.image_source_input.addItem("Rendered canvas", "canvas")
+        self.image_source_input.addItem("Raster window (native resolution)", "raster")
+        render_scale_label = QLabel("Canvas Render Scale (0 = auto):")
+        self.render_scale_input = QDoubleSpinBox()
+        self.render_scale_input.setRange(0.0, 2.0)
+        self.render_scale_input.setSingleStep(0.25)
+        self.render_scale_input.setToolTip(
+            "Relative to the physical screen pixels. "
+            "Auto caps the long side of the rendering at 1536 px."
+        )
+        ground_resolution_label = QLabel("Ground Resolution (layer units/px, 0 = native):")
+        self.ground_resolution_input = QDoubleSpinBox()
+        self.ground_resolution_input.setDecimals(6)
+        self.ground_resolution_input.setRange(0.0, 1e6)
+        window_size_label = QLabel("Raster Window Size (px):")
+        self.window_size_input = QSpinBox()
+        self.window_size_input.setRange(256, 4096)
+        self.window_size_input.setSingleStep(256)
+        self.crop_input = QCheckBox("Crop to the clicks and segmentation before upload")
+        roi_margin_label = QLabel("Crop Margin (x object size):")
+        self.roi_margin_input = QDoubleSpinBox()
+        self.roi_margin_input.setRange(0.0, 5.0)
+        self.roi_margin_input.setSingleStep(0.1)
+        roi_min_size_label = QLabel("Minimum Crop Size (px):")
+        self.roi_min_size_input = QSpinBox()
+        self.roi_min_size_input.setRange(64, 4096)
+        self.roi_min_size_input.setSingleStep(64)
+        preview_label = QLabel("Preview:")
+        self.preview_input = QComboBox()
+        self.preview_input.addItem("Temporary layers", "layers")
+        self.preview_input.addItem("Canvas overlay (faster on large projects)", "overlay")
+        history_depth_label = QLabel("Undo Steps:")
+        self.history_depth_input = QSpinBox()
+        self.history_depth_input.setRange(1, 10000)
+        history_memory_label = QLabel("Undo Memory (MB):")
+        self.history_memory_input = QSpinBox()
+        self.history_memory_input.setRange(1, 4096)
+        tracing_label = QLabel("Tracing:")
+        self.tracing_input = QComboBox()
+        self.tracing_input.addItem("Off", "off")
+        self.tracing_input.addItem("JSON file", "file")
+        self.tracing_input.addItem("OTLP collector", "otlp")
+        tracing_target_label = QLabel("Trace File / Collector URL:")
+        self.tracing_target_input = QLineEdit()
+        self.tracing_target_input.setPlaceholderText("http://localhost:4318")
+        latency_log_label = QLabel("Latency Log (CSV, optional):")
+        self.latency_log_input = QLineEdit()
 
         self.api_input.setText(self.api_endpoint)
         self.token_input.setText(self.api_token)
+        self.simplify_input.setValue(self.simplify_tolerance)
+        self.connect_timeout_input.setValue(self.connect_timeout)
+        self.read_timeout_input.setValue(self.read_timeout)
+        self.output_input.setCurrentIndex(max(self.output_input.findData(self.output_mode), 0))
+        self.image_source_input.setCurrentIndex(
+            max(self.image_source_input.findData(self.image_source), 0)
+        )
+        self.render_scale_input.setValue(self.render_scale)
+        self.ground_resolution_input.setValue(self.ground_resolution)
+        self.window_size_input.setValue(self.window_size)
+        self.crop_input.setChecked(self.crop_to_objects)
+        self.roi_margin_input.setValue(self.roi_margin)
+        self.roi_min_size_input.setValue(self.roi_min_size)
+        self.preview_input.setCurrentIndex(max(self.preview_input.findData(self.preview), 0))
+        self.history_depth_input.setValue(self.history_depth)
+        self.history_memory_input.setValue(self.history_memory)
+        self.tracing_input.setCurrentIndex(max(self.tracing_input.findData(self.tracing_mode), 0))
+        self.tracing_target_input.setText(self.tracing_target)
+        self.latency_log_input.setText(self.latency_log)
 
         save_button = QPushButton("Save")
         save_button.clicked.connect(lambda: self.save_settings(dialog))
@@ -121,6 +268,39 @@ class SegMap:
         layout.addWidget(self.api_input)
         layout.addWidget(token_label)
         layout.addWidget(self.token_input)
+        layout.addWidget(simplify_label)
+        layout.addWidget(self.simplify_input)
+        layout.addWidget(connect_timeout_label)
+        layout.addWidget(self.connect_timeout_input)
+        layout.addWidget(read_timeout_label)
+        layout.addWidget(self.read_timeout_input)
+        layout.addWidget(output_label)
+        layout.addWidget(self.output_input)
+        layout.addWidget(image_source_label)
+        layout.addWidget(self.image_source_input)
+        layout.addWidget(render_scale_label)
+        layout.addWidget(self.render_scale_input)
+        layout.addWidget(ground_resolution_label)
+        layout.addWidget(self.ground_resolution_input)
+        layout.addWidget(window_size_label)
+        layout.addWidget(self.window_size_input)
+        layout.addWidget(self.crop_input)
+        layout.addWidget(roi_margin_label)
+        layout.addWidget(self.roi_margin_input)
+        layout.addWidget(roi_min_size_label)
+        layout.addWidget(self.roi_min_size_input)
+        layout.addWidget(preview_label)
+        layout.addWidget(self.preview_input)
+        layout.addWidget(history_depth_label)
+        layout.addWidget(self.history_depth_input)
+        layout.addWidget(history_memory_label)
+        layout.addWidget(self.history_memory_input)
+        layout.addWidget(tracing_label)
+        layout.addWidget(self.tracing_input)
+        layout.addWidget(tracing_target_label)
+        layout.addWidget(self.tracing_target_input)
+        layout.addWidget(latency_log_label)
+        layout.addWidget(self.latency_log_input)
         layout.addWidget(save_button)
 
         dialog.setLayout(layout)
@@ -129,10 +309,50 @@ class SegMap:
     def save_settings(self, dialog: QDialog) -> None:
         self.api_endpoint = self.api_input.text()
         self.api_token = self.token_input.text()
+        self.simplify_tolerance = self.simplify_input.value()
+        self.connect_timeout = self.connect_timeout_input.value()
+        self.read_timeout = self.read_timeout_input.value()
+        self.output_mode = self.output_input.currentData()
+        self.image_source = self.image_source_input.currentData()
+        self.render_scale = self.render_scale_input.value()
+        self.ground_resolution = self.ground_resolution_input.value()
+        self.window_size = self.window_size_input.value()
+        self.crop_to_objects = self.crop_input.isChecked()
+        self.roi_margin = self.roi_margin_input.value()
+        self.roi_min_size = self.roi_min_size_input.value()
+        self.preview = self.preview_input.currentData()
+        self.history_depth = self.history_depth_input.value()
+        self.history_memory = self.history_memory_input.value()
+        self.tracing_mode = self.tracing_input.currentData()
+        self.tracing_target = self.tracing_target_input.text()
+        self.latency_log = self.latency_log_input.text()
 
         # Save settings to QGIS settings for persistence
         self.settings.setValue("SegMap/api_endpoint", self.api_endpoint)
         self.settings.setValue("SegMap/api_token", self.api_token)
+        self.settings.setValue("SegMap/simplify_tolerance", self.simplify_tolerance)
+        self.settings.setValue("SegMap/connect_timeout", self.connect_timeout)
+        self.settings.setValue("SegMap/read_timeout", self.read_timeout)
+        self.settings.setValue("SegMap/output_mode", self.output_mode)
+        self.settings.setValue("SegMap/image_source", self.image_source)
+        self.settings.setValue("SegMap/render_scale", self.render_scale)
+        self.settings.setValue("SegMap/ground_resolution", self.ground_resolution)
+        self.settings.setValue("SegMap/window_size", self.window_size)
+        self.settings.setValue("SegMap/crop_to_objects", self.crop_to_objects)
+        self.settings.setValue("SegMap/roi_margin", self.roi_margin)
+        self.settings.setValue("SegMap/roi_min_size", self.roi_min_size)
+        self.settings.setValue("SegMap/preview", self.preview)
+        self.settings.setValue("SegMap/history_depth", self.history_depth)
+        self.settings.setValue("SegMap/history_memory", self.history_memory)
+        self.settings.setValue("SegMap/tracing_mode", self.tracing_mode)
+        self.settings.setValue("SegMap/tracing_target", self.tracing_target)
+        self.settings.setValue("SegMap/latency_log", self.latency_log)
+
+        self.tracer.close()
+        self.tracer = create_tracer(self.tracing_mode, self.tracing_target)
+        if self.controller:
+            # The closed tracer drops every span, hand the new one to the live controller
+            self.controller.tracer = self.tracer
         dialog.accept()
 
     def init_controller(self) -> None:
@@ -141,7 +361,26 @@ class SegMap:
 
         self.controller = ISController(
             self.api_endpoint, self.api_token,
+            simplify_tolerance=self.simplify_tolerance,
+            output_mode=self.output_mode,
+            tracer=self.tracer,
+            session=self.session,
+            render_cache=self.render_cache,
+            timeout=(self.connect_timeout, self.read_timeout),
+            image_source=self.image_source,
+            render_scale=self.render_scale,
+            ground_resolution=self.ground_resolution,
+            window_size=self.window_size,
+            crop_to_objects=self.crop_to_objects,
+            roi_margin=self.roi_margin,
+            roi_min_size=self.roi_min_size,
+            history_depth=self.history_depth,
+            history_memory=self.history_memory * 1024 * 1024,
+            preview=self.preview,
         )
+        self.controller.segmented.connect(self.on_segmented)
+        self.controller.failed.connect(self.on_segment_failed)
+        self.controller.idle.connect(self.on_controller_idle)
 
     def activate_tool(self) -> None:
         """
@@ -175,6 +414,7 @@ class SegMap:
         self.panel.ui.modelSelect.setCurrentIndex(0)  # Default to the first model
         update_model_selection()  # Set the initial model ID
 
+        self.panel.ui.latencyPanel.set_log_path(self.latency_log)
         self.iface.addDockWidget(Qt.RightDockWidgetArea, self.panel)
         self.panel.show()
 
@@ -210,10 +450,7 @@ class SegMap:
 
         # Display options
         self.panel.ui.opacitySlider.valueChanged.connect(
-            lambda value: (
-                self.controller.segm_layer.setOpacity(value / 100.0),
-                self.controller.segm_layer.triggerRepaint()
-            )
+            lambda value: self.controller.set_opacity(value / 100.0)
         )
 
         # Bind shortcuts to buttons
@@ -261,10 +498,7 @@ class SegMap:
         self.canvas.setMapTool(self.map_tool)
 
         # Insert tmp layers
-        QgsProject.instance().addMapLayer(self.controller.segm_layer)
-        QgsProject.instance().addMapLayer(self.controller.click_layer)
-        self.controller.segm_layer.setFlags(QgsMapLayer.Private)
-        self.controller.click_layer.setFlags(QgsMapLayer.Private)
+        self.controller.add_to_project()
 
         # Disable buttons
         self.panel.ui.startBtn.hide()  # Hide "Start" button
@@ -293,20 +527,48 @@ class SegMap:
         feature.setGeometry(QgsGeometry.fromPointXY(point))
         feature.setAttributes([1 if button == Qt.LeftButton else 0])
 
-        # trigger segmentation
+        # trigger segmentation, the result is applied when the background task ends
         try:
             raster_layer_id = self.panel.ui.rasterSelect.currentData()
             raster_layer = QgsProject.instance().mapLayer(raster_layer_id)
             self.controller.segment(self.model_id, raster_layer, feature)
         except Exception as e:
-            self.iface.messageBar().pushMessage(
-                "Error", f"{str(e)}", level=Qgis.Critical
-            )
+            self.on_segment_failed(str(e))
+
+    def on_segmented(self, result: dict) -> None:
+        """Show the latency of a segmentation applied to the canvas."""
+        if self.panel and self.controller and self.controller.last_timings:
+            self.panel.ui.latencyPanel.add_sample(self.controller.last_timings)
+
+    def on_segment_failed(self, message: str) -> None:
+        self.iface.messageBar().pushMessage(
+            "Error", message, level=Qgis.Critical
+        )
+        # Do not save the previous result in place of the one that failed
+        self.cancel_pending_confirm()
+
+    def on_controller_idle(self) -> None:
+        """Run a confirmation that waited for the last segmentation."""
+        if self.confirm_pending and self.controller and not self.controller.busy:
+            self.cancel_pending_confirm()
+            self.confirm_results()
+
+    def cancel_pending_confirm(self) -> None:
+        if self.confirm_pending:
+            self.confirm_pending = False
+            if self.panel:
+                self.panel.ui.confirmBtn.setEnabled(True)
 
     def confirm_results(self) -> None:
         """
         Save the segmentation results to the selected layer.
         """
+        # Wait for a segmentation in flight, otherwise its result would be dropped
+        if self.controller and self.controller.busy:
+            self.confirm_pending = True
+            self.panel.ui.confirmBtn.setEnabled(False)
+            return
+
         # Save features from the segmentation layer to the selected layer
         if self.controller and \
             self.panel.ui.outputSelect.currentData() and\
@@ -337,10 +599,7 @@ class SegMap:
         # Cleanup the controller
         self.init_controller()
         # Insert tmp layers
-        QgsProject.instance().addMapLayer(self.controller.segm_layer)
-        QgsProject.instance().addMapLayer(self.controller.click_layer)
-        self.controller.segm_layer.setFlags(QgsMapLayer.Private)
-        self.controller.click_layer.setFlags(QgsMapLayer.Private)
+        self.controller.add_to_project()
 
     def exit_segmentation(self) -> None:
         "Reverse enter_segmentation to exit the segmentation workflow."
@@ -350,6 +609,9 @@ class SegMap:
             self.map_tool = None
             self.iface.actionPan().trigger()  # Switch back to pan tool
 
+        # Ending discards the segmentation in flight as well
+        self.cancel_pending_confirm()
+
         # Remove temporary layers
         self.init_controller()
 
@@ -364,6 +626,7 @@ class SegMap:
         self.panel.ui.outputSelect.setEnabled(True)
 
     def deactivate_tool(self) -> None:
+        self.confirm_pending = False
         if self.controller:
             self.controller.teardown()
             self.controller = None
@@ -1,63 +1,222 @@
-import os
-import base64
-from PyQt5.QtGui import QImage
+from typing import List, Sequence, Tuple
+from PyQt5.QtCore import QSize
+from PyQt5.QtGui import QImage, QPainter
 import numpy as np
+from osgeo import gdal, ogr
 from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsGeometry,
     QgsMapSettings,
-    QgsMapRendererParallelJob,
+    QgsMapRendererCustomPainterJob,
     QgsProject,
+    QgsRasterDataProvider,
     QgsRasterLayer,
+    QgsRasterRenderer,
+    QgsRectangle,
 )
 from qgis.gui import QgsMapCanvas
-import tempfile
-from PIL import Image
 
 
 def qimage_to_numpy_rgb(image: QImage) -> np.ndarray:
     """Convert a QImage to a NumPy array (RGB only)."""
     # Ensure the image is in RGB format
     image = image.convertToFormat(QImage.Format_RGB888)
+    width, height = image.width(), image.height()
 
-    # Save QImage to a temporary file
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
-        temp_filename = tmp_file.name
+    # Rows are padded to a multiple of 4 bytes, bytesPerLine is the stride
+    stride = image.bytesPerLine()
+    size = stride * height
 
-    image.save(tmp_file.name)
+    bits = image.constBits()
+    try:
+        # View the pixels in place, sip.voidptr needs the buffer size first
+        bits.setsize(size)
+        buffer = memoryview(bits)
+    except (AttributeError, TypeError):
+        # Older PyQt versions without buffer support, copy the bytes instead
+        buffer = image.bits().asstring(size)
 
-    # Load the temporary file into a NumPy array using PIL
-    pil_image = Image.open(tmp_file.name)
-    array = np.array(pil_image)
+    rows = np.frombuffer(buffer, dtype=np.uint8, count=size).reshape(height, stride)
+    # A single copy drops the padding and detaches the array from the QImage memory
+    return rows[:, :width * 3].copy().reshape(height, width, 3)
 
-    # Delete the temporary file
-    try:
-        os.remove(temp_filename)
-    except OSError:
-        pass
 
-    return array
+def crs_definition(crs: QgsCoordinateReferenceSystem) -> str:
+    """Return a CRS definition the server can parse: the authority id, or WKT for custom CRSs"""
+    authid = crs.authid()
+    if not authid or authid.upper().startswith("USER:"):
+        # User-defined CRSs only have an id local to this QGIS profile
+        return crs.toWkt(QgsCoordinateReferenceSystem.WKT_PREFERRED)
+    return authid
 
 
-def encode_image(image: np.ndarray) -> str:
-    """Encode a 3-channel NumPy image to a base64-encoded string"""
-    channel_first = np.transpose(image, (2, 0, 1))  # Change to channel first
-    flattened_data = channel_first.flatten()
-    base64_encoded = base64.b64encode(flattened_data).decode('utf-8')
-    return base64_encoded
+def encode_rle(mask: np.ndarray) -> List[int]:
+    """Encode a mask as COCO-style uncompressed RLE counts (column-major, starting with zeros)"""
+    flat = (mask > 0).ravel(order="F")
+    if flat.size == 0:
+        return []
 
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
 
-def read_displayed_raster_data(raster_layer: QgsRasterLayer, canvas: QgsMapCanvas) -> np.ndarray:
-    """Read raster data from the displayed raster layer"""
 
+def decode_rle(counts: Sequence[int], width: int, height: int) -> np.ndarray:
+    """Decode COCO-style uncompressed RLE counts (column-major, starting with zeros) to a uint8 mask"""
+    values = np.arange(len(counts), dtype=np.uint8) % 2
+    flat = np.repeat(values, np.asarray(counts, dtype=np.int64))
+    return flat.reshape((height, width), order="F")
+
+
+def polygonize_mask(mask: np.ndarray, geotransform: Sequence[float]) -> List[QgsGeometry]:
+    """Vectorize the non-zero pixels of a mask with GDAL, using a GDAL-style geotransform"""
+    if mask.size == 0:
+        return []
+
+    height, width = mask.shape
+    dataset = gdal.GetDriverByName("MEM").Create("", width, height, 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(list(geotransform))
+    band = dataset.GetRasterBand(1)
+    band.WriteArray(mask)
+
+    vector = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = vector.CreateLayer("mask")
+    layer.CreateField(ogr.FieldDefn("value", ogr.OFTInteger))
+    # Use the mask itself as the validity mask so only the foreground is vectorized
+    gdal.Polygonize(band, band, layer, 0)
+
+    geometries = []
+    for feature in layer:
+        geometry = QgsGeometry()
+        geometry.fromWkb(bytes(feature.GetGeometryRef().ExportToWkb()))
+        geometries.append(geometry)
+    return geometries
+
+
+def rasterize_geometries(
+    geometries: List[QgsGeometry], geotransform: Sequence[float], width: int, height: int
+) -> np.ndarray:
+    """Burn geometries into a uint8 mask with GDAL, using a GDAL-style geotransform"""
+    dataset = gdal.GetDriverByName("MEM").Create("", width, height, 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(list(geotransform))
+
+    vector = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = vector.CreateLayer("geometries")
+    for geometry in geometries:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+        layer.CreateFeature(feature)
+
+    gdal.RasterizeLayer(dataset, [1], layer, burn_values=[1])
+    return dataset.GetRasterBand(1).ReadAsArray()
+
+
+def displayed_map_settings(
+    raster_layer: QgsRasterLayer, canvas: QgsMapCanvas, scale: float = 1.0
+) -> QgsMapSettings:
+    """
+    Map settings rendering only the raster layer over the current canvas view,
+    at `scale` times the canvas size in logical pixels.
+    """
     map_settings = QgsMapSettings()
     map_settings.setDestinationCrs(canvas.mapSettings().destinationCrs())
     map_settings.setTransformContext(QgsProject.instance().transformContext())
-    map_settings.setOutputSize(canvas.size())
+    map_settings.setOutputSize(QSize(
+        max(round(canvas.width() * scale), 1), max(round(canvas.height() * scale), 1)
+    ))
     map_settings.setExtent(canvas.extent())
     map_settings.setLayers([raster_layer])
+    return map_settings
+
+
+class MapRender:
+    """
+    Rendering of map settings into an RGB array, split like QgsMapRendererTask.
+
+    Creating it prepares the layer renderers, which reads the layers and must
+    happen on the main thread. `render` then only draws the prepared layers and
+    can run on a background task.
+    """
+
+    def __init__(self, map_settings: QgsMapSettings) -> None:
+        self.image = QImage(map_settings.outputSize(), QImage.Format_ARGB32_Premultiplied)
+        self.image.setDotsPerMeterX(int(1000 * map_settings.outputDpi() / 25.4))
+        self.image.setDotsPerMeterY(int(1000 * map_settings.outputDpi() / 25.4))
+        self.image.fill(map_settings.backgroundColor())
+
+        self.painter = QPainter(self.image)
+        self.job = QgsMapRendererCustomPainterJob(map_settings, self.painter)
+        self.job.prepare()
+
+    def render(self) -> np.ndarray:
+        self.job.renderPrepared()
+        self.painter.end()
+        return qimage_to_numpy_rgb(self.image)
+
+
+def render_map_settings(map_settings: QgsMapSettings) -> np.ndarray:
+    """Render map settings to an RGB array on the main thread."""
+    return MapRender(map_settings).render()
+
+
+def read_displayed_raster_data(raster_layer: QgsRasterLayer, canvas: QgsMapCanvas) -> np.ndarray:
+    """Read raster data from the displayed raster layer"""
+    return render_map_settings(displayed_map_settings(raster_layer, canvas))
+
+
+def geotransform_from_extent(extent: QgsRectangle, width: int, height: int) -> List[float]:
+    """GDAL-style geotransform of a north-up image of `width` x `height` pixels covering `extent`"""
+    return [
+        extent.xMinimum(), extent.width() / width, 0.0,
+        extent.yMaximum(), 0.0, -extent.height() / height,
+    ]
+
+
+def map_to_pixel(geotransform: Sequence[float], coords: np.ndarray) -> np.ndarray:
+    """Convert an (N, 2) array of map coordinates to pixel coordinates of a north-up image"""
+    x, pixel_width, _, y, _, pixel_height = geotransform
+    return (np.asarray(coords, dtype=np.float64) - (x, y)) / (pixel_width, pixel_height)
+
+
+def extent_from_geotransform(geotransform: Sequence[float], width: int, height: int) -> QgsRectangle:
+    """Extent covered by a north-up image of `width` x `height` pixels with a GDAL-style geotransform"""
+    x, pixel_width, _, y, _, pixel_height = geotransform
+    return QgsRectangle(x, y + height * pixel_height, x + width * pixel_width, y)
+
+
+def clone_raster_pipe(raster_layer: QgsRasterLayer) -> Tuple[QgsRasterDataProvider, QgsRasterRenderer]:
+    """
+    Clone the data provider and renderer of a raster layer, like QgsRasterLayerRenderer
+    does, so the layer can be read on a background task.
+
+    Keep a reference to the provider as long as the renderer is used, the renderer
+    does not own its input.
+    """
+    provider = raster_layer.dataProvider().clone()
+    renderer = raster_layer.renderer().clone()
+    renderer.setInput(provider)
+    return provider, renderer
+
+
+def read_raster_window(
+    renderer: QgsRasterRenderer, extent: QgsRectangle, width: int, height: int
+) -> np.ndarray:
+    """
+    Read a window of a raster layer at a given resolution to an RGB array.
 
-    job = QgsMapRendererParallelJob(map_settings)
-    job.start()
-    job.waitForFinished()
+    The pixels are requested from the data provider for exactly `extent` at
+    `width` x `height`, in the layer CRS, and styled by the layer renderer, so
+    the result does not depend on the canvas or the screen. The GDAL provider
+    reads from overviews when the resolution is coarser than the native one.
+    Transparent pixels, e.g. no data, are composited over white like on the canvas.
+    """
+    block = renderer.block(1, extent, width, height)
+    if not block.isValid() or block.isEmpty():
+        raise ValueError("Failed to read the raster layer")
 
-    image = job.renderedImage()
-    return qimage_to_numpy_rgb(image)
+    # Renderer output is premultiplied ARGB32, stored as BGRA on little-endian machines
+    bgra = np.frombuffer(bytes(block.data()), dtype=np.uint8).reshape(height, width, 4)
+    rgb = bgra[:, :, 2::-1].astype(np.uint16) + (255 - bgra[:, :, 3:4])
+    return rgb.astype(np.uint8)
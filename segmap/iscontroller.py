@@ -1,8 +1,18 @@
 from typing import List, Dict, Any, Optional, Tuple, TypedDict, Union
 import os
+import math
+import base64
+import gzip
+import json
+import time
 from urllib.parse import urljoin
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from qgis.core import (
+    QgsApplication,
+    QgsTask,
     QgsVectorLayer,
     QgsField,
     QgsFillSymbol,
@@ -14,16 +24,35 @@ from qgis.core import (
     QgsPointXY,
     QgsCoordinateTransform,
     QgsCoordinateReferenceSystem,
+    QgsMapLayer,
     QgsProject,
+    QgsRasterDataProvider,
     QgsRasterLayer,
+    QgsRasterRenderer,
+    QgsRectangle,
+    QgsWkbTypes,
 )
+from qgis.gui import QgsRubberBand
 from qgis.utils import iface
-from PyQt5.QtCore import QMetaType
+from PyQt5.QtCore import QMetaType, QObject, pyqtSignal
+from PyQt5.QtGui import QColor, QTransform
 from helper_func import (
-    read_displayed_raster_data,
-    encode_image,
+    displayed_map_settings,
+    MapRender,
+    clone_raster_pipe,
+    read_raster_window,
+    geotransform_from_extent,
+    extent_from_geotransform,
+    map_to_pixel,
+    crs_definition,
+    encode_rle,
+    decode_rle,
+    polygonize_mask,
+    rasterize_geometries,
 )
-from collections import deque
+from wire_format import encode_image, parse_server_timing
+from tracing import Span, Tracer, SPAN_KIND_CLIENT
+from render_cache import RenderCache, image_hash
 
 
 class ModelInfo(TypedDict):
@@ -34,14 +63,103 @@ class ModelInfo(TypedDict):
     description: Optional[str]
 
 
-class FeatureState(TypedDict):
-    """Type definition for layer state in undo/redo stacks"""
+class SegmentCommand(TypedDict):
+    """One step of the undo history: the click it added and the segmentation it resulted in"""
 
-    click_layer: List[QgsFeature]
-    segm_layer: List[QgsFeature]
+    click: Optional[QgsFeature]
+    segmentation: Optional[List[QgsGeometry]]  # None until the result is applied
+    size: int  # Approximate memory use in bytes
 
 
-class ISController:
+def create_session(retries: int = 3, backoff_factor: float = 0.3, pool_size: int = 4) -> requests.Session:
+    """
+    Create a pooled keep-alive HTTP session with bounded retries.
+
+    Failed connections are retried for every request since nothing was sent yet.
+    Read errors and 502/503/504 responses are only retried for idempotent methods,
+    a segment POST that reached the server is not sent twice.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ImageFrame(TypedDict):
+    """Pixel grid of the image sent to the server, a north-up GDAL-style geotransform in `crs`"""
+
+    crs: QgsCoordinateReferenceSystem
+    geotransform: List[float]
+    width: int
+    height: int
+
+
+class SegmentState(TypedDict):
+    """Snapshot of the canvas and layers taken on the main thread for a background segmentation"""
+
+    model_id: str
+    source: str
+    map_render: Optional[MapRender]  # Prepared canvas rendering, None if it is cached
+    source_image: Optional[np.ndarray]  # Cached canvas rendering a crop is cut from
+    render_entry: Optional[Dict[str, Any]]  # Cached image of the request
+    raster_pipe: Optional[Tuple[QgsRasterDataProvider, QgsRasterRenderer]]
+    source_key: Tuple[Any, ...]
+    render_key: Tuple[Any, ...]
+    roi: Optional[List[int]]
+    frame: ImageFrame
+    segm_crs: QgsCoordinateReferenceSystem
+    to_segm: Optional[QgsCoordinateTransform]  # From the image CRS, None if they are the same
+    from_segm: Optional[QgsCoordinateTransform]
+    clicks: List[List[Union[float, int]]]
+    segm_geometries: List[QgsGeometry]
+    mask_id: Optional[str]
+    mask_frame: Optional[Tuple[Any, ...]]
+    started: float
+
+
+class SegmentTask(QgsTask):
+    """
+    Runs one segmentation request off the main thread.
+
+    `completed` is emitted from `finished`, which QGIS calls on the main thread,
+    with the generation of the request, the outcome (None if it failed or was
+    canceled) and an error message.
+    """
+
+    completed = pyqtSignal(int, object, str)
+
+    def __init__(self, controller: "ISController", generation: int, state: SegmentState):
+        super().__init__("SegMap segmentation", QgsTask.CanCancel | QgsTask.Silent)
+        self.controller = controller
+        self.generation = generation
+        self.state = state
+        self.outcome: Optional[Dict[str, Any]] = None
+        self.error = ""
+
+    def run(self) -> bool:
+        try:
+            self.outcome = self.controller._run_segmentation(self.state, self)
+        except Exception as e:
+            self.error = str(e)
+            return False
+        return self.outcome is not None
+
+    def finished(self, result: bool) -> None:
+        self.completed.emit(self.generation, self.outcome if result else None, self.error)
+
+
+class ISController(QObject):
     """
     This class handles interactive image segmentation using RESTful API endpoints.
 
@@ -83,17 +201,87 @@ class ISController:
         channel-first (C, H, W) and must be reshaped into a 1-D array before transmission.
         The server will reconstruct the original shape.
         Ensure the image shape matches the model's input requirements.
+    - Segmentations run on a background `SegmentTask`. Each click supersedes the
+        request in flight: it is canceled, its result discarded, and the latest
+        clicks are sent once it has ended.
+    - The image is either the rendered canvas (`image_source="canvas"`), scaled by
+        `render_scale` and capped in auto mode so 4K screens do not upload 8 MP,
+        or a window of the raster layer around the clicks read at a fixed ground
+        resolution (`image_source="raster"`), independent of the screen. Click
+        pixel coordinates and masks refer to the `ImageFrame` of the image either way.
+    - With `crop_to_objects`, only a region of interest around the clicks and the
+        current segmentation is sent (at least `roi_min_size` pixels, with a margin
+        of `roi_margin` times the object size). The crop is sent with its own
+        geotransform, so results map back to the full image without extra steps.
+    - With `preview="overlay"` the clicks and segmentation are drawn as rubber bands
+        on the canvas. The memory layers still hold them but are not added to the
+        project, so a result does not trigger a repaint of the map layers.
+    - Segmentation results are requested as a base64-encoded WKB MultiPolygon
+        (`geometry_format="wkb"`), so they can be loaded into QGIS without walking
+        the vertices in Python. The geotransform and CRS of the image are sent along
+        with it so the server returns map coordinates in the segmentation layer CRS.
     """
 
+    ROI_ALIGN = 32  # Crops are aligned to this many pixels so nearby clicks reuse them
+    AUTO_RENDER_SIZE = 1536  # Long side of the canvas rendering in auto render scale
+
+    segmented = pyqtSignal(dict)  # The server response of an applied segmentation
+    failed = pyqtSignal(str)
+    idle = pyqtSignal()  # The last request has ended, after `segmented` or `failed`
+
     def __init__(
         self,
         api_url: str,
         token: str,
+        simplify_tolerance: float = 0.0,
+        output_mode: str = "polygon",
+        tracer: Optional[Tracer] = None,
+        session: Optional[requests.Session] = None,
+        render_cache: Optional[RenderCache] = None,
+        timeout: Tuple[float, float] = (5.0, 60.0),
+        image_source: str = "canvas",
+        ground_resolution: float = 0.0,
+        window_size: int = 1024,
+        history_depth: int = 100,
+        history_memory: int = 64 * 1024 * 1024,
+        preview: str = "layers",
+        render_scale: float = 0.0,
+        crop_to_objects: bool = False,
+        roi_margin: float = 0.5,
+        roi_min_size: int = 512,
     ):
+        super().__init__()
         self.api_url = api_url
         self.token = token
+        self.simplify_tolerance = simplify_tolerance  # Douglas-Peucker tolerance in pixels
+        # "polygon": the server vectorizes the result,
+        # "mask": the server returns an RLE mask which is vectorized locally
+        self.output_mode = output_mode
+        # "canvas": render the canvas view,
+        # "raster": read a window of the raster layer around the clicks
+        self.image_source = image_source
+        self.ground_resolution = ground_resolution  # Layer units per pixel, 0 for native
+        self.window_size = window_size  # Side of the raster window in pixels
+        # Canvas rendering size relative to the physical canvas pixels, 0 for auto
+        self.render_scale = render_scale
+        # Region of interest: margin as a fraction of the object size, minimum side in pixels
+        self.crop_to_objects = crop_to_objects
+        self.roi_margin = roi_margin
+        self.roi_min_size = roi_min_size
+        # Keep-alive connections, shared with the controllers created before and after this one
+        self.session = session or create_session()
+        self.timeout = timeout  # (connect, read) in seconds
+        # Rendered and encoded canvas images, reused while the view is unchanged
+        self.render_cache = render_cache or RenderCache()
+        # Client stages of each segmentation, continued by the server via `traceparent`
+        self.tracer = tracer or Tracer()
+        # Latency breakdown of the last segmentation, shown in the latency panel
+        self.last_timings: Optional[Dict[str, Any]] = None
         self.current_model: Optional[str] = None
         self.canvas = iface.mapCanvas()
+        # "layers": show the clicks and segmentation as temporary project layers,
+        # "overlay": draw them as rubber bands, the layers only hold the data
+        self.preview = preview
 
         # Set up the style for the clicks layer,
         # use point symbol with colors depending on click type
@@ -136,8 +324,43 @@ class ISController:
         )
         self.segm_layer.renderer().setSymbol(segm_symbol)
 
-        self.undo_stack: deque[FeatureState] = deque()  # Store previous states for undo
-        self.redo_stack: deque[FeatureState] = deque()  # Store undone states for redo
+        # Canvas items of the overlay preview, redrawn without rendering any map layer
+        self._segm_band: Optional[QgsRubberBand] = None
+        self._click_bands: Dict[int, QgsRubberBand] = {}
+        if self.preview == "overlay":
+            self._segm_band = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
+            self._segm_band.setStrokeColor(QColor(0, 0, 255))
+            self._segm_band.setWidth(1)
+            for click_type, color in ((0, QColor("red")), (1, QColor("green"))):
+                band = QgsRubberBand(self.canvas, QgsWkbTypes.PointGeometry)
+                band.setColor(color)
+                band.setIcon(QgsRubberBand.ICON_CIRCLE)
+                band.setIconSize(8)
+                self._click_bands[click_type] = band
+            self.set_opacity(0.5)
+
+        # Id of the last mask cached by the server and the image frame it belongs to
+        self.mask_id: Optional[str] = None
+        self._mask_frame: Optional[Tuple[Any, ...]] = None
+
+        # Undo history: the first `history_position` commands are applied, the rest were undone.
+        # Commands beyond the depth or memory cap are folded into `history_base`.
+        self.history: List[SegmentCommand] = []
+        self.history_position = 0
+        self.history_base: List[QgsGeometry] = []  # Segmentation before the oldest command
+        self.history_depth = history_depth
+        self.history_memory = history_memory  # Bytes
+        self._history_size = 0
+
+        # Coordinate transforms by CRS pair, rebuilt when the project transform context changes
+        self._crs_transforms: Dict[Tuple[str, str], QgsCoordinateTransform] = {}
+        QgsProject.instance().transformContextChanged.connect(self._clear_crs_transforms)
+
+        # Background segmentation: results of older generations are discarded
+        self.generation = 0
+        self._task: Optional[SegmentTask] = None
+        self._pending = False
+        self._request: Optional[Tuple[str, QgsRasterLayer]] = None
 
     def _headers(self) -> Dict[str, str]:
         return {
@@ -148,236 +371,746 @@ class ISController:
 
     def get_models(self) -> List[ModelInfo]:
         """Retrieve a list of available models for segmentation."""
-        response = requests.get(
-            urljoin(self.api_url, "v1/models"), headers=self._headers()
+        response = self.session.get(
+            urljoin(self.api_url, "v1/models"), headers=self._headers(), timeout=self.timeout
         )
         response.raise_for_status()
         return response.json()
 
-    def add_click(self, feature: QgsFeature) -> None:
-        """Add a click feature to the click layer."""
-        self.click_layer.dataProvider().addFeature(feature)
+    def add_to_project(self) -> None:
+        """Show the clicks and segmentation layers, unless they are drawn as an overlay."""
+        if self.preview == "overlay":
+            return
+        QgsProject.instance().addMapLayer(self.segm_layer)
+        QgsProject.instance().addMapLayer(self.click_layer)
+        self.segm_layer.setFlags(QgsMapLayer.Private)
+        self.click_layer.setFlags(QgsMapLayer.Private)
+
+    def set_opacity(self, opacity: float) -> None:
+        """Set the opacity of the segmentation, from 0 to 1."""
+        self.segm_layer.setOpacity(opacity)
+        if self._segm_band is not None:
+            self._segm_band.setFillColor(QColor(0, 0, 255, round(opacity * 255)))
+        else:
+            self.segm_layer.triggerRepaint()
+
+    def add_click(self, feature: QgsFeature) -> QgsFeature:
+        """Add a click feature to the click layer, return it with its feature id."""
+        _, added = self.click_layer.dataProvider().addFeatures([feature])
+        self._clicks_changed()
+        return added[0]
+
+    def _clicks_changed(self) -> None:
         self.click_layer.updateExtents()
-        self.click_layer.triggerRepaint()
+        if not self._click_bands:
+            self.click_layer.triggerRepaint()
+            return
+
+        points: Dict[int, List[QgsPointXY]] = {click_type: [] for click_type in self._click_bands}
+        for feature in self.click_layer.getFeatures():
+            if feature.hasGeometry() and feature["click_type"] in points:
+                points[feature["click_type"]].append(feature.geometry().asPoint())
+        for click_type, band in self._click_bands.items():
+            if points[click_type]:
+                band.setToGeometry(QgsGeometry.fromMultiPointXY(points[click_type]), self.click_layer)
+            else:
+                band.reset(QgsWkbTypes.PointGeometry)
 
     def segment(
         self,
         model_id: str,
         raster_layer: QgsRasterLayer,
         new_click: Optional[QgsFeature] = None,
-    ) -> Dict[str, Any]:
-        """Perform image segmentation using the current model and manage clicks/mask."""
-        self._save_state_for_undo()  # Save current state before modification
-        self.redo_stack.clear()  # Clear redo stack on new action
+    ) -> None:
+        """
+        Add a click and segment the canvas in the background.
+
+        Rendering, encoding, the HTTP request and building the result geometries
+        run on a `SegmentTask`. The result is applied to the segmentation layer on
+        the main thread and announced with `segmented`, errors with `failed`.
+        """
+        # Add the new click to the click layer and record it for undo
+        self._push_command(self.add_click(new_click) if new_click else None)
+
+        self._request = (model_id, raster_layer)
+        self.generation += 1
+        if self._task is not None:
+            # Cancel-on-supersede: the running request is abandoned and the latest
+            # clicks are sent once it has ended, so rapid clicks are coalesced
+            self._task.cancel()
+            self._pending = True
+        else:
+            self._start_task()
+
+    @property
+    def busy(self) -> bool:
+        return self._task is not None
+
+    def _start_task(self) -> None:
+        self._pending = False
+        model_id, raster_layer = self._request
+        task = SegmentTask(self, self.generation, self._snapshot(model_id, raster_layer))
+        task.completed.connect(self._on_task_completed)
+        self._task = task  # Keep a reference, the task manager does not own the Python object
+        QgsApplication.taskManager().addTask(task)
+
+    def _invalidate(self) -> None:
+        """Discard the running and pending requests, e.g. when the clicks are undone."""
+        self.generation += 1
+        self._pending = False
+        if self._task is not None:
+            self._task.cancel()
+
+    def _snapshot(self, model_id: str, raster_layer: QgsRasterLayer) -> "SegmentState":
+        """Copy everything a segmentation needs from the canvas and layers on the main thread."""
+        map_settings = None
+        raster_pipe = None
+        if self.image_source == "raster":
+            frame = self._raster_frame(raster_layer)
+            raster_pipe = clone_raster_pipe(raster_layer)
+        else:
+            map_settings = displayed_map_settings(raster_layer, self.canvas, self._render_scale())
+            size = map_settings.outputSize()
+            frame = {
+                "crs": map_settings.destinationCrs(),
+                # The visible extent is adjusted to the aspect ratio of the rounded output size
+                "geotransform": geotransform_from_extent(
+                    map_settings.visibleExtent(), size.width(), size.height()
+                ),
+                "width": size.width(),
+                "height": size.height(),
+            }
+
+        source_key = self.render_cache.key(
+            raster_layer, self.image_source, frame["geotransform"],
+            frame["width"], frame["height"], frame["crs"],
+        )
+        render_key = source_key
+        roi = self._roi(frame) if self.crop_to_objects else None
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            x, pixel_width, _, y, _, pixel_height = frame["geotransform"]
+            frame = {
+                "crs": frame["crs"],
+                "geotransform": [
+                    x + x0 * pixel_width, pixel_width, 0.0,
+                    y + y0 * pixel_height, 0.0, pixel_height,
+                ],
+                "width": x1 - x0,
+                "height": y1 - y0,
+            }
+            render_key = source_key + (tuple(roi),)
+
+        # Canvas renderings are prepared here, on the main thread, unless cached
+        render_entry = self.render_cache.get(render_key)
+        source_image = None
+        map_render = None
+        if render_entry is None and map_settings is not None:
+            source = self.render_cache.get(source_key)
+            if source is not None:
+                source_image = source["image"]
+            else:
+                map_render = MapRender(map_settings)
+
+        return {
+            "model_id": model_id,
+            "source": self.image_source,
+            "map_render": map_render,
+            "source_image": source_image,
+            "render_entry": render_entry,
+            "raster_pipe": raster_pipe,
+            "source_key": source_key,
+            "render_key": render_key,
+            "roi": roi,
+            "frame": frame,
+            "segm_crs": self.segm_layer.crs(),
+            "to_segm": self._crs_transform(frame["crs"], self.segm_layer.crs()),
+            "from_segm": self._crs_transform(self.segm_layer.crs(), frame["crs"]),
+            "clicks": self._get_click_list(frame),
+            "segm_geometries": [
+                QgsGeometry(feature.geometry()) for feature in self.segm_layer.getFeatures()
+                if feature.hasGeometry()
+            ],
+            "mask_id": self.mask_id,
+            "mask_frame": self._mask_frame,
+            "started": time.perf_counter(),
+        }
 
-        if new_click:
-            # Add the new click to the click layer
-            self.add_click(new_click)
+    def _render_scale(self) -> float:
+        """
+        Scale of the canvas rendering relative to the logical canvas size.
+
+        `render_scale` is relative to the physical pixels of the screen, so HiDPI
+        canvases are not rendered at half their resolution. In auto mode (0) the
+        canvas is rendered at its physical resolution, but with the long side
+        capped at `AUTO_RENDER_SIZE` pixels.
+        """
+        device_pixel_ratio = self.canvas.devicePixelRatioF()
+        if self.render_scale > 0:
+            return self.render_scale * device_pixel_ratio
+        long_side = max(self.canvas.width(), self.canvas.height(), 1)
+        return min(device_pixel_ratio, self.AUTO_RENDER_SIZE / long_side)
+
+    def _clear_crs_transforms(self) -> None:
+        self._crs_transforms.clear()
+
+    def _crs_transform(
+        self, source: QgsCoordinateReferenceSystem, destination: QgsCoordinateReferenceSystem
+    ) -> Optional[QgsCoordinateTransform]:
+        """
+        Cached transform between two CRSs, None if they are the same.
+
+        Must be called on the main thread. The returned transform can be used on
+        background tasks.
+        """
+        if source == destination:
+            return None
+        key = (crs_definition(source), crs_definition(destination))
+        transform = self._crs_transforms.get(key)
+        if transform is None:
+            transform = QgsCoordinateTransform(source, destination, QgsProject.instance())
+            self._crs_transforms[key] = transform
+        return transform
+
+    def _raster_frame(self, raster_layer: QgsRasterLayer) -> ImageFrame:
+        """
+        Window of the raster layer around the clicks and the current segmentation.
+
+        The window is `window_size` pixels wide at the ground resolution, coarser if
+        the clicks and segmentation would not fit with a margin. It is aligned to a
+        grid of a quarter window so it stays put while clicking around the same
+        object, which keeps the render cache and the server-side mask valid.
+        """
+        crs = raster_layer.crs()
+        bbox = self._objects_extent(crs)
+        if bbox.isNull():
+            bbox = self.canvas.extent()
+            transform = self._crs_transform(self.canvas.mapSettings().destinationCrs(), crs)
+            if transform is not None:
+                bbox = transform.transformBoundingBox(bbox)
+
+        resolution = self.ground_resolution or raster_layer.rasterUnitsPerPixelX()
+        # Leave a margin of a quarter of the window on each side of the objects
+        resolution = max(resolution, max(bbox.width(), bbox.height()) * 1.5 / self.window_size)
+        side = self.window_size * resolution
+        step = side / 4
+
+        origin = raster_layer.extent()
+        center = bbox.center()
+        x_min = origin.xMinimum() + round((center.x() - side / 2 - origin.xMinimum()) / step) * step
+        y_max = origin.yMaximum() + round((center.y() + side / 2 - origin.yMaximum()) / step) * step
+        window = QgsRectangle(x_min, y_max - side, x_min + side, y_max)
+
+        # Do not read beyond the raster
+        clipped = window.intersect(origin)
+        if not clipped.isEmpty():
+            window = clipped
+        width = max(round(window.width() / resolution), 1)
+        height = max(round(window.height() / resolution), 1)
 
-        # Read image data from the current canvas
-        image = read_displayed_raster_data(raster_layer, self.canvas)
-        base64_image = encode_image(image)
+        return {
+            "crs": crs,
+            "geotransform": geotransform_from_extent(window, width, height),
+            "width": width,
+            "height": height,
+        }
+
+    def _objects_extent(self, crs: QgsCoordinateReferenceSystem) -> QgsRectangle:
+        """Bounding box of the clicks and the current segmentation in `crs`, null if there are none."""
+        bbox = QgsRectangle()
+        bbox.setMinimal()
+        for layer in (self.click_layer, self.segm_layer):
+            if layer.featureCount() == 0:
+                continue
+            extent = layer.extent()
+            transform = self._crs_transform(layer.crs(), crs)
+            if transform is not None:
+                extent = transform.transformBoundingBox(extent)
+            bbox.combineExtentWith(extent)
+        return bbox
+
+    def _roi(self, frame: ImageFrame) -> Optional[List[int]]:
+        """
+        Pixel box [x0, y0, x1, y1] of the region of interest in an image.
+
+        The box is a square around the clicks and the current segmentation,
+        expanded by the margin and at least `roi_min_size` pixels wide, aligned
+        to `ROI_ALIGN` pixels and clipped to the image. Returns None if the crop
+        would cover the whole image.
+        """
+        bbox = self._objects_extent(frame["crs"])
+        if bbox.isNull():
+            return None
+
+        x, pixel_width, _, y, _, pixel_height = frame["geotransform"]
+        left = (bbox.xMinimum() - x) / pixel_width
+        right = (bbox.xMaximum() - x) / pixel_width
+        top = (bbox.yMaximum() - y) / pixel_height
+        bottom = (bbox.yMinimum() - y) / pixel_height
+        size = max(right - left, bottom - top)
+        half = max(size * (1 + 2 * self.roi_margin), self.roi_min_size) / 2
+        center_x = (left + right) / 2
+        center_y = (top + bottom) / 2
+
+        align = self.ROI_ALIGN
+        x0 = max(math.floor((center_x - half) / align) * align, 0)
+        y0 = max(math.floor((center_y - half) / align) * align, 0)
+        x1 = min(math.ceil((center_x + half) / align) * align, frame["width"])
+        y1 = min(math.ceil((center_y + half) / align) * align, frame["height"])
+        if x1 <= x0 or y1 <= y0:
+            return None  # The objects are outside the image
+        if x1 - x0 >= frame["width"] and y1 - y0 >= frame["height"]:
+            return None
+        return [x0, y0, x1, y1]
+
+    def _on_task_completed(
+        self, generation: int, outcome: Optional[Dict[str, Any]], error: str
+    ) -> None:
+        """Apply the outcome of a `SegmentTask` on the main thread unless it was superseded."""
+        self._task = None
+        if self._pending:
+            self._start_task()
+            return
+        self._apply_outcome(generation, outcome, error)
+        self.idle.emit()
+
+    def _apply_outcome(
+        self, generation: int, outcome: Optional[Dict[str, Any]], error: str
+    ) -> None:
+        if generation != self.generation:
+            return  # Superseded by undo/redo or a teardown
+
+        if outcome is None:
+            if error:
+                self.failed.emit(error)
+            return
+
+        result = outcome["result"]
+        self.mask_id = result.get("mask_id")
+        self._mask_frame = outcome["frame"]
+
+        start = time.perf_counter()
+        self._set_segm_geometries(outcome["geometries"])
+        self._record_segmentation(outcome["geometries"])
+        end = time.perf_counter()
+
+        timings = outcome["timings"]
+        timings["update"] += (end - start) * 1000
+        # From the snapshot of the clicks to the result on the canvas
+        timings["total"] = (end - outcome["started"]) * 1000
+        self.last_timings = timings
+        self.segmented.emit(result)
+
+    def _run_segmentation(self, state: "SegmentState", task: QgsTask) -> Optional[Dict[str, Any]]:
+        """
+        Run a segmentation request from a snapshot, called on a background task.
+
+        Returns None if the task was canceled.
+        """
+        tracer = self.tracer  # The same tracer for the spans and their breakdown
+        with tracer.span(
+            "segment", model_id=state["model_id"], output=self.output_mode
+        ) as span:
+            outcome = self._request_segmentation(state, task)
+            if outcome is not None:
+                span.attributes["mask_id"] = outcome["result"].get("mask_id")
+        if outcome is not None:
+            outcome["timings"] = self._latency_breakdown(tracer.last_trace, outcome["result"])
+            outcome["started"] = state["started"]
+        return outcome
+
+    @staticmethod
+    def _latency_breakdown(spans: List[Span], result: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Summarize the spans of a segmentation into client and server times in milliseconds.
+
+        `upload` is the time of the HTTP request not spent in the server stages, i.e.
+        the transfer of the request and response bodies and the network latency.
+        """
+        durations: Dict[str, float] = {}
+        for span in spans:
+            durations[span.name] = durations.get(span.name, 0.0) + span.duration_ms
+        # A request resent after the server evicted its image counts in upload
+        uploads = [s for s in spans if s.kind == SPAN_KIND_CLIENT]
+        request = uploads[-1] if uploads else None
+        root = next((s for s in spans if not s.parent_span_id), None)
+
+        server_stages = parse_server_timing(
+            (request.attributes.get("server_timing") if request else None) or ""
+        )
+        server = sum(server_stages.values()) or result.get("processing_time", 0.0) * 1000
+        http = sum(s.duration_ms for s in uploads)
+        read_image = next((s for s in spans if s.name == "read_image"), None)
 
-        # Collect clicks from the click layer
-        clicks = self._get_click_list()
+        return {
+            "render": durations.get("read_image", 0.0),
+            "encode": sum(durations.get(name, 0.0) for name in (
+                "encode_image", "previous_mask_encode", "compress"
+            )),
+            "upload": max(http - server, 0.0),
+            "server": server,
+            "update": durations.get("parse_response", 0.0) + durations.get("build_geometries", 0.0),
+            "total": root.duration_ms if root else 0.0,
+            "server_stages": server_stages,
+            "payload_bytes": sum(s.attributes.get("body_bytes", 0) for s in uploads),
+            "width": read_image.attributes.get("width") if read_image else None,
+            "height": read_image.attributes.get("height") if read_image else None,
+            "model_id": root.attributes.get("model_id") if root else None,
+        }
 
-        # Prepare payload
+    def _request_segmentation(
+        self, state: "SegmentState", task: QgsTask
+    ) -> Optional[Dict[str, Any]]:
+        tracer = self.tracer
+
+        # Render the canvas snapshot or read the raster window, unless it was read before
+        frame = state["frame"]
+        entry = state["render_entry"]
+        with tracer.span(
+            "read_image", source=state["source"], cache_hit=entry is not None, roi=state["roi"]
+        ) as span:
+            if entry is None:
+                entry = self.render_cache.put(state["render_key"], self._read_image(state))
+            image = entry["image"]
+            span.attributes.update(width=image.shape[1], height=image.shape[0])
+        if task.isCanceled():
+            return None
+        if entry["encoded"] is None:
+            with tracer.span("encode_image"):
+                entry["encoded"] = encode_image(image)
+                entry["hash"] = image_hash(image)
+
+        # Prepare payload. Once a server has acknowledged an image hash, the image
+        # itself is only sent again if the server no longer has it.
         payload: Dict[str, Any] = {
-            "model_id": model_id,
-            "image": base64_image,
-            "clicks": clicks,
+            "model_id": state["model_id"],
+            "image": "" if self.api_url in entry["uploaded"] else entry["encoded"],
+            "image_hash": entry["hash"],
+            "clicks": state["clicks"],
             "width": image.shape[1],
             "height": image.shape[0],
             "channel": image.shape[2],
+            "simplify_tolerance": self.simplify_tolerance,
+            "geometry_format": "wkb",
+            "output": self.output_mode,
+            "mask_format": "rle",
         }
 
-        # if self.segm_layer has feature, convert it to previous_mask in the payload
-        if False:
-            # if self.segm_layer.featureCount() > 0:
-            payload["previous_mask"] = self._segm_layer_to_geojson()
+        # Let the server return map coordinates in the CRS of the segmentation layer
+        payload["geotransform"] = frame["geotransform"]
+        payload["crs"] = crs_definition(frame["crs"])
+        if state["to_segm"] is not None:
+            payload["target_crs"] = crs_definition(state["segm_crs"])
+
+        # Condition the model on the current segmentation. While the image frame is
+        # unchanged the server still has it cached, otherwise send it as an RLE mask.
+        mask_frame = (tuple(frame["geotransform"]), image.shape[1], image.shape[0], payload["crs"])
+        payload["cache_mask"] = True
+        if state["mask_id"] and mask_frame == state["mask_frame"]:
+            payload["previous_mask_id"] = state["mask_id"]
         else:
-            payload["previous_mask"] = []
-
-        response = requests.post(
-            urljoin(self.api_url, "v1/segment"), json=payload, headers=self._headers()
-        )
+            with tracer.span("previous_mask_encode"):
+                payload["previous_mask"] = self._geometries_to_mask(
+                    state, image.shape[1], image.shape[0]
+                ) or []
+
+        if task.isCanceled():
+            return None
+        response = self._post_segment(payload)
+        if response.status_code == 409 and not payload["image"]:
+            # The server evicted the image, send it again
+            entry["uploaded"].discard(self.api_url)
+            payload["image"] = entry["encoded"]
+            response = self._post_segment(payload)
+        if task.isCanceled():
+            return None
         response.raise_for_status()
-        result = response.json()
-
-        # Save segmentation result to the segmentation layer
-        self._geojson_to_segm_layer(result["segmentation"])
+        with tracer.span("parse_response"):
+            result = response.json()
+        if result.get("image_hash") == entry["hash"]:
+            entry["uploaded"].add(self.api_url)
+
+        # Build the geometries of the segmentation layer
+        with tracer.span("build_geometries"):
+            if result.get("mask") is not None:
+                geometries = self._mask_to_geometries(state, result["mask"])
+            else:
+                geometries = self._wkb_to_geometries(
+                    state,
+                    base64.b64decode(result["segmentation"]),
+                    georeferenced=result.get("crs") is not None,
+                )
+
+        return {"result": result, "geometries": geometries, "frame": mask_frame}
+
+    def _read_image(self, state: "SegmentState") -> np.ndarray:
+        """Read the image of a snapshot, cropped to its region of interest."""
+        frame = state["frame"]
+        if state["raster_pipe"] is not None:
+            # The provider reads the cropped window directly
+            return read_raster_window(
+                state["raster_pipe"][1],
+                extent_from_geotransform(frame["geotransform"], frame["width"], frame["height"]),
+                frame["width"],
+                frame["height"],
+            )
 
-        return result
+        # Crops of the same view are cut from one rendering
+        image = state["source_image"]
+        if image is None:
+            image = state["map_render"].render()
+            if state["roi"] is not None:
+                self.render_cache.put(state["source_key"], image)
+        if state["roi"] is not None:
+            x0, y0, x1, y1 = state["roi"]
+            image = image[y0:y1, x0:x1].copy()
+        return image
+
+    def _post_segment(self, payload: Dict[str, Any]) -> requests.Response:
+        """Send a gzip-compressed segment request."""
+        tracer = self.tracer
+
+        # Compress the request body, the image dominates its size
+        headers = self._headers()
+        headers["Content-Encoding"] = "gzip"
+        with tracer.span("compress") as span:
+            body = gzip.compress(json.dumps(payload).encode("utf-8"), compresslevel=1)
+            span.attributes["body_bytes"] = len(body)
+
+        url = urljoin(self.api_url, "v1/segment")
+        with tracer.span("POST /v1/segment", kind=SPAN_KIND_CLIENT, url=url) as span:
+            response = self.session.post(
+                url, data=body, headers=tracer.inject(headers), timeout=self.timeout
+            )
+            span.attributes["body_bytes"] = len(body)
+            span.attributes["status_code"] = response.status_code
+            span.attributes["server_timing"] = response.headers.get("Server-Timing")
+        return response
+
+    def _mask_to_geometries(self, state: "SegmentState", mask: Dict[str, Any]) -> List[QgsGeometry]:
+        """Vectorize an RLE mask returned by the server into geometries in the layer CRS."""
+        array = decode_rle(mask["counts"], mask["width"], mask["height"])
+
+        frame = state["frame"]
+        geotransform = mask.get("geotransform")
+        if geotransform is None:
+            # Place the mask crop in the image from its pixel offset
+            x, pixel_width, _, y, _, pixel_height = frame["geotransform"]
+            geotransform = [
+                x + mask["offset"][0] * pixel_width, pixel_width, 0,
+                y + mask["offset"][1] * pixel_height, 0, pixel_height,
+            ]
 
-    def _geojson_to_segm_layer(self, segm: List[Dict[str, Any]]) -> None:
-        """Save segmentation result to the segmentation layer."""
+        transform = state["to_segm"]
+        geometries = []
+        for geometry in polygonize_mask(array, geotransform):
+            if self.simplify_tolerance > 0:
+                geometry = geometry.simplify(self.simplify_tolerance * abs(geotransform[1]))
+            if transform is not None:
+                geometry.transform(transform)
+            geometries.append(geometry)
+
+        return geometries
+
+    def _wkb_to_geometries(
+        self, state: "SegmentState", wkb: bytes, georeferenced: bool = False
+    ) -> List[QgsGeometry]:
+        """
+        Split a WKB MultiPolygon into geometries in the layer CRS.
+
+        The geometry is expected in the layer CRS if it was georeferenced by the
+        server, otherwise in image pixel coordinates.
+        """
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+
+        if not georeferenced:
+            # Convert pixel coordinates to map coordinates with a single affine transform
+            frame = state["frame"]
+            x, pixel_width, _, y, _, pixel_height = frame["geotransform"]
+            geometry.transform(QTransform(pixel_width, 0, 0, pixel_height, x, y))
+
+            # Transform to target CRS if necessary
+            if state["to_segm"] is not None:
+                geometry.transform(state["to_segm"])
+
+        return geometry.asGeometryCollection()
+
+    def _set_segm_geometries(self, geometries: List[QgsGeometry]) -> None:
+        """Replace the features of the segmentation layer with one feature per polygon."""
         provider = self.segm_layer.dataProvider()
         provider.truncate()  # Clear existing features
 
-        target_crs = self.segm_layer.crs()
-
-        for polygon in segm:
+        features = []
+        for geometry in geometries:
             feature = QgsFeature()
-
-            geo_polygon = []
-            for ring in polygon["coordinates"]:
-                qgis_ring = []
-                for point in ring:
-                    # Convert pixel coordinates to geo coordinates
-                    geo_x, geo_y = self._pixel2geo_coords(
-                        point[0], point[1], target_crs
-                    )
-                    qgis_ring.append(QgsPointXY(geo_x, geo_y))
-                geo_polygon.append(qgis_ring)
-
-            geometry = QgsGeometry.fromPolygonXY(geo_polygon)
             feature.setGeometry(geometry)
-
-            provider.addFeature(feature)
+            features.append(feature)
+        provider.addFeatures(features)
 
         self.segm_layer.updateExtents()
-        self.segm_layer.triggerRepaint()
-
-    def _segm_layer_to_geojson(self) -> List[Dict[str, Any]]:
-        """Export all features in segm_layer to GeoJSON format."""
-        features = list(self.segm_layer.getFeatures())
-        geojson_features: List[Dict[str, Any]] = []
-
-        for feature in features:
-            geometry = feature.geometry()
-            polygon = []
-
-            for ring in geometry.asPolygon():
-                ring_points = []
-                for point in ring:
-                    # Convert geo coordinates to pixel coordinates
-                    pixel_x, pixel_y = self._geo2pixel_coords(
-                        point, self.segm_layer.crs()
-                    )
-                    ring_points.append([pixel_x, pixel_y])
-                polygon.append(ring_points)
-
-            geojson_features.append({"type": "Polygon", "coordinates": polygon})
+        if self._segm_band is None:
+            self.segm_layer.triggerRepaint()
+        elif geometries:
+            # Only the overlay is redrawn, the map layers and their caches are untouched
+            self._segm_band.setToGeometry(QgsGeometry.collectGeometry(geometries), self.segm_layer)
+        else:
+            self._segm_band.reset(QgsWkbTypes.PolygonGeometry)
+
+    def _geometries_to_mask(
+        self, state: "SegmentState", width: int, height: int
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Rasterize the segmentation of a snapshot to an RLE mask in image pixel space.
+
+        Only the bounding box of the segmentation is rasterized. Returns None if
+        there is no segmentation in the image.
+        """
+        geometries = [QgsGeometry(geometry) for geometry in state["segm_geometries"]]
+        if not geometries:
+            return None
+
+        frame = state["frame"]
+        if state["from_segm"] is not None:
+            for geometry in geometries:
+                geometry.transform(state["from_segm"])
+
+        bbox = geometries[0].boundingBox()
+        for geometry in geometries[1:]:
+            bbox.combineExtentWith(geometry.boundingBox())
+
+        # Pixel window of the bounding box, clipped to the image
+        x, pixel_width, _, y, _, pixel_height = frame["geotransform"]
+        x0 = max(math.floor((bbox.xMinimum() - x) / pixel_width), 0)
+        x1 = min(math.ceil((bbox.xMaximum() - x) / pixel_width), width)
+        y0 = max(math.floor((bbox.yMaximum() - y) / pixel_height), 0)
+        y1 = min(math.ceil((bbox.yMinimum() - y) / pixel_height), height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        geotransform = [
+            x + x0 * pixel_width, pixel_width, 0,
+            y + y0 * pixel_height, 0, pixel_height,
+        ]
+        mask = rasterize_geometries(geometries, geotransform, x1 - x0, y1 - y0)
 
-        return geojson_features
+        return {
+            "format": "rle",
+            "offset": [x0, y0],
+            "width": x1 - x0,
+            "height": y1 - y0,
+            "counts": encode_rle(mask),
+        }
 
-    def _get_click_list(self) -> List[List[Union[float, int]]]:
-        """Convert click_layer to a list of click coordinates."""
-        clicks: List[List[Union[float, int]]] = []
+    def _get_click_list(self, frame: ImageFrame) -> List[List[Union[float, int]]]:
+        """Convert click_layer to a list of click coordinates in the pixel space of an image."""
+        points: List[QgsPointXY] = []
+        click_types: List[int] = []
         for feature in self.click_layer.getFeatures():
             geometry = feature.geometry()
             if geometry.isEmpty():
                 continue
+            points.append(geometry.asPoint())
+            click_types.append(feature["click_type"])
+        if not points:
+            return []
+
+        # Transform all clicks to the image CRS at once
+        transform = self._crs_transform(self.click_layer.crs(), frame["crs"])
+        if transform is not None:
+            multipoint = QgsGeometry.fromMultiPointXY(points)
+            multipoint.transform(transform)
+            points = multipoint.asMultiPoint()
+
+        # Convert geo coordinates to pixel coordinates
+        pixels = map_to_pixel(frame["geotransform"], [(point.x(), point.y()) for point in points])
+        return [
+            [pixel_x, pixel_y, click_type]
+            for (pixel_x, pixel_y), click_type in zip(pixels.tolist(), click_types)
+        ]
 
-            point = geometry.asPoint()
-            click_type = feature["click_type"]
-
-            # Convert geo coordinates to pixel coordinates
-            pixel_x, pixel_y = self._geo2pixel_coords(point, self.click_layer.crs())
-            clicks.append([pixel_x, pixel_y, click_type])
-
-        return clicks
-
-    def _geo2pixel_coords(
-        self, point: QgsPointXY, point_crs: QgsCoordinateReferenceSystem
-    ) -> Tuple[float, float]:
-        """Convert geo coordinates to pixel coordinates."""
-        # if point crs is not the same as the canvas crs, transform it to canvas crs
-        canvas_crs = self.canvas.mapSettings().destinationCrs()
-        if point_crs != canvas_crs:
-            transform = QgsCoordinateTransform(
-                point_crs, canvas_crs, QgsProject.instance()
-            )
-            point = transform.transform(point)
-
-        extent = self.canvas.extent()
-
-        # Convert to pixel coordinates
-        pixel_x = (point.x() - extent.xMinimum()) / extent.width() * self.canvas.width()
-        pixel_y = (
-            (extent.yMaximum() - point.y()) / extent.height() * self.canvas.height()
-        )
-
-        return pixel_x, pixel_y
-
-    def _pixel2geo_coords(
-        self, pixel_x: float, pixel_y: float, target_crs: QgsCoordinateReferenceSystem
-    ) -> Tuple[float, float]:
-        """Convert pixel coordinates to geo coordinates."""
-        extent = self.canvas.extent()
-
-        # Convert to geo coordinates
-        geo_x = extent.xMinimum() + pixel_x / self.canvas.width() * extent.width()
-        geo_y = extent.yMaximum() - pixel_y / self.canvas.height() * extent.height()
-
-        canvas_crs = self.canvas.mapSettings().destinationCrs()
-        # Transform to target CRS if necessary
-        if target_crs != canvas_crs:
-            point = QgsPointXY(geo_x, geo_y)
-            transform = QgsCoordinateTransform(
-                canvas_crs,
-                target_crs,
-                QgsProject.instance(),
-            )
-            point = transform.transform(point)
-            geo_x, geo_y = point.x(), point.y()
-
-        return geo_x, geo_y
-
-    def _save_state_for_undo(self) -> None:
-        """Save the current state of the click and segmentation layers for undo."""
-        state: FeatureState = {
-            "click_layer": [feature for feature in self.click_layer.getFeatures()],
-            "segm_layer": [feature for feature in self.segm_layer.getFeatures()],
-        }
-        self.undo_stack.append(state)
-
-    def _restore_state(self, state: FeatureState) -> None:
-        """Restore the state of the click and segmentation layers."""
-        self.click_layer.dataProvider().truncate()
-        self.segm_layer.dataProvider().truncate()
-
-        for feature in state["click_layer"]:
-            self.click_layer.dataProvider().addFeature(feature)
-
-        for feature in state["segm_layer"]:
-            self.segm_layer.dataProvider().addFeature(feature)
-
-        self.click_layer.updateExtents()
-        self.click_layer.triggerRepaint()
-        self.segm_layer.updateExtents()
-        self.segm_layer.triggerRepaint()
+    def _push_command(self, click: Optional[QgsFeature]) -> None:
+        """Record a new action, discarding the undone ones."""
+        for command in self.history[self.history_position:]:
+            self._history_size -= command["size"]
+        del self.history[self.history_position:]
+
+        command: SegmentCommand = {"click": click, "segmentation": None, "size": 0}
+        self.history.append(command)
+        self.history_position += 1
+        self._trim_history()
+
+    def _record_segmentation(self, geometries: List[QgsGeometry]) -> None:
+        """Store the applied segmentation with the latest command."""
+        if self.history_position == 0:
+            return
+        command = self.history[self.history_position - 1]
+        size = sum(len(geometry.asWkb()) for geometry in geometries)
+        self._history_size += size - command["size"]
+        command["segmentation"] = geometries
+        command["size"] = size
+        self._trim_history()
+
+    def _trim_history(self) -> None:
+        """Fold the oldest commands into the base state while over the depth or memory cap."""
+        while self.history_position > 1 and (
+            len(self.history) > self.history_depth or self._history_size > self.history_memory
+        ):
+            command = self.history.pop(0)
+            self.history_position -= 1
+            self._history_size -= command["size"]
+            if command["segmentation"] is not None:
+                self.history_base = command["segmentation"]
+
+    def _segmentation_at(self, position: int) -> List[QgsGeometry]:
+        """
+        Segmentation after the first `position` commands.
+
+        A command whose result was superseded by a later click has none, the
+        segmentation of the command before it is shown instead.
+        """
+        for command in reversed(self.history[:position]):
+            if command["segmentation"] is not None:
+                return command["segmentation"]
+        return self.history_base
+
+    def _restore_segmentation(self) -> None:
+        """Show the segmentation of the current history position."""
+        self._invalidate()  # A result in flight belongs to the clicks being replaced
+        self.mask_id = None  # The server-side mask no longer matches the segmentation
+        self._set_segm_geometries(self._segmentation_at(self.history_position))
 
     def undo(self) -> None:
         """Undo the last action."""
-        if not self.undo_stack:
+        if self.history_position == 0:
             return  # Nothing to undo
 
-        current_state: FeatureState = {
-            "click_layer": [feature for feature in self.click_layer.getFeatures()],
-            "segm_layer": [feature for feature in self.segm_layer.getFeatures()],
-        }
-        self.redo_stack.append(current_state)  # Save current state for redo
-
-        previous_state = self.undo_stack.pop()
-        self._restore_state(previous_state)
+        self.history_position -= 1
+        command = self.history[self.history_position]
+        if command["click"] is not None:
+            self.click_layer.dataProvider().deleteFeatures([command["click"].id()])
+            self._clicks_changed()
+        self._restore_segmentation()
 
     def redo(self) -> None:
         """Redo the last undone action."""
-        if not self.redo_stack:
+        if self.history_position == len(self.history):
             return  # Nothing to redo
 
-        current_state: FeatureState = {
-            "click_layer": [feature for feature in self.click_layer.getFeatures()],
-            "segm_layer": [feature for feature in self.segm_layer.getFeatures()],
-        }
-        self.undo_stack.append(current_state)  # Save current state for undo
-
-        next_state = self.redo_stack.pop()
-        self._restore_state(next_state)
+        command = self.history[self.history_position]
+        self.history_position += 1
+        if command["click"] is not None:
+            # The click gets a new feature id when it is added again
+            command["click"] = self.add_click(QgsFeature(command["click"]))
+        self._restore_segmentation()
 
     def teardown(self) -> None:
         """Remove layers from the QGIS project."""
+        self._invalidate()
+        for band in [self._segm_band, *self._click_bands.values()]:
+            if band is not None:
+                self.canvas.scene().removeItem(band)
+        QgsProject.instance().transformContextChanged.disconnect(self._clear_crs_transforms)
         QgsProject.instance().removeMapLayer(self.click_layer.id())
         QgsProject.instance().removeMapLayer(self.segm_layer.id())
         iface.mapCanvas().refresh()
@@ -0,0 +1,90 @@
+from typing import Any, Dict, Hashable, Optional, Sequence, Tuple
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from qgis.core import QgsCoordinateReferenceSystem, QgsMapLayer
+from helper_func import crs_definition
+
+
+def image_hash(image: np.ndarray) -> str:
+    """Content hash of an image as sent to the server (channel-first bytes)"""
+    channel_first = np.ascontiguousarray(np.transpose(image, (2, 0, 1)))
+    return hashlib.blake2b(channel_first.data, digest_size=16).hexdigest()
+
+
+class RenderCache:
+    """
+    LRU cache of rendered canvas images, read raster windows and their crops.
+
+    Entries are keyed by the raster layer and its revision, how the image was
+    produced, its geotransform, size and CRS, and hold the RGB array and, once
+    it was sent, the encoded payload and its content hash. The revision of a
+    layer is bumped whenever its renderer or data changes, so stale renderings
+    are never hit.
+
+    `key` must be called on the main thread, `get` and `put` are thread-safe.
+    """
+
+    def __init__(self, max_entries: int = 4):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._revisions: Dict[str, int] = {}
+
+    def _revision(self, layer: QgsMapLayer) -> int:
+        layer_id = layer.id()
+        if layer_id not in self._revisions:
+            self._revisions[layer_id] = 0
+
+            def bump(*args: Any) -> None:
+                self._revisions[layer_id] += 1
+
+            layer.rendererChanged.connect(bump)
+            layer.dataChanged.connect(bump)
+            layer.repaintRequested.connect(bump)
+        return self._revisions[layer_id]
+
+    def key(
+        self,
+        layer: QgsMapLayer,
+        source: str,
+        geotransform: Sequence[float],
+        width: int,
+        height: int,
+        crs: QgsCoordinateReferenceSystem,
+    ) -> Tuple[Any, ...]:
+        return (
+            layer.id(),
+            self._revision(layer),
+            source,
+            tuple(geotransform),
+            (width, height),
+            crs_definition(crs),
+        )
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(
+        self,
+        key: Hashable,
+        image: np.ndarray,
+        encoded: Optional[str] = None,
+        content_hash: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        # "uploaded" holds the API URLs of the servers known to have the image
+        entry = {"image": image, "encoded": encoded, "hash": content_hash, "uploaded": set()}
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,246 @@
+from typing import Any, Dict, List, Optional, Iterator
+import os
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
+import requests
+from qgis.core import Qgis, QgsMessageLog
+
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+
+
+class Span:
+    """A timed operation of a trace, encoded in the OTLP/JSON format when exported."""
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_span_id: Optional[str] = None,
+        kind: int = SPAN_KIND_INTERNAL,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_time or self.start_time) - self.start_time) / 1e6
+
+    def traceparent(self) -> str:
+        """W3C trace context header making this span the parent of the server span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span: Dict[str, Any] = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id or "",
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time or self.start_time),
+            "attributes": encode_attributes(self.attributes),
+        }
+        if self.error is not None:
+            span["status"] = {"code": 2, "message": self.error}
+        return span
+
+
+def encode_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Encode a dict as OTLP key/value attributes."""
+    encoded = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            encoded_value = {"boolValue": value}
+        elif isinstance(value, int):
+            encoded_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            encoded_value = {"doubleValue": value}
+        else:
+            encoded_value = {"stringValue": str(value)}
+        encoded.append({"key": key, "value": encoded_value})
+    return encoded
+
+
+class FileExporter:
+    """Append OTLP/JSON export requests to a JSON lines file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, request: Dict[str, Any]) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+
+class OTLPHttpExporter:
+    """Post OTLP/JSON export requests to the `/v1/traces` endpoint of a collector."""
+
+    def __init__(self, endpoint: str, timeout: float = 5.0):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.timeout = timeout
+
+    def export(self, request: Dict[str, Any]) -> None:
+        response = requests.post(self.url, json=request, timeout=self.timeout)
+        response.raise_for_status()
+
+
+class Tracer:
+    """
+    Records the client stages of a segmentation as spans of one trace.
+
+    Spans opened with `span` nest into the currently open span of the same
+    thread, so segmentations running on background tasks get separate traces.
+    When the root span of a trace ends, its spans are exported by a background
+    thread so the exporter never delays the canvas. Without an exporter spans
+    are still timed but neither exported nor propagated. `close` stops the
+    export thread.
+    """
+
+    def __init__(self, exporter: Optional[Any] = None, service_name: str = "segmap-qgis"):
+        self.exporter = exporter
+        self.service_name = service_name
+        self._local = threading.local()
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=64)
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        self._closed = False
+        self._failing = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    @property
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.finished = []
+        return self._local.stack
+
+    @property
+    def last_trace(self) -> List[Span]:
+        """Spans of the last trace finished on the current thread."""
+        return getattr(self._local, "last_trace", [])
+
+    @contextmanager
+    def span(self, name: str, kind: int = SPAN_KIND_INTERNAL, **attributes: Any) -> Iterator[Span]:
+        parent = self._stack[-1] if self._stack else None
+        span = Span(
+            name,
+            parent.trace_id if parent else os.urandom(16).hex(),
+            parent.span_id if parent else None,
+            kind,
+            attributes,
+        )
+        self._stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e)
+            raise
+        finally:
+            span.end_time = time.time_ns()
+            stack = self._stack
+            stack.pop()
+            self._local.finished.append(span)
+            if not stack:
+                spans, self._local.finished = self._local.finished, []
+                self._local.last_trace = spans
+                self._export(spans)
+
+    def inject(self, headers: Dict[str, str]) -> Dict[str, str]:
+        """Add the `traceparent` header of the current span to request headers."""
+        if self.enabled and self._stack:
+            headers["traceparent"] = self._stack[-1].traceparent()
+        return headers
+
+    def _export(self, spans: List[Span]) -> None:
+        if not self.enabled:
+            return
+        request = {
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": encode_attributes({"service.name": self.service_name}),
+                },
+                "scopeSpans": [{
+                    "scope": {"name": "segmap"},
+                    "spans": [span.to_otlp() for span in spans],
+                }],
+            }],
+        }
+        with self._worker_lock:
+            if self._closed:
+                return
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="segmap-trace-exporter", daemon=True
+                )
+                self._worker.start()
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            pass  # Drop the trace rather than blocking the UI
+
+    def close(self) -> None:
+        """Stop the export thread, dropping traces that were not exported yet."""
+        with self._worker_lock:
+            self._closed = True
+            if self._worker is None:
+                return
+            while True:
+                try:
+                    self._queue.put_nowait(None)
+                    break
+                except queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+            self._worker = None
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            try:
+                self.exporter.export(request)
+                self._failing = False
+            except Exception as e:
+                # Report an unreachable exporter once rather than for every trace
+                if not self._failing:
+                    self._failing = True
+                    QgsMessageLog.logMessage(f"Failed to export trace: {e}", "SegMap", Qgis.Warning)
+
+
+def create_tracer(mode: str, target: str) -> Tracer:
+    """
+    Create a tracer from the plugin settings.
+
+    `mode` is "off", "file" (append to the JSON lines file `target`) or "otlp"
+    (post to the OTLP/HTTP collector at `target`).
+    """
+    if mode == "file" and target:
+        return Tracer(FileExporter(target))
+    if mode == "otlp" and target:
+        return Tracer(OTLPHttpExporter(target))
+    return Tracer()
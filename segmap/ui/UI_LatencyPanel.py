@@ -0,0 +1,121 @@
+import os
+import csv
+import time
+from collections import deque
+from PyQt5.QtWidgets import (
+    QWidget,
+    QGridLayout,
+    QLabel,
+)
+
+
+class UI_LatencyPanel(QWidget):
+    """
+    A small panel showing where the time of the last click went.
+
+    Lists the client stages (render, encode, upload, layer update) next to the
+    server time, whose stage breakdown is shown in the tooltip, plus rolling
+    p50/p95 of the total latency and the payload size. Each sample can also be
+    appended to a CSV log.
+    """
+    STAGES = [
+        ("render", "Render"),
+        ("encode", "Encode"),
+        ("upload", "Upload"),
+        ("server", "Server"),
+        ("update", "Layer update"),
+        ("total", "Total"),
+    ]
+    CSV_FIELDS = [
+        "time", "model_id", "width", "height", "payload_bytes",
+        "render_ms", "encode_ms", "upload_ms", "server_ms", "update_ms", "total_ms",
+        "server_stages",
+    ]
+
+    def __init__(self, parent=None, history: int = 100):
+        super().__init__(parent)
+
+        self.totals: deque = deque(maxlen=history)
+        self.log_path = ""
+
+        layout = QGridLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.value_labels = {}
+        for row, (key, title) in enumerate(self.STAGES):
+            layout.addWidget(QLabel(title, self), row, 0)
+            label = QLabel("-", self)
+            label.setToolTip("")
+            self.value_labels[key] = label
+            layout.addWidget(label, row, 1)
+
+        row = len(self.STAGES)
+        layout.addWidget(QLabel("p50 / p95", self), row, 0)
+        self.percentile_label = QLabel("-", self)
+        layout.addWidget(self.percentile_label, row, 1)
+        layout.addWidget(QLabel("Payload", self), row + 1, 0)
+        self.payload_label = QLabel("-", self)
+        layout.addWidget(self.payload_label, row + 1, 1)
+
+        self.setLayout(layout)
+
+    def set_log_path(self, path: str) -> None:
+        """Append every sample to the CSV file at `path`, or disable logging if empty."""
+        self.log_path = path
+
+    def clear(self) -> None:
+        self.totals.clear()
+        for label in self.value_labels.values():
+            label.setText("-")
+            label.setToolTip("")
+        self.percentile_label.setText("-")
+        self.payload_label.setText("-")
+
+    def add_sample(self, timings: dict) -> None:
+        """Show the latency breakdown of a click, as returned by `ISController`."""
+        for key, label in self.value_labels.items():
+            label.setText(f"{timings.get(key, 0.0):.0f} ms")
+
+        server_stages = timings.get("server_stages") or {}
+        self.value_labels["server"].setToolTip("\n".join(
+            f"{name}: {duration:.1f} ms" for name, duration in server_stages.items()
+        ))
+
+        self.totals.append(timings.get("total", 0.0))
+        self.percentile_label.setText(
+            f"{self._percentile(50):.0f} / {self._percentile(95):.0f} ms (n={len(self.totals)})"
+        )
+
+        payload = f"{timings.get('payload_bytes', 0) / 1024:.0f} KB"
+        if timings.get("width") and timings.get("height"):
+            payload += f" ({timings['width']}x{timings['height']})"
+        self.payload_label.setText(payload)
+
+        if self.log_path:
+            self._log(timings)
+
+    def _percentile(self, q: float) -> float:
+        values = sorted(self.totals)
+        index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+        return values[index]
+
+    def _log(self, timings: dict) -> None:
+        try:
+            new_file = not os.path.exists(self.log_path)
+            with open(self.log_path, "a", newline="") as f:
+                writer = csv.writer(f)
+                if new_file:
+                    writer.writerow(self.CSV_FIELDS)
+                writer.writerow([
+                    time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    timings.get("model_id"),
+                    timings.get("width"),
+                    timings.get("height"),
+                    timings.get("payload_bytes"),
+                    *(f"{timings.get(key, 0.0):.1f}" for key, _ in self.STAGES),
+                    ";".join(
+                        f"{name}={duration:.1f}"
+                        for name, duration in (timings.get("server_stages") or {}).items()
+                    ),
+                ])
+        except OSError as e:
+            self.setToolTip(f"Failed to write the latency log: {e}")
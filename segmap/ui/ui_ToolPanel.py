@@ -136,6 +136,17 @@ class Ui_ToolPanel(object):
         self.endBtn.setObjectName("endBtn")
         self.actionBtnGroup.addButton(self.endBtn)
         self.verticalLayout.addWidget(self.endBtn)
+        self.line_5 = QtWidgets.QFrame(self.content)
+        self.line_5.setFrameShape(QtWidgets.QFrame.HLine)
+        self.line_5.setFrameShadow(QtWidgets.QFrame.Sunken)
+        self.line_5.setObjectName("line_5")
+        self.verticalLayout.addWidget(self.line_5)
+        self.label_9 = QtWidgets.QLabel(self.content)
+        self.label_9.setObjectName("label_9")
+        self.verticalLayout.addWidget(self.label_9)
+        self.latencyPanel = UI_LatencyPanel(self.content)
+        self.latencyPanel.setObjectName("latencyPanel")
+        self.verticalLayout.addWidget(self.latencyPanel)
         spacerItem = QtWidgets.QSpacerItem(20, 51, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
         self.verticalLayout.addItem(spacerItem)
         self.horizontalLayout_2 = QtWidgets.QHBoxLayout()
@@ -170,7 +181,9 @@ class Ui_ToolPanel(object):
         self.redoBtn.setText(_translate("ToolPanel", "Redo→"))
         self.undoBtn.setText(_translate("ToolPanel", "←Undo"))
         self.endBtn.setText(_translate("ToolPanel", "End (ESC)"))
+        self.label_9.setText(_translate("ToolPanel", "Latency"))
         self.helpBtn.setText(_translate("ToolPanel", "Help"))
 from .UI_EditableComboBox import UI_EditableComboBox
+from .UI_LatencyPanel import UI_LatencyPanel
 from .UI_OutputLayerSelectComboBox import UI_OutputLayerSelectComboBox
 from .UI_RasterSelectComboBox import UI_RasterSelectComboBox
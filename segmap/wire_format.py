@@ -0,0 +1,27 @@
+# Encodings of the segment API, free of QGIS imports so the server benchmarks can use them
+from typing import Dict
+import base64
+import numpy as np
+
+
+def encode_image(image: np.ndarray) -> str:
+    """Encode a 3-channel NumPy image to a base64-encoded string"""
+    channel_first = np.transpose(image, (2, 0, 1))  # Change to channel first
+    flattened_data = channel_first.flatten()
+    base64_encoded = base64.b64encode(flattened_data).decode('utf-8')
+    return base64_encoded
+
+
+def parse_server_timing(value: str) -> Dict[str, float]:
+    """Parse a `Server-Timing` header into stage durations in milliseconds"""
+    timings: Dict[str, float] = {}
+    for item in value.split(","):
+        name, _, params = item.strip().partition(";")
+        for param in params.split(";"):
+            key, _, duration = param.strip().partition("=")
+            if name and key == "dur":
+                try:
+                    timings[name] = float(duration)
+                except ValueError:
+                    pass
+    return timings
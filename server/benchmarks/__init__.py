@@ -0,0 +1,13 @@
+import importlib
+import os
+import sys
+
+
+PLUGIN_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "segmap")
+
+
+def load_plugin_module(name):
+    """Import a module of the QGIS plugin, so benchmarks use the plugin's own implementation."""
+    if PLUGIN_DIR not in sys.path:
+        sys.path.insert(0, PLUGIN_DIR)
+    return importlib.import_module(name)
@@ -0,0 +1,285 @@
+"""
+Accuracy-vs-speed evaluation with automatic click simulation.
+
+Runs the standard NoC protocol: for every object of a dataset, a simulated user
+places up to ``--max-clicks`` clicks, each one on the largest error of the
+previous prediction (`clicker.Clicker.make_next_click`), and the IoU with the
+ground truth is recorded after every click. Requests go through
+`server.segment` with the previous mask, like in the server.
+
+Each ``--config`` is a set of speed settings, e.g. ``zoom=320,flip=0,precision=bf16``:
+
+- ``zoom``: ZoomIn target size, ``none`` to disable it (default 448)
+- ``flip``: horizontal flip test-time augmentation, 0 or 1 (default 1)
+- ``precision``: ``fp32``, ``fp16`` (CUDA) or ``bf16`` autocast (default fp32)
+- ``quant``: ``none`` or ``dynamic`` int8 quantization of the linear layers (CPU, default none)
+- ``backend``: ``eager`` or ``compile`` (torch.compile, default eager)
+
+The first config is the reference: NoC@85/90, the IoU-per-click curve and the
+latency of every other config are reported next to their difference to it, so
+every speed setting comes with its accuracy cost.
+
+The dataset folder contains ``images/<name>.<ext>`` and ``masks/<name>.png``
+pairs; each distinct non-zero value of a mask is one object. Run from the server
+directory::
+
+    python -m benchmarks.evaluate /data/GrabCut --model SimpleClick-ViT-B \\
+        --config zoom=448 --config zoom=448,flip=0 --config zoom=320,flip=0 --workers 4
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import multiprocessing
+import cv2
+import numpy as np
+import torch
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+DEFAULT_KNOBS = {
+    "zoom": "448",
+    "flip": "1",
+    "precision": "fp32",
+    "quant": "none",
+    "backend": "eager",
+}
+
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def parse_config(value):
+    """Parse ``key=value,...`` speed settings, completed with the defaults."""
+    knobs = dict(DEFAULT_KNOBS)
+    for item in filter(None, value.split(",")):
+        key, _, knob = item.partition("=")
+        if key not in knobs:
+            raise argparse.ArgumentTypeError(f"Unknown setting {key}")
+        knobs[key] = knob
+    if knobs["precision"] not in PRECISIONS:
+        raise argparse.ArgumentTypeError(f"Unknown precision {knobs['precision']}")
+    if knobs["quant"] not in ("none", "dynamic"):
+        raise argparse.ArgumentTypeError(f"Unknown quantization {knobs['quant']}")
+    if knobs["backend"] not in ("eager", "compile"):
+        raise argparse.ArgumentTypeError(f"Unknown backend {knobs['backend']}")
+    return knobs
+
+
+def config_name(knobs):
+    return ",".join(f"{key}={value}" for key, value in knobs.items())
+
+
+def list_objects(dataset, min_area, limit=None):
+    """Return ``(image_path, mask_path, value)`` for every object of the dataset."""
+    image_dir = os.path.join(dataset, "images")
+    mask_dir = os.path.join(dataset, "masks")
+
+    objects = []
+    for name in sorted(os.listdir(image_dir)):
+        stem, ext = os.path.splitext(name)
+        mask_path = os.path.join(mask_dir, stem + ".png")
+        if ext.lower() not in IMAGE_EXTENSIONS or not os.path.exists(mask_path):
+            continue
+
+        mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
+        if mask.ndim == 3:
+            mask = mask[:, :, 0]
+        values, counts = np.unique(mask, return_counts=True)
+        for value, count in zip(values, counts):
+            if value != 0 and count >= min_area:
+                objects.append((os.path.join(image_dir, name), mask_path, int(value)))
+
+    return objects[:limit]
+
+
+# State of a worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(model_name, random_weights, knobs, device, threads):
+    """Load the model with the speed settings of ``knobs`` into the worker's predictor pool."""
+    if threads:
+        torch.set_num_threads(threads)
+
+    # The server reads its device when it is imported
+    os.environ["DEVICE"] = device
+    import server
+
+    if random_weights:
+        from benchmarks.models import build_model
+        model, mode = build_model(model_name, device)
+    else:
+        model_info = server.MODELS.get(model_name)
+        if model_info is None:
+            raise ValueError(f"No model with name {model_name} in {server.WEIGHTS_DIR}")
+        model, mode = server.load_model(model_name, model_info)
+
+    if knobs["quant"] == "dynamic":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    zoom_in_size = None if knobs["zoom"] == "none" else int(knobs["zoom"])
+    predictor = server.create_predictor(
+        model, mode,
+        zoom_in_size=zoom_in_size,
+        with_flip=knobs["flip"] == "1",
+        compile=knobs["backend"] == "compile",
+    )
+    server.add_predictor(model_name, predictor)
+
+    dtype = PRECISIONS[knobs["precision"]]
+    device_type = "cuda" if device.startswith("cuda") else "cpu"
+    _worker.update(
+        server=server,
+        model_name=model_name,
+        autocast=(lambda: torch.autocast(device_type, dtype=dtype)) if dtype else nullcontext,
+    )
+
+
+def evaluate_object(task, max_clicks):
+    """Run a click session on one object and return its IoU and latency per click."""
+    from isegm.inference import clicker
+
+    image_path, mask_path, value = task
+    image = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+    mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    gt_mask = (mask == value).astype(np.uint8)
+
+    server = _worker["server"]
+    clicks = clicker.Clicker(gt_mask=gt_mask)
+    pred_mask = np.zeros_like(gt_mask, dtype=bool)
+    prev_mask = None
+    ious, latencies = [], []
+
+    for _ in range(max_clicks):
+        clicks.make_next_click(pred_mask)
+        click_points = [[c.coords[1], c.coords[0], c.is_positive] for c in clicks.get_clicks()]
+
+        start = time.perf_counter()
+        with _worker["autocast"]():
+            prev_mask = server.segment(_worker["model_name"], image, click_points, prev_mask)
+        latencies.append(time.perf_counter() - start)
+
+        pred_mask = prev_mask > 0
+        union = np.logical_or(pred_mask, gt_mask).sum()
+        ious.append(float(np.logical_and(pred_mask, gt_mask).sum() / union) if union else 1.0)
+
+    return ious, latencies
+
+
+def _evaluate_chunk(tasks, max_clicks):
+    return [evaluate_object(task, max_clicks) for task in tasks]
+
+
+def compute_noc(ious, threshold, max_clicks):
+    """Number of clicks to reach ``threshold`` (``max_clicks`` if it is never reached)."""
+    for i, iou in enumerate(ious):
+        if iou >= threshold:
+            return i + 1
+    return max_clicks
+
+
+def summarize(sessions, max_clicks):
+    ious = np.array([s[0] for s in sessions])
+    latencies = np.array([s[1] for s in sessions]) * 1000
+    noc85 = [compute_noc(s[0], 0.85, max_clicks) for s in sessions]
+    noc90 = [compute_noc(s[0], 0.90, max_clicks) for s in sessions]
+    return {
+        "objects": len(sessions),
+        "noc85": float(np.mean(noc85)),
+        "noc90": float(np.mean(noc90)),
+        "nof85": int(sum(ious.max(axis=1) < 0.85)),
+        "nof90": int(sum(ious.max(axis=1) < 0.90)),
+        "miou_per_click": ious.mean(axis=0).tolist(),
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "per_click": latencies.mean(axis=0).tolist(),
+        },
+    }
+
+
+def run_config(args, knobs, objects):
+    init_args = (args.model, args.random_weights, knobs, args.device, args.threads)
+
+    if args.workers <= 0:
+        init_worker(*init_args)
+        return [evaluate_object(task, args.max_clicks) for task in objects]
+
+    # One chunk per worker and round, so each process keeps its predictor warm
+    chunk_size = max(1, len(objects) // (args.workers * 4))
+    chunks = [objects[i:i + chunk_size] for i in range(0, len(objects), chunk_size)]
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(args.workers, mp_context=context,
+                             initializer=init_worker, initargs=init_args) as pool:
+        results = pool.map(_evaluate_chunk, chunks, [args.max_clicks] * len(chunks))
+        return [session for chunk in results for session in chunk]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", help="Folder with images/ and masks/")
+    parser.add_argument("--model", required=True, help="Model id from models.yaml, or a benchmark model")
+    parser.add_argument("--random-weights", action="store_true",
+                        help="Use a random-weight benchmark model (for smoke tests, accuracy is meaningless)")
+    parser.add_argument("--config", dest="configs", action="append", type=parse_config,
+                        help="Speed settings, the first one is the reference (repeatable)")
+    parser.add_argument("--max-clicks", type=int, default=20)
+    parser.add_argument("--min-area", type=int, default=100, help="Skip smaller objects (pixels)")
+    parser.add_argument("--limit", type=int, help="Evaluate only the first N objects")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() // 2 or 1,
+                        help="Worker processes, 0 runs in the main process")
+    parser.add_argument("--threads", type=int, help="Torch CPU threads per worker")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    configs = args.configs or [parse_config("")]
+    if args.threads is None and args.workers > 0 and not args.device.startswith("cuda"):
+        args.threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    objects = list_objects(args.dataset, args.min_area, args.limit)
+    if not objects:
+        parser.error(f"No image/mask pairs found in {args.dataset}")
+    print(f"{len(objects)} objects, {len(configs)} configs, {args.workers} workers")
+
+    results = []
+    for knobs in configs:
+        start = time.perf_counter()
+        summary = summarize(run_config(args, knobs, objects), args.max_clicks)
+        summary["config"] = knobs
+        summary["elapsed_s"] = time.perf_counter() - start
+        results.append(summary)
+
+    reference = results[0]
+    print(f"{'config':<64}{'NoC@85':>8}{'NoC@90':>8}{'mIoU@5':>8}{'ms/click':>10}{'speedup':>9}")
+    for summary in results:
+        summary["cost"] = {
+            "noc85": summary["noc85"] - reference["noc85"],
+            "noc90": summary["noc90"] - reference["noc90"],
+            "miou_per_click": (np.array(summary["miou_per_click"])
+                               - np.array(reference["miou_per_click"])).tolist(),
+            "speedup": reference["latency_ms"]["mean"] / summary["latency_ms"]["mean"],
+        }
+        miou5 = summary["miou_per_click"][min(4, args.max_clicks - 1)]
+        print(f"{config_name(summary['config']):<64}"
+              f"{summary['noc85']:>8.2f}{summary['noc90']:>8.2f}{miou5:>8.3f}"
+              f"{summary['latency_ms']['mean']:>10.1f}{summary['cost']['speedup']:>8.2f}x")
+        if summary is not reference:
+            print(f"{'  cost vs reference':<64}{summary['cost']['noc85']:>+8.2f}"
+                  f"{summary['cost']['noc90']:>+8.2f}"
+                  f"{summary['cost']['miou_per_click'][min(4, args.max_clicks - 1)]:>+8.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"model": args.model, "dataset": args.dataset, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
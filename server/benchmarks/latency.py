@@ -0,0 +1,258 @@
+"""
+Latency benchmark of the inference stack.
+
+Models with random weights (see `benchmarks.models`) are registered in the
+predictor pool of the server and driven through `server.segment` with
+synthetic images and click sequences. A simulated user places each click on the
+largest error of the previous prediction, like in the evaluation protocol of
+interactive segmentation, and sends the previous mask along.
+
+Reports p50/p95/p99 latency and peak memory per stage and writes the results
+to JSON. Run from the server directory::
+
+    python -m benchmarks.latency --models RITM-HRNet18 SAM-ViT-B --sizes 512x512 1024x1024
+    python -m benchmarks.latency --device cpu --threads 4 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+import cv2
+import numpy as np
+import torch
+from isegm.inference import clicker
+from metrics import StageTimer
+from benchmarks.models import MODEL_NAMES, DEFAULT_MODELS, build_model
+
+
+def read_peak_rss():
+    """Peak resident set size of the process in bytes since the last reset."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size (Linux only, a no-op elsewhere)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class MemoryStageTimer(StageTimer):
+    """StageTimer that also records the peak memory of each stage."""
+
+    def __init__(self, synchronize=None, cuda=False):
+        super().__init__(synchronize)
+        self.cuda = cuda
+        self.peak_rss = {}
+        self.peak_cuda = {}
+
+    @contextmanager
+    def stage(self, name):
+        reset_peak_rss()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        with super().stage(name):
+            yield
+        self.peak_rss[name] = max(self.peak_rss.get(name, 0), read_peak_rss())
+        if self.cuda:
+            self.peak_cuda[name] = max(
+                self.peak_cuda.get(name, 0), torch.cuda.max_memory_allocated()
+            )
+
+
+def synthetic_sample(width, height, rng, num_distractors=5):
+    """
+    Create a noisy image with random ellipses and the mask of the topmost one.
+
+    Returns:
+        tuple: The RGB image (height, width, 3) and the ground truth mask (0, 1).
+    """
+    image = rng.integers(0, 64, (height, width, 3), dtype=np.uint8)
+    gt_mask = np.zeros((height, width), dtype=np.uint8)
+    size = min(width, height)
+
+    for i in range(num_distractors + 1):
+        center = (int(rng.integers(size // 8, width - size // 8)),
+                  int(rng.integers(size // 8, height - size // 8)))
+        axes = (int(rng.integers(size // 16, size // 4)), int(rng.integers(size // 16, size // 4)))
+        angle = float(rng.uniform(0, 180))
+        color = tuple(int(c) for c in rng.integers(64, 256, 3))
+        cv2.ellipse(image, center, axes, angle, 0, 360, color, -1)
+
+        if i == num_distractors:
+            cv2.ellipse(gt_mask, center, axes, angle, 0, 360, 1, -1)
+
+    return image, gt_mask
+
+
+def run_session(server, clicker, cuda, model_name, image, gt_mask, num_clicks):
+    """Run one click sequence and return the timers of its requests."""
+    clicks = clicker.Clicker(gt_mask=gt_mask)
+    pred_mask = np.zeros_like(gt_mask, dtype=bool)
+    prev_mask = None
+    timers = []
+
+    for _ in range(num_clicks):
+        clicks.make_next_click(pred_mask)
+        # The API expects [x, y, is_positive], the clicker uses (y, x)
+        click_points = [[c.coords[1], c.coords[0], c.is_positive] for c in clicks.get_clicks()]
+
+        timer = MemoryStageTimer(torch.cuda.synchronize if cuda else None, cuda)
+        start = time.perf_counter()
+        mask = server.segment(model_name, image, click_points, prev_mask, timer)
+        timer.add("total", start, time.perf_counter())
+
+        timers.append(timer)
+        pred_mask = mask > 0
+        prev_mask = mask
+
+    return timers
+
+
+def summarize(timers):
+    """Latency percentiles (ms) and peak memory (MB) per stage."""
+    durations = {}
+    for timer in timers:
+        for name, duration in timer.durations.items():
+            durations.setdefault(name, []).append(duration * 1000)
+
+    stages = {}
+    for name, values in durations.items():
+        values = np.asarray(values)
+        stats = {
+            "count": len(values),
+            "mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)),
+        }
+        peak_rss = [t.peak_rss[name] for t in timers if name in t.peak_rss]
+        if peak_rss:
+            stats["peak_rss_mb"] = max(peak_rss) / 2 ** 20
+        peak_cuda = [t.peak_cuda[name] for t in timers if name in t.peak_cuda]
+        if peak_cuda:
+            stats["peak_cuda_mb"] = max(peak_cuda) / 2 ** 20
+        stages[name] = stats
+
+    return stages
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS, choices=MODEL_NAMES + ["all"])
+    parser.add_argument("--sizes", nargs="+", default=["512x512", "1024x768", "1536x1536"],
+                        help="Canvas sizes as WIDTHxHEIGHT")
+    parser.add_argument("--clicks", type=int, default=5, help="Clicks per session")
+    parser.add_argument("--repeat", type=int, default=3, help="Sessions per model and size")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed sessions per model")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--threads", type=int, help="Number of torch CPU threads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    models = MODEL_NAMES if "all" in args.models else args.models
+    sizes = [parse_size(size) for size in args.sizes]
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # The server reads its device when it is imported
+    os.environ["DEVICE"] = args.device
+    import server
+
+    cuda = args.device.startswith("cuda")
+
+    results = []
+    for model_name in models:
+        server.PREDICTOR_POOL.clear()
+        if cuda:
+            torch.cuda.empty_cache()
+
+        start = time.perf_counter()
+        model, mode = build_model(model_name, args.device)
+        server.add_predictor(model_name, server.create_predictor(model, mode))
+        load_time = time.perf_counter() - start
+        num_params = sum(p.numel() for p in model.parameters())
+        print(f"{model_name}: {num_params / 1e6:.1f}M parameters, built in {load_time:.2f} s")
+
+        rng = np.random.default_rng(args.seed)
+        for _ in range(args.warmup):
+            image, gt_mask = synthetic_sample(*sizes[0], rng)
+            run_session(server, clicker, cuda, model_name, image, gt_mask, min(args.clicks, 2))
+
+        for width, height in sizes:
+            rng = np.random.default_rng(args.seed)
+            timers = []
+            for _ in range(args.repeat):
+                image, gt_mask = synthetic_sample(width, height, rng)
+                timers += run_session(server, clicker, cuda, model_name, image, gt_mask, args.clicks)
+
+            stages = summarize(timers)
+            results.append({
+                "model": model_name,
+                "width": width,
+                "height": height,
+                "clicks": args.clicks,
+                "sessions": args.repeat,
+                "num_params": num_params,
+                "load_time_s": load_time,
+                "stages": stages,
+            })
+
+            print(f"  {width}x{height}")
+            print(f"    {'stage':<20}{'p50':>9}{'p95':>9}{'p99':>9}")
+            for name, stats in stages.items():
+                memory = f"{stats['peak_rss_mb']:>9.0f} MB" if "peak_rss_mb" in stats else ""
+                print(f"    {name:<20}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}"
+                      f"{stats['p99_ms']:>9.1f} ms{memory}")
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "device": args.device,
+            "device_name": torch.cuda.get_device_name() if cuda else platform.processor(),
+            "threads": torch.get_num_threads(),
+            "platform": platform.platform(),
+            "python": sys.version.split()[0],
+            "torch": torch.__version__,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Concurrent load test of the segment API.
+
+Simulates QGIS users running click sessions: each user segments objects on
+synthetic canvas-sized images, placing every click on the largest error of the
+previous result and waiting a think time between clicks, like the plugin does
+with the previous mask cached on the server.
+
+By default the FastAPI app runs in-process behind an ASGI transport with small
+random-weight models (see `benchmarks.models`). ``--serve`` runs it in a local
+uvicorn instead, and ``--url`` targets a running server with its own models.
+
+Reports throughput, the latency distribution, the error rate and the queue wait
+reported by the server. ``--verify`` replays the last request of some sessions
+sequentially after the run and checks that the masks match, which catches
+concurrent requests corrupting the shared predictor state. Run from the server
+directory::
+
+    python -m benchmarks.loadtest --users 8 --duration 60 --think-time 1.0
+    python -m benchmarks.loadtest --url http://localhost:8080 --token <token> --models SAM
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import socket
+import threading
+import time
+import httpx
+import numpy as np
+import orjson
+import torch
+from isegm.inference import clicker
+from maskcodec import decode_mask
+from benchmarks.latency import synthetic_sample, parse_size
+from benchmarks.models import MODEL_NAMES, build_model
+from benchmarks import load_plugin_module
+
+# The plugin's own encodings, so the load test sends what QGIS sends
+wire_format = load_plugin_module("wire_format")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.queue_waits = []
+        self.stages = {}
+        self.errors = {}
+        self.requests = 0
+        self.sessions = 0
+
+    def add_response(self, latency, response):
+        self.requests += 1
+        if response.status_code != 200:
+            self.errors[str(response.status_code)] = self.errors.get(str(response.status_code), 0) + 1
+            return
+        self.latencies.append(latency * 1000)
+        timings = wire_format.parse_server_timing(response.headers.get("server-timing", ""))
+        self.queue_waits.append(timings.get("queue_wait", 0.0))
+        for name, duration in timings.items():
+            self.stages.setdefault(name, []).append(duration)
+
+    def add_error(self, error):
+        self.requests += 1
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        num_errors = sum(self.errors.values())
+        return {
+            "elapsed_s": elapsed,
+            "sessions": self.sessions,
+            "requests": self.requests,
+            "throughput_rps": (self.requests - num_errors) / elapsed if elapsed > 0 else 0.0,
+            "error_rate": num_errors / self.requests if self.requests else 0.0,
+            "errors": self.errors,
+            "latency_ms": percentiles(self.latencies),
+            "queue_wait_ms": percentiles(self.queue_waits),
+            "stages_ms": {name: percentiles(values) for name, values in self.stages.items()},
+        }
+
+
+async def post_segment(client, payload, headers, compress):
+    body = orjson.dumps(payload)
+    headers = dict(headers, **{"Content-Type": "application/json"})
+    if compress:
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    return await client.post("/v1/segment", content=body, headers=headers)
+
+
+async def run_user(user_id, client, args, stats, deadline, verify_requests):
+    rng = np.random.default_rng(args.seed + user_id)
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    models = args.models
+
+    session = 0
+    while time.perf_counter() < deadline:
+        model_id = models[(user_id + session) % len(models)]
+        width, height = args.sizes[int(rng.integers(len(args.sizes)))]
+        image, gt_mask = synthetic_sample(width, height, rng)
+        encoded_image = wire_format.encode_image(image)
+        num_clicks = int(rng.integers(args.min_clicks, args.max_clicks + 1))
+
+        clicks = clicker.Clicker(gt_mask=gt_mask)
+        pred_mask = np.zeros_like(gt_mask, dtype=bool)
+        mask_id = None
+        mask = None
+        payload = None
+
+        for _ in range(num_clicks):
+            if time.perf_counter() >= deadline:
+                break
+
+            clicks.make_next_click(pred_mask)
+            payload = {
+                "model_id": model_id,
+                "image": encoded_image,
+                "clicks": [[int(c.coords[1]), int(c.coords[0]), bool(c.is_positive)]
+                           for c in clicks.get_clicks()],
+                "width": width,
+                "height": height,
+                "channel": 3,
+                "previous_mask_id": mask_id,
+                "cache_mask": True,
+                "output": "mask",
+                "mask_format": "rle",
+            }
+
+            start = time.perf_counter()
+            try:
+                response = await post_segment(client, payload, headers, args.compress)
+            except httpx.HTTPError as e:
+                stats.add_error(e)
+                break
+            stats.add_response(time.perf_counter() - start, response)
+            if response.status_code != 200:
+                break
+
+            result = response.json()
+            # Remember the previous mask itself for the verification replay
+            payload["previous_mask"] = mask or []
+            mask_id = result.get("mask_id")
+            mask = result["mask"]
+            pred_mask = decode_mask(mask, width, height) > 0
+
+            if args.think_time > 0:
+                await asyncio.sleep(rng.exponential(args.think_time))
+
+        stats.sessions += 1
+        session += 1
+        if payload is not None and mask is not None and len(verify_requests) < args.verify:
+            payload = dict(payload, previous_mask_id=None, cache_mask=False)
+            verify_requests.append((payload, mask))
+
+
+async def verify(client, args, verify_requests):
+    """Replay requests sequentially and count the masks that differ from the concurrent run."""
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    mismatches = 0
+    for payload, expected in verify_requests:
+        response = await post_segment(client, payload, headers, args.compress)
+        response.raise_for_status()
+        width, height = payload["width"], payload["height"]
+        mask = decode_mask(response.json()["mask"], width, height) > 0
+        expected = decode_mask(expected, width, height) > 0
+        union = np.logical_or(mask, expected).sum()
+        iou = np.logical_and(mask, expected).sum() / union if union else 1.0
+        if iou < args.verify_iou:
+            mismatches += 1
+    return {"replayed": len(verify_requests), "mismatches": mismatches}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_uvicorn(app):
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def run(args, client):
+    stats = Stats()
+    verify_requests = []
+    deadline = time.perf_counter() + args.duration
+
+    async def start_user(user_id):
+        # Spread the start of the users over the ramp up time
+        await asyncio.sleep(args.ramp_up * user_id / max(args.users, 1))
+        await run_user(user_id, client, args, stats, deadline, verify_requests)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(start_user(i) for i in range(args.users)))
+    report = stats.report(time.perf_counter() - start)
+
+    if args.verify:
+        report["verify"] = await verify(client, args, verify_requests)
+    return report
+
+
+def print_report(report):
+    print(f"{report['sessions']} sessions, {report['requests']} requests in {report['elapsed_s']:.1f} s")
+    print(f"throughput {report['throughput_rps']:.2f} req/s, error rate {report['error_rate']:.2%}"
+          + (f" {report['errors']}" if report["errors"] else ""))
+    for name in ("latency_ms", "queue_wait_ms"):
+        stats = report[name]
+        if stats:
+            print(f"{name:<16} p50 {stats['p50']:>8.1f}  p95 {stats['p95']:>8.1f}  "
+                  f"p99 {stats['p99']:>8.1f}  max {stats['max']:>8.1f}")
+    if "verify" in report:
+        verify_report = report["verify"]
+        print(f"verify: {verify_report['mismatches']} of {verify_report['replayed']} replayed masks differ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4, help="Number of concurrent users")
+    parser.add_argument("--duration", type=float, default=30.0, help="Duration of the test in seconds")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds until all users are started")
+    parser.add_argument("--think-time", type=float, default=1.0,
+                        help="Mean think time between clicks in seconds (exponentially distributed)")
+    parser.add_argument("--min-clicks", type=int, default=1)
+    parser.add_argument("--max-clicks", type=int, default=20)
+    parser.add_argument("--sizes", nargs="+", default=["1024x768", "1920x1080"],
+                        help="Canvas sizes as WIDTHxHEIGHT")
+    parser.add_argument("--models", nargs="+", default=["RITM-HRNet18s"],
+                        help="Model ids. In-process they must be benchmark models: " + ", ".join(MODEL_NAMES))
+    parser.add_argument("--url", help="Test a running server instead of the in-process app")
+    parser.add_argument("--serve", action="store_true", help="Run the app in a local uvicorn")
+    parser.add_argument("--token", help="Bearer token of the server")
+    parser.add_argument("--no-compress", dest="compress", action="store_false",
+                        help="Send uncompressed requests")
+    parser.add_argument("--verify", type=int, default=0, metavar="N",
+                        help="Replay the last request of N sessions sequentially and compare the masks")
+    parser.add_argument("--verify-iou", type=float, default=0.99)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args()
+    args.sizes = [parse_size(size) for size in args.sizes]
+
+    uvicorn_server = None
+    if args.url:
+        transport, base_url = None, args.url
+    else:
+        # The server reads its device and token when it is imported
+        os.environ["DEVICE"] = args.device
+        if args.token:
+            os.environ["BEARER_TOKEN"] = args.token
+        import server
+
+        for model_name in args.models:
+            model, mode = build_model(model_name, args.device)
+            server.add_predictor(model_name, server.create_predictor(model, mode))
+        print(f"Loaded {', '.join(args.models)} on {args.device} ({torch.get_num_threads()} threads)")
+
+        if args.serve:
+            uvicorn_server, base_url = start_uvicorn(server.app)
+            transport = None
+        else:
+            transport, base_url = httpx.ASGITransport(app=server.app), "http://segmap"
+
+    async def main_async():
+        limits = httpx.Limits(max_connections=args.users)
+        async with httpx.AsyncClient(transport=transport, base_url=base_url,
+                                     timeout=None, limits=limits) as client:
+            return await run(args, client)
+
+    try:
+        report = asyncio.run(main_async())
+    finally:
+        if uvicorn_server is not None:
+            uvicorn_server.should_exit = True
+
+    report["config"] = {
+        "users": args.users,
+        "duration": args.duration,
+        "think_time": args.think_time,
+        "clicks": [args.min_clicks, args.max_clicks],
+        "sizes": args.sizes,
+        "models": args.models,
+        "target": args.url or ("uvicorn" if args.serve else "asgi"),
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Micro-benchmarks of hot helper functions with regression checks.
+
+Covers mask polygonization and rasterization, ring orientation, the plugin's
+canvas image conversion and encoding, click distance maps, ZoomIn ROI resizing, crops and click
+grouping, on inputs from 512x512 to 4096x4096 and on pathological shapes (many
+small blobs, very long or very jagged contours).
+
+Save a baseline on a machine, then compare later runs on the same machine
+against it. Cases slower than the baseline by more than the tolerance are
+reported and make the command exit with status 1. Run from the server
+directory::
+
+    python -m benchmarks.micro --save baseline.json
+    python -m benchmarks.micro --compare baseline.json --tolerance 0.25
+    python -m benchmarks.micro --filter polygon --max-size 2048
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+import torch
+from polygonize import mask_to_polygon, polygon_to_mask, is_counter_clockwise
+from isegm.inference.clicker import Click
+from isegm.inference.transforms.crops import Crops
+from isegm.inference.transforms.zoom_in import get_roi_image_nd
+from isegm.model.is_model import split_points_by_order
+from isegm.model.ops import DistMaps
+from benchmarks import load_plugin_module
+
+
+SIZES = (512, 1024, 2048, 4096)
+
+# Canvas sizes for the QImage conversion, up to a 4K screen
+CANVAS_SIZES = ((1024, 768), (1920, 1080), (3840, 2160))
+
+
+def blob_mask(size):
+    """One large disk."""
+    mask = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(mask, (size // 2, size // 2), size // 3, 255, -1)
+    return mask
+
+
+def many_blobs_mask(size, seed=0):
+    """Thousands of small disks, one per 48x48 pixel cell on average."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(size * size // 48 ** 2):
+        center = tuple(int(c) for c in rng.integers(0, size, 2))
+        cv2.circle(mask, center, int(rng.integers(6, 12)), 255, -1)
+    return mask
+
+
+def spiral_mask(size, turns=40):
+    """A thin spiral, a single object with a very long contour."""
+    t = np.linspace(0, turns * 2 * np.pi, turns * 2000)
+    radius = t / t[-1] * size * 0.48
+    points = np.stack((size / 2 + radius * np.cos(t), size / 2 + radius * np.sin(t)), axis=1)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    cv2.polylines(mask, [points.astype(np.int32).reshape(-1, 1, 2)], False, 255, 3)
+    return mask
+
+
+def jagged_mask(size, seed=0):
+    """Thresholded smoothed noise: maze-like regions with jagged borders and many holes."""
+    rng = np.random.default_rng(seed)
+    noise = cv2.GaussianBlur(rng.random((size, size), dtype=np.float32), (0, 0), 4)
+    return np.where(noise > noise.mean(), 255, 0).astype(np.uint8)
+
+
+MASKS = {
+    "blob": blob_mask,
+    "many_blobs": many_blobs_mask,
+    "spiral": spiral_mask,
+    "jagged": jagged_mask,
+}
+
+
+def circle_ring(num_points):
+    t = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    return np.stack((1000 + 500 * np.cos(t), 1000 + 500 * np.sin(t)), axis=1)
+
+
+def random_points(num_points, size, seed=0):
+    """Click tensor (1, 2 * num_points, 3) with all positive and half of the negative slots used."""
+    rng = np.random.default_rng(seed)
+    points = np.full((1, 2 * num_points, 3), -1, dtype=np.float32)
+    for i in range(2 * num_points):
+        if i < num_points + num_points // 2:
+            points[0, i, :2] = rng.integers(0, size, 2)
+            points[0, i, 2] = i % num_points
+    return torch.from_numpy(points)
+
+
+def load_plugin_helpers():
+    """Import the plugin's helper_func module, which needs a QGIS Python environment."""
+    try:
+        return load_plugin_module("helper_func")
+    except ImportError:
+        return None
+
+
+def qimage_to_numpy_rgb_png(image):
+    """The former conversion of the plugin, through a temporary PNG file, for comparison."""
+    from PIL import Image
+    from PyQt5.QtGui import QImage
+
+    image = image.convertToFormat(QImage.Format_RGB888)
+    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmp_file:
+        temp_filename = tmp_file.name
+    image.save(temp_filename)
+    array = np.array(Image.open(temp_filename))
+    os.remove(temp_filename)
+    return array
+
+
+def canvas_qimage(width, height):
+    """A rendered canvas image: ARGB32 premultiplied, like QgsMapRendererParallelJob returns."""
+    from PyQt5.QtGui import QImage
+
+    image = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    qimage = QImage(image.tobytes(), width, height, width * 3, QImage.Format_RGB888)
+    return qimage.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+
+
+def build_cases(max_size):
+    """Return ``(name, setup)`` pairs; ``setup()`` prepares inputs and returns the callable to time."""
+    sizes = [size for size in SIZES if size <= max_size]
+    cases = []
+
+    for kind, make_mask in MASKS.items():
+        for size in sizes if kind == "blob" else [s for s in sizes if s in (2048, 4096)]:
+            def setup(make_mask=make_mask, size=size):
+                mask = make_mask(size)
+                return lambda: mask_to_polygon(mask)
+            cases.append((f"mask_to_polygon/{kind}/{size}", setup))
+
+            def setup(make_mask=make_mask, size=size):
+                polygons = mask_to_polygon(make_mask(size), min_area=0)
+                return lambda: polygon_to_mask(polygons, size, size)
+            cases.append((f"polygon_to_mask/{kind}/{size}", setup))
+
+    for num_points in (1000, 100000, 1000000):
+        def setup(num_points=num_points):
+            ring = circle_ring(num_points)
+            return lambda: is_counter_clockwise(ring)
+        cases.append((f"is_counter_clockwise/array/{num_points}", setup))
+
+    def setup():
+        ring = circle_ring(100000).tolist()
+        return lambda: is_counter_clockwise(ring)
+    cases.append(("is_counter_clockwise/list/100000", setup))
+
+    helpers = load_plugin_helpers()
+
+    wire_format = load_plugin_module("wire_format")
+    for size in sizes:
+        def setup(size=size):
+            image = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+            return lambda: wire_format.encode_image(image)
+        cases.append((f"encode_image/{size}", setup))
+
+    for width, height in CANVAS_SIZES:
+        for path in ("buffer", "png"):
+            def setup(width=width, height=height, path=path):
+                if helpers is None:
+                    return None
+                image = canvas_qimage(width, height)
+                convert = helpers.qimage_to_numpy_rgb if path == "buffer" else qimage_to_numpy_rgb_png
+                return lambda: convert(image)
+            cases.append((f"qimage_to_numpy/{path}/{width}x{height}", setup))
+
+    for cpu_mode in (False, True):
+        mode = "cython" if cpu_mode else "torch"
+        for size in (448, 1024):
+            for num_points in (1, 24):
+                def setup(cpu_mode=cpu_mode, size=size, num_points=num_points):
+                    try:
+                        dist_maps = DistMaps(norm_radius=5, cpu_mode=cpu_mode, use_disks=True)
+                    except ImportError:
+                        return None  # Cython extension not built
+                    points = random_points(num_points, size)
+                    return lambda: dist_maps.get_coord_features(points, 1, size, size)
+                cases.append((f"dist_maps/{mode}/{size}/{num_points}", setup))
+
+    for size in sizes:
+        def setup(size=size):
+            image_nd = torch.rand((1, 4, size, size))
+            roi = (size // 4, size * 3 // 4, size // 4, size * 3 // 4)
+            return lambda: get_roi_image_nd(image_nd, roi, 448)
+        cases.append((f"get_roi_image_nd/{size}", setup))
+
+    for size in [s for s in sizes if s <= 2048]:
+        def setup(size=size):
+            image_nd = torch.rand((1, 3, size, size))
+            clicks = [Click(is_positive=i % 2 == 0, coords=(i * 37 % size, i * 91 % size), indx=i)
+                      for i in range(10)]
+            crops = Crops(crop_size=(320, 480))
+            return lambda: crops.transform(image_nd, [clicks])
+        cases.append((f"crops_transform/{size}", setup))
+
+    for num_points in (1, 24, 100):
+        def setup(num_points=num_points):
+            points = random_points(num_points, 448)
+            return lambda: split_points_by_order(points, groups=(1, 0))
+        cases.append((f"split_points_by_order/{num_points}", setup))
+
+    return cases
+
+
+def measure(func, repeat, min_time):
+    """Median and minimum time per call, with the number of calls per repeat calibrated to ``min_time``."""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    number = max(1, int(min_time / max(elapsed, 1e-9)))
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+
+    return {"median_ms": float(np.median(times)) * 1000, "min_ms": float(np.min(times)) * 1000,
+            "number": number, "repeat": repeat}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", help="Only run cases containing this string")
+    parser.add_argument("--max-size", type=int, default=4096, help="Largest image size")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.1, help="Minimum time per repeat in seconds")
+    parser.add_argument("--threads", type=int, default=1, help="Torch CPU threads")
+    parser.add_argument("--save", metavar="FILE", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="Compare with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown relative to the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    cv2.setNumThreads(args.threads)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = []
+    for name, setup in build_cases(args.max_size):
+        if args.filter and args.filter not in name:
+            continue
+
+        func = setup()
+        if func is None:
+            print(f"{name:<44}skipped")
+            continue
+
+        result = measure(func, args.repeat, args.min_time)
+        results[name] = result
+
+        line = f"{name:<44}{result['median_ms']:>12.3f} ms"
+        if name in baseline:
+            ratio = result["median_ms"] / baseline[name]["median_ms"]
+            line += f"{ratio:>8.2f}x"
+            if ratio > 1 + args.tolerance:
+                regressions.append((name, ratio))
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                    "platform": platform.platform(),
+                    "processor": platform.processor(),
+                    "python": sys.version.split()[0],
+                    "numpy": np.__version__,
+                    "opencv": cv2.__version__,
+                    "torch": torch.__version__,
+                    "threads": args.threads,
+                },
+                "results": results,
+            }, f, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {args.tolerance:.0%}:")
+        for name, ratio in regressions:
+            print(f"  {name}: {ratio:.2f}x")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
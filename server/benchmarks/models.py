@@ -0,0 +1,119 @@
+"""
+Benchmark models with random weights.
+
+The interactive segmentation models are built from the same ``serialize``
+configs that are stored in the checkpoints, so their architecture matches the
+released weights without downloading them. SAM models are built from the
+segment-anything registry without a checkpoint.
+"""
+from collections import OrderedDict
+from isegm.utils.serialization import load_model
+
+
+HRNET = "isegm.model.is_hrnet_model.HRNetModel"
+PLAINVIT = "isegm.model.is_plainvit_model.PlainVitModel"
+
+
+def make_config(class_name, **params):
+    """Build a config in the format written by `isegm.utils.serialization.serialize`."""
+    return {
+        "class": class_name,
+        "params": {
+            name: {"type": "builtin", "value": value, "specified": True}
+            for name, value in params.items()
+        },
+    }
+
+
+def hrnet_config(width, ocr_width, small=False):
+    return make_config(
+        HRNET,
+        width=width,
+        ocr_width=ocr_width,
+        small=small,
+        with_aux_output=True,
+        use_leaky_relu=True,
+        use_rgb_conv=False,
+        use_disks=True,
+        norm_radius=5,
+        with_prev_mask=True,
+    )
+
+
+def plainvit_config(embed_dim, depth, num_heads, out_dims, channels=256):
+    return make_config(
+        PLAINVIT,
+        use_disks=True,
+        norm_radius=5,
+        with_prev_mask=True,
+        backbone_params=dict(
+            img_size=(448, 448),
+            patch_size=(16, 16),
+            in_chans=3,
+            embed_dim=embed_dim,
+            depth=depth,
+            num_heads=num_heads,
+            mlp_ratio=4,
+            qkv_bias=True,
+        ),
+        neck_params=dict(in_dim=embed_dim, out_dims=out_dims),
+        head_params=dict(
+            in_channels=out_dims,
+            in_index=[0, 1, 2, 3],
+            dropout_ratio=0.1,
+            num_classes=1,
+            loss_decode=None,
+            align_corners=False,
+            upsample="x1",
+            channels=channels,
+        ),
+    )
+
+
+# Name -> (config, eval_ritm). The configs follow the released RITM and SimpleClick models.
+IS_MODELS = OrderedDict([
+    ("RITM-HRNet18s", (hrnet_config(18, 48, small=True), True)),
+    ("RITM-HRNet18", (hrnet_config(18, 64), True)),
+    ("RITM-HRNet32", (hrnet_config(32, 128), True)),
+    ("SimpleClick-ViT-B", (plainvit_config(768, 12, 12, [128, 256, 512, 1024]), False)),
+    ("SimpleClick-ViT-L", (plainvit_config(1024, 24, 16, [192, 384, 768, 1536]), False)),
+    ("SimpleClick-ViT-H", (plainvit_config(1280, 32, 16, [240, 480, 960, 1920]), False)),
+])
+
+# Name -> segment-anything registry key
+SAM_MODELS = OrderedDict([
+    ("SAM-ViT-B", "vit_b"),
+    ("SAM-ViT-L", "vit_l"),
+    ("SAM-ViT-H", "vit_h"),
+])
+
+MODEL_NAMES = list(IS_MODELS) + list(SAM_MODELS)
+
+DEFAULT_MODELS = ["RITM-HRNet18", "SimpleClick-ViT-B", "SAM-ViT-B"]
+
+
+def build_model(name, device):
+    """
+    Build a benchmark model with random weights.
+
+    Returns:
+        tuple: The network and its predictor mode (``NoBRS`` or ``SAM``).
+    """
+    if name in SAM_MODELS:
+        from segment_anything import sam_model_registry
+
+        model = sam_model_registry[SAM_MODELS[name]](checkpoint=None)
+        mode = "SAM"
+    elif name in IS_MODELS:
+        config, eval_ritm = IS_MODELS[name]
+        model = load_model(config, eval_ritm, cpu_dist_maps=True)
+        mode = "NoBRS"
+    else:
+        raise ValueError(f"No benchmark model with name {name}")
+
+    for param in model.parameters():
+        param.requires_grad = False
+    model.to(device)
+    model.eval()
+
+    return model, mode
@@ -0,0 +1,134 @@
+"""
+Capture of segment requests for offline replay.
+
+Requests slower than a latency threshold, or picked by a sampling rate, are
+recorded with their inputs, outputs and stage timings. A capture is a pair of
+files sharing a name: ``<name>.npz`` holds the arrays (``image``, ``pred_mask``
+and, if present, ``prev_mask``) and ``<name>.json`` the request parameters and
+timings. The JSON file is written last, so only complete captures are listed.
+
+Captures are written by a background thread and kept in a bounded ring: the
+oldest captures are deleted once ``max_captures`` is exceeded. When the writer
+falls behind, new captures are dropped instead of blocking requests.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CaptureRecorder:
+    def __init__(self, directory, max_captures=100, latency_threshold=None, sample_rate=0.0,
+                 queue_size=8):
+        self.directory = directory
+        self.max_captures = max_captures
+        self.latency_threshold = latency_threshold
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_captures > 0 and (
+            self.latency_threshold is not None or self.sample_rate > 0
+        )
+
+    def should_capture(self, latency):
+        """Decide whether a request with a total ``latency`` (in seconds) is captured."""
+        if not self.enabled:
+            return None
+        if self.latency_threshold is not None and latency >= self.latency_threshold:
+            return "latency"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def submit(self, arrays, metadata):
+        """Queue a capture for writing. Returns False if the capture was dropped."""
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait((arrays, metadata))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            arrays, metadata = self._queue.get()
+            try:
+                self._write(arrays, metadata)
+                self._prune()
+            except Exception as e:
+                logger.warning("Failed to write capture: %s", e)
+
+    def _write(self, arrays, metadata):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), uuid.uuid4().hex[:8])
+        base = os.path.join(self.directory, name)
+
+        arrays = {k: v for k, v in arrays.items() if v is not None}
+        # np.savez adds the .npz suffix, so the temporary name must already end with it
+        np.savez_compressed(base + ".tmp.npz", **arrays)
+        os.replace(base + ".tmp.npz", base + ".npz")
+
+        with open(base + ".json.tmp", "w") as f:
+            json.dump(dict(metadata, name=name), f, indent=2)
+        os.replace(base + ".json.tmp", base + ".json")
+
+    def _prune(self):
+        names = list_captures(self.directory)
+        for name in names[:max(len(names) - self.max_captures, 0)]:
+            for suffix in (".json", ".npz"):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+
+def list_captures(directory):
+    """Return the names of the complete captures in ``directory``, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        entry.name[:-len(".json")] for entry in os.scandir(directory)
+        if entry.name.endswith(".json")
+        and os.path.exists(os.path.join(directory, entry.name[:-len(".json")] + ".npz"))
+    )
+
+
+def load_capture(path):
+    """
+    Load a capture.
+
+    Args:
+        path (str): The path of the capture, with or without the ``.npz`` or ``.json`` suffix.
+
+    Returns:
+        tuple: The arrays (dict) and the metadata (dict) of the capture.
+    """
+    base, ext = os.path.splitext(path)
+    if ext not in (".npz", ".json"):
+        base = path
+
+    with open(base + ".json", "r") as f:
+        metadata = json.load(f)
+    with np.load(base + ".npz") as data:
+        arrays = {k: data[k] for k in data.files}
+
+    return arrays, metadata
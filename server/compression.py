@@ -0,0 +1,240 @@
+"""
+ASGI middleware for compressed requests and responses.
+
+Responses are compressed with brotli or gzip, depending on the client's
+``Accept-Encoding`` header, once they exceed a minimum size. Request bodies sent
+with ``Content-Encoding: gzip`` (or ``br``) are decompressed before they reach
+the application, so clients can upload large images compressed. Compressed and
+decompressed request bodies are limited to ``max_request_size`` bytes and
+rejected with 413 beyond it, so a small compressed body cannot expand into
+gigabytes of server memory.
+
+(De)compression runs in the thread pool to keep the event loop responsive.
+
+Brotli support is optional and enabled when the ``brotli`` package is installed.
+Brotli request bodies need brotli 1.2 or later, which bounds decompression.
+"""
+import gzip
+import zlib
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+def decompress_limited(data, encoding, limit):
+    """
+    Decompress a gzip or brotli body, raising ``RequestTooLarge`` as soon as the
+    output exceeds ``limit`` bytes and ``ValueError`` if the body is invalid.
+    """
+    chunks = []
+    size = 0
+    if encoding == "br":
+        if brotli is None or not hasattr(brotli.Decompressor, "can_accept_more_data"):
+            # Older brotli releases cannot bound the output of a decompression call
+            raise ValueError("brotli is not supported")
+        decompressor = brotli.Decompressor()
+        # The output of each call is bounded, the rest of the input stays buffered
+        chunk = decompressor.process(data, output_buffer_limit=limit + 1)
+        while True:
+            size += len(chunk)
+            if size > limit:
+                raise RequestTooLarge()
+            chunks.append(chunk)
+            if decompressor.is_finished() or decompressor.can_accept_more_data():
+                break
+            chunk = decompressor.process(b"", output_buffer_limit=limit + 1 - size)
+        if not decompressor.is_finished():
+            raise ValueError("Truncated brotli body")
+        return b"".join(chunks)
+
+    while data:
+        # A gzip body may consist of several members
+        decompressor = zlib.decompressobj(wbits=31)
+        while data and not decompressor.eof:
+            chunk = decompressor.decompress(data, limit + 1 - size)
+            size += len(chunk)
+            if size > limit:
+                raise RequestTooLarge()
+            chunks.append(chunk)
+            data = decompressor.unconsumed_tail
+        if not decompressor.eof:
+            raise ValueError("Truncated gzip body")
+        data = decompressor.unused_data
+    return b"".join(chunks)
+
+
+def _parse_accept_encoding(value):
+    """Return the set of encodings accepted by the client (``q=0`` excluded)."""
+    encodings = set()
+    for item in value.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, number = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+class CompressionMiddleware:
+    def __init__(
+        self,
+        app,
+        minimum_size=1024,
+        gzip_level=6,
+        brotli_quality=4,
+        max_request_size=128 * 1024 * 1024,
+    ):
+        self.app = app
+        self.max_request_size = max_request_size
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+
+        content_encoding = headers.get("content-encoding", "").strip().lower()
+        if content_encoding in ("gzip", "br"):
+            scope, receive = await self._decompress_request(scope, receive, content_encoding, send)
+            if scope is None:
+                return
+
+        accepted = _parse_accept_encoding(headers.get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        await self.app(scope, receive, _CompressedSender(send, encoding, self))
+
+    def compress(self, body, encoding):
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def _decompress_request(self, scope, receive, encoding, send):
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return None, None  # Client disconnected
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_request_size:
+                await _send_error(send, 413, b'{"detail":"Request body too large"}')
+                return None, None
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+
+        try:
+            body = await run_in_threadpool(
+                decompress_limited, b"".join(chunks), encoding, self.max_request_size
+            )
+        except RequestTooLarge:
+            await _send_error(send, 413, b'{"detail":"Request body too large"}')
+            return None, None
+        except Exception:
+            await _send_error(send, 400, b'{"detail":"Invalid compressed request body"}')
+            return None, None
+
+        # Replace the body and its headers with the decompressed version
+        request_headers = [
+            (k, v) for k, v in scope["headers"]
+            if k.lower() not in (b"content-encoding", b"content-length")
+        ]
+        request_headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        scope = dict(scope, headers=request_headers)
+
+        sent = False
+
+        async def receive_decompressed():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        return scope, receive_decompressed
+
+
+class _CompressedSender:
+    """Buffers a response and compresses it before it is sent."""
+
+    def __init__(self, send, encoding, middleware):
+        self.send = send
+        self.encoding = encoding
+        self.middleware = middleware
+        self.start_message = None
+        self.chunks = []
+        self.passthrough = False
+
+    async def __call__(self, message):
+        if self.passthrough:
+            await self.send(message)
+            return
+
+        if message["type"] == "http.response.start":
+            headers = {k.lower() for k, _ in message.get("headers", [])}
+            if b"content-encoding" in headers:
+                # Already encoded by the application
+                self.passthrough = True
+                await self.send(message)
+            else:
+                self.start_message = message
+            return
+
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        self.chunks.append(message.get("body", b""))
+        if message.get("more_body", False):
+            return
+
+        body = b"".join(self.chunks)
+        headers = [
+            (k, v) for k, v in self.start_message.get("headers", [])
+            if k.lower() != b"content-length"
+        ]
+        if len(body) >= self.middleware.minimum_size:
+            body = await run_in_threadpool(self.middleware.compress, body, self.encoding)
+            headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+            headers.append((b"vary", b"Accept-Encoding"))
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+
+        await self.send(dict(self.start_message, headers=headers))
+        await self.send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+async def _send_error(send, status, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body, "more_body": False})
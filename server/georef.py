@@ -0,0 +1,86 @@
+"""
+Georeferencing of pixel-space polygons.
+
+A geotransform uses the GDAL convention ``(x0, dx, rx, y0, ry, dy)`` and maps a
+pixel position ``(col, row)`` to map coordinates::
+
+    x = x0 + col * dx + row * rx
+    y = y0 + col * ry + row * dy
+
+All rings of a response are transformed together in one NumPy operation and,
+when a target CRS is given, reprojected with a single pyproj call.
+"""
+from functools import lru_cache
+import numpy as np
+
+
+def geotransform_from_extent(extent, width, height):
+    """
+    Build a north-up geotransform for an image covering ``extent``.
+
+    Args:
+        extent (list): ``[xmin, ymin, xmax, ymax]`` of the image in map units.
+        width (int): The width of the image in pixels.
+        height (int): The height of the image in pixels.
+
+    Returns:
+        tuple: The geotransform ``(x0, dx, rx, y0, ry, dy)``.
+    """
+    xmin, ymin, xmax, ymax = extent
+    return (xmin, (xmax - xmin) / width, 0.0, ymax, 0.0, -(ymax - ymin) / height)
+
+
+def offset_geotransform(geotransform, x, y):
+    """Return the geotransform of a window starting at pixel ``(x, y)``."""
+    x0, dx, rx, y0, ry, dy = geotransform
+    return (x0 + x * dx + y * rx, dx, rx, y0 + x * ry + y * dy, ry, dy)
+
+
+@lru_cache(maxsize=16)
+def get_transformer(src_crs, dst_crs):
+    """Return a cached pyproj transformer between two CRS definitions."""
+    try:
+        from pyproj import Transformer
+    except ImportError as e:
+        raise ValueError("Reprojection requires the pyproj package") from e
+
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def georeference(polygons, geotransform, src_crs=None, dst_crs=None):
+    """
+    Convert polygons from pixel space to map coordinates.
+
+    Args:
+        polygons (list): Polygons as returned by `polygonize.extract_polygons`.
+        geotransform (tuple): The geotransform of the image the polygons were extracted from.
+        src_crs (str): The CRS of the geotransform, as an authority id or WKT.
+        dst_crs (str): The CRS of the output. Reprojection is skipped if it is empty
+            or equal to ``src_crs``.
+
+    Returns:
+        list: Polygons with the same structure and float64 rings in map coordinates.
+    """
+    rings = [ring for polygon in polygons for ring in polygon]
+    if not rings:
+        return []
+
+    coords = np.concatenate(rings, axis=0).astype(np.float64)
+    x0, dx, rx, y0, ry, dy = geotransform
+    affine = np.array([[dx, ry], [rx, dy]], dtype=np.float64)
+    coords = coords @ affine + (x0, y0)
+
+    if dst_crs and src_crs and dst_crs != src_crs:
+        x, y = get_transformer(src_crs, dst_crs).transform(coords[:, 0], coords[:, 1])
+        coords = np.stack((x, y), axis=1)
+
+    ring_splits = np.cumsum([len(ring) for ring in rings])[:-1]
+    rings = np.split(coords, ring_splits)
+
+    georeferenced = []
+    start = 0
+    for polygon in polygons:
+        georeferenced.append(rings[start:start + len(polygon)])
+        start += len(polygon)
+
+    return georeferenced
@@ -30,30 +30,44 @@ class Clicker(object):
         fn_mask = np.logical_and(np.logical_and(self.gt_mask, np.logical_not(pred_mask)), self.not_ignore_mask)
         fp_mask = np.logical_and(np.logical_and(np.logical_not(self.gt_mask), pred_mask), self.not_ignore_mask)
 
-        if padding:
-            fn_mask = np.pad(fn_mask, ((1, 1), (1, 1)), 'constant')
-            fp_mask = np.pad(fp_mask, ((1, 1), (1, 1)), 'constant')
+        fn_max_dist, fn_coords = self._get_max_distance(fn_mask, padding)
+        fp_max_dist, fp_coords = self._get_max_distance(fp_mask, padding)
+
+        is_positive = fn_max_dist > fp_max_dist
+        coords = fn_coords if is_positive else fp_coords  # coords is [y, x]
+
+        return Click(is_positive=is_positive, coords=coords)
+
+    def _get_max_distance(self, error_mask, padding=True):
+        # The distance transform is limited to the bounding box of the error region plus a
+        # one pixel margin, which contains only zeros and bounds all distances inside the box.
+        rows = np.flatnonzero(error_mask.any(axis=1))
+        if len(rows) == 0:
+            return 0.0, (0, 0)
+        cols = np.flatnonzero(error_mask.any(axis=0))
 
-        fn_mask_dt = cv2.distanceTransform(fn_mask.astype(np.uint8), cv2.DIST_L2, 0)
-        fp_mask_dt = cv2.distanceTransform(fp_mask.astype(np.uint8), cv2.DIST_L2, 0)
+        height, width = error_mask.shape
+        y0, y1 = max(rows[0] - 1, 0), min(rows[-1] + 2, height)
+        x0, x1 = max(cols[0] - 1, 0), min(cols[-1] + 2, width)
+        error_roi = error_mask[y0:y1, x0:x1].astype(np.uint8)
 
         if padding:
-            fn_mask_dt = fn_mask_dt[1:-1, 1:-1]
-            fp_mask_dt = fp_mask_dt[1:-1, 1:-1]
+            error_roi = np.pad(error_roi, ((1, 1), (1, 1)), 'constant')
 
-        fn_mask_dt = fn_mask_dt * self.not_clicked_map
-        fp_mask_dt = fp_mask_dt * self.not_clicked_map
+        error_dt = cv2.distanceTransform(error_roi, cv2.DIST_L2, 0)
 
-        fn_max_dist = np.max(fn_mask_dt)
-        fp_max_dist = np.max(fp_mask_dt)
+        if padding:
+            error_dt = error_dt[1:-1, 1:-1]
 
-        is_positive = fn_max_dist > fp_max_dist
-        if is_positive:
-            coords_y, coords_x = np.where(fn_mask_dt == fn_max_dist)  # coords is [y, x]
-        else:
-            coords_y, coords_x = np.where(fp_mask_dt == fp_max_dist)  # coords is [y, x]
+        error_dt = error_dt * self.not_clicked_map[y0:y1, x0:x1]
+
+        max_dist = np.max(error_dt)
+        if max_dist == 0:
+            # Same as searching the whole (all zero) distance map
+            return 0.0, (0, 0)
 
-        return Click(is_positive=is_positive, coords=(coords_y[0], coords_x[0]))
+        coords_y, coords_x = np.where(error_dt == max_dist)
+        return max_dist, (y0 + coords_y[0], x0 + coords_x[0])
 
     def add_click(self, click):
         coords = click.coords
@@ -82,7 +96,7 @@ class Clicker(object):
 
     def reset_clicks(self):
         if self.gt_mask is not None:
-            self.not_clicked_map = np.ones_like(self.gt_mask, dtype=np.bool)
+            self.not_clicked_map = np.ones_like(self.gt_mask, dtype=bool)
 
         self.num_pos_clicks = 0
         self.num_neg_clicks = 0
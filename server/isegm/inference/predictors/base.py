@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 import torch
 import torch.nn.functional as F
 from torchvision import transforms
@@ -26,6 +27,8 @@ class BasePredictor(object):
         self.cascade_step = cascade_step
         self.cascade_adaptive = cascade_adaptive
         self.cascade_clicks = cascade_clicks
+        # Optional StageTimer (see server/metrics.py) recording the prediction stages
+        self.timer = None
 
         if isinstance(model, tuple):
             self.net, self.click_models = model
@@ -76,16 +79,19 @@ class BasePredictor(object):
             prev_mask = self.prev_prediction
         if hasattr(self.net, 'with_prev_mask') and self.net.with_prev_mask:
             input_image = torch.cat((input_image, prev_mask), dim=1)
-        image_nd, clicks_lists, is_image_changed = self.apply_transforms(
-            input_image, [clicks_list]
-        )
+        with self._stage('transforms'):
+            image_nd, clicks_lists, is_image_changed = self.apply_transforms(
+                input_image, [clicks_list]
+            )
 
-        pred_logits = self._get_prediction(image_nd, clicks_lists, is_image_changed)
-        prediction = F.interpolate(pred_logits, mode='bilinear', align_corners=True,
-                                   size=image_nd.size()[2:])
+        with self._stage('forward'):
+            pred_logits = self._get_prediction(image_nd, clicks_lists, is_image_changed)
+            prediction = F.interpolate(pred_logits, mode='bilinear', align_corners=True,
+                                       size=image_nd.size()[2:])
 
-        for t in reversed(self.transforms):
-            prediction = t.inv_transform(prediction)
+        with self._stage('inverse_transforms'):
+            for t in reversed(self.transforms):
+                prediction = t.inv_transform(prediction)
 
         if self.zoom_in is not None and self.zoom_in.check_possible_recalculation():
             return self.get_prediction(clicker)
@@ -93,6 +99,11 @@ class BasePredictor(object):
         self.prev_prediction = prediction
         return prediction.cpu().numpy()[0, 0]
 
+    def _stage(self, name):
+        if self.timer is None:
+            return nullcontext()
+        return self.timer.stage(name)
+
     def _get_prediction(self, image_nd, clicks_lists, is_image_changed):
         points_nd = self.get_points_nd(clicks_lists)
         return self.net(image_nd, points_nd)['instances']
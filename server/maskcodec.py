@@ -0,0 +1,163 @@
+"""
+Compact encodings of binary masks.
+
+Masks are cropped to the bounding box of their foreground before encoding and
+are transported together with the offset of the crop, so the payload size
+depends on the object and not on the size of the canvas.
+
+Two encodings are supported:
+- ``rle``: COCO-style uncompressed run-length encoding. Runs are counted in
+  column-major order and start with a (possibly empty) run of zeros.
+- ``png``: a 1-bit PNG image, base64-encoded.
+"""
+import base64
+import struct
+import cv2
+import numpy as np
+
+
+def crop_to_roi(mask):
+    """
+    Crop a mask to the bounding box of its non-zero pixels.
+
+    Returns:
+        tuple: The cropped mask and its ``(x, y)`` offset in the input mask.
+            An empty mask gives a ``(0, 0)`` crop at offset ``(0, 0)``.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return mask[:0, :0], (0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    rmin, rmax = rows[0], rows[-1]
+    cmin, cmax = cols[0], cols[-1]
+    return mask[rmin:rmax + 1, cmin:cmax + 1], (int(cmin), int(rmin))
+
+
+def encode_rle(mask):
+    """Encode a binary mask as COCO-style uncompressed RLE counts."""
+    flat = (mask > 0).ravel(order="F")
+    if flat.size == 0:
+        return []
+
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+
+def decode_rle(counts, width, height):
+    """Decode COCO-style uncompressed RLE counts to a binary mask (0, 255)."""
+    try:
+        counts = np.asarray(counts, dtype=np.int64)
+    except (TypeError, OverflowError):
+        raise ValueError("RLE counts must be integers")
+    # Check the counts before expanding them, they come from the client
+    if counts.ndim != 1 or np.any(counts < 0):
+        raise ValueError("RLE counts must be non-negative integers")
+    if int(counts.sum(dtype=object)) != width * height:
+        raise ValueError("RLE counts do not match the mask size")
+
+    values = np.arange(len(counts), dtype=np.uint8) % 2 * 255
+    flat = np.repeat(values, counts)
+    return flat.reshape((height, width), order="F")
+
+
+def encode_png(mask):
+    """Encode a binary mask as a base64 1-bit PNG."""
+    ok, buffer = cv2.imencode(".png", (mask > 0).astype(np.uint8) * 255,
+                              [cv2.IMWRITE_PNG_BILEVEL, 1])
+    if not ok:
+        raise ValueError("Failed to encode mask as PNG")
+    return base64.b64encode(buffer.tobytes()).decode("utf-8")
+
+
+def png_size(data):
+    """Read the ``(width, height)`` of a PNG from its IHDR chunk."""
+    if len(data) < 24 or data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        raise ValueError("Invalid PNG mask")
+    return struct.unpack(">II", data[16:24])
+
+
+def decode_png(data, width, height):
+    """Decode a base64 PNG of size ``(width, height)`` to a binary mask (0, 255)."""
+    data = base64.b64decode(data)
+    # Check the size in the header before decoding, the PNG comes from the client
+    if png_size(data) != (width, height):
+        raise ValueError("PNG size does not match the mask size")
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    mask = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError("Failed to decode PNG mask")
+    return np.where(mask > 0, 255, 0).astype(np.uint8)
+
+
+def paste_roi(roi, offset, width, height):
+    """Place a cropped mask at ``offset`` in an empty ``(height, width)`` mask, clipping at the borders."""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    x, y = offset
+    roi_height, roi_width = roi.shape
+
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + roi_width, width), min(y + roi_height, height)
+    if x1 > x0 and y1 > y0:
+        mask[y0:y1, x0:x1] = roi[y0 - y:y1 - y, x0 - x:x1 - x]
+    return mask
+
+
+def decode_mask(encoded, width, height):
+    """
+    Decode a mask produced by `encode_mask` into a full ``(height, width)`` binary mask (0, 255).
+
+    Raises:
+        ValueError: If the crop does not fit in the mask or its data does not match its size.
+    """
+    try:
+        roi_width, roi_height = int(encoded["width"]), int(encoded["height"])
+        x, y = (int(v) for v in encoded.get("offset", (0, 0)))
+    except (TypeError, ValueError):
+        raise ValueError("Mask size and offset must be integers")
+    if not (0 <= roi_width <= width and 0 <= roi_height <= height):
+        raise ValueError("Mask crop is larger than the mask")
+
+    if encoded["format"] == "rle":
+        roi = decode_rle(encoded["counts"], roi_width, roi_height)
+    elif encoded["format"] == "png":
+        if roi_width * roi_height == 0:
+            roi = np.zeros((roi_height, roi_width), dtype=np.uint8)
+        else:
+            roi = decode_png(encoded["data"], roi_width, roi_height)
+    else:
+        raise ValueError(f"Unknown mask format {encoded['format']}")
+
+    if roi.shape != (roi_height, roi_width):
+        raise ValueError("Mask data does not match the mask size")
+
+    return paste_roi(roi, (x, y), width, height)
+
+
+def encode_mask(mask, mask_format="rle"):
+    """
+    Crop a binary mask to its foreground and encode it.
+
+    Returns:
+        dict: ``format``, ``offset`` (``[x, y]`` of the crop), ``width`` and ``height`` of the
+            crop, and either ``counts`` (``rle``) or ``data`` (``png``).
+    """
+    roi, (x, y) = crop_to_roi(mask)
+    encoded = {
+        "format": mask_format,
+        "offset": [x, y],
+        "width": roi.shape[1],
+        "height": roi.shape[0],
+    }
+
+    if mask_format == "rle":
+        encoded["counts"] = encode_rle(roi)
+    elif mask_format == "png":
+        encoded["data"] = encode_png(roi) if roi.size else ""
+    else:
+        raise ValueError(f"Unknown mask format {mask_format}")
+
+    return encoded
@@ -0,0 +1,135 @@
+"""
+Per-stage latency measurement and Prometheus metrics.
+
+A `StageTimer` is created for every segment request and passed down to the
+predictor, which records the time spent in each stage. The durations are
+returned in the ``Server-Timing`` header and aggregated in Prometheus
+histograms labelled by model and stage.
+"""
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from prometheus_client import Gauge, Histogram
+
+
+# Buckets from 1 ms to 30 s
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+STAGE_SECONDS = Histogram(
+    "segmap_stage_seconds",
+    "Time spent in each stage of a segment request.",
+    ["model", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "segmap_request_seconds",
+    "Total time of a segment request, from receiving it to serializing the response.",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    "segmap_queue_depth",
+    "Number of segment requests waiting for the inference lock.",
+)
+INFERENCE_ACTIVE = Gauge(
+    "segmap_inference_active",
+    "Number of segment requests holding the inference lock.",
+)
+PREDICTOR_POOL_SIZE = Gauge(
+    "segmap_predictor_pool_size",
+    "Number of predictors loaded in the predictor pool.",
+)
+PREDICTOR_POOL_CAPACITY = Gauge(
+    "segmap_predictor_pool_capacity",
+    "Maximum number of predictors kept in the predictor pool.",
+)
+MEMORY_BYTES = Gauge(
+    "segmap_memory_bytes",
+    "Memory usage of the server process.",
+    ["kind"],
+)
+
+
+def _rss_bytes():
+    """Resident set size of the process, 0 where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+MEMORY_BYTES.labels("rss").set_function(_rss_bytes)
+
+
+def register_cuda_memory(torch):
+    """Export the CUDA memory of the torch allocator."""
+    MEMORY_BYTES.labels("cuda_allocated").set_function(torch.cuda.memory_allocated)
+    MEMORY_BYTES.labels("cuda_reserved").set_function(torch.cuda.memory_reserved)
+
+
+class StageTimer:
+    """
+    Records the wall time of named stages.
+
+    Stages may repeat (e.g. when the predictor recomputes a prediction), their
+    durations are then summed. ``synchronize`` is called around each stage so
+    asynchronous GPU work is attributed to the stage that queued it.
+    """
+
+    def __init__(self, synchronize=None):
+        self.synchronize = synchronize
+        self.records = []
+        self.current = None
+
+    @contextmanager
+    def stage(self, name):
+        if self.synchronize is not None:
+            self.synchronize()
+        previous, self.current = self.current, name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize is not None:
+                self.synchronize()
+            self.records.append((name, start, time.perf_counter()))
+            self.current = previous
+
+    def add(self, name, start, end):
+        """Record a stage measured elsewhere with `time.perf_counter`."""
+        self.records.append((name, start, end))
+
+    @property
+    def durations(self):
+        """Durations in seconds per stage, in order of first occurrence."""
+        durations = OrderedDict()
+        for name, start, end in self.records:
+            durations[name] = durations.get(name, 0.0) + end - start
+        return durations
+
+    def server_timing(self):
+        """Format the durations as a ``Server-Timing`` header value."""
+        return ", ".join(
+            f"{name};dur={duration * 1000:.2f}" for name, duration in self.durations.items()
+        )
+
+    def observe(self, model_name):
+        """Add the durations to the Prometheus histograms."""
+        for name, duration in self.durations.items():
+            STAGE_SECONDS.labels(model_name, name).observe(duration)
+
+
+class RequestTimingMiddleware:
+    """Stores the time a request was received as ``request.state.received_at``."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
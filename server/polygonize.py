@@ -0,0 +1,369 @@
+"""
+Conversion between binary masks and polygons.
+
+Rings are kept as closed ``(N, 2)`` int32 NumPy arrays in pixel space while the
+polygons are built. They are only converted to Python lists when a GeoJSON
+payload is produced.
+
+Orientation follows the convention of the API: exterior rings are
+counter-clockwise and holes are clockwise as seen on screen (``y`` pointing
+down). In terms of OpenCV's oriented area this means a negative area for
+exterior rings and a positive area for holes.
+"""
+import base64
+import struct
+import cv2
+import numpy as np
+
+
+# WKB geometry type codes
+_WKB_POLYGON = 3
+_WKB_MULTIPOLYGON = 6
+
+
+def is_counter_clockwise(polygon):
+    """
+    Determines if a polygon is wound counter-clockwise.
+
+    Args:
+        polygon (list | np.ndarray): A sequence of [x, y] points representing the polygon.
+
+    Returns:
+        bool: True if the polygon is counter-clockwise, False otherwise.
+    """
+    ring = np.asarray(polygon, dtype=np.float32).reshape(-1, 2)
+    return cv2.contourArea(ring, oriented=True) < 0
+
+
+def _orient(ring, area, exterior):
+    """Reverse ``ring`` if its signed ``area`` does not match the ring type."""
+    if (area > 0) == exterior:
+        ring = ring[::-1]
+    return ring
+
+
+def _close(ring):
+    """Return ``ring`` with its first vertex repeated at the end."""
+    return np.concatenate((ring, ring[:1]), axis=0)
+
+
+def _simplify(ring, tolerance):
+    """
+    Douglas-Peucker simplification of an open ring.
+
+    The simplified ring is rejected (and the input returned unchanged) when it
+    degenerates or flips its orientation.
+    """
+    simplified = cv2.approxPolyDP(ring.reshape(-1, 1, 2), tolerance, True).reshape(-1, 2)
+    if len(simplified) < 3:
+        return ring
+
+    area = cv2.contourArea(ring, oriented=True)
+    simplified_area = cv2.contourArea(simplified, oriented=True)
+    if simplified_area == 0 or (simplified_area > 0) != (area > 0):
+        return ring
+
+    return simplified
+
+
+def _crossing_rings(rings, chunk_size=256):
+    """
+    Return the pairs of ring indices with an edge crossing another edge, ``(i, i)``
+    if a ring crosses itself.
+
+    Only proper crossings count, plus edges that fold back onto the previous edge
+    of the same ring. Touching and overlapping edges are left alone since the
+    pixel contours of a mask already touch where the mask is one pixel wide.
+
+    Edges are sorted by their minimum ``x`` and each chunk is only tested against
+    the edges whose ``x`` range can overlap it, with exact integer orientation tests.
+    """
+    starts = np.concatenate(rings).astype(np.int64)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings]).astype(np.int64)
+    ring_ids = np.concatenate([np.full(len(ring), i) for i, ring in enumerate(rings)])
+    vertex_ids = np.concatenate([np.arange(len(ring)) for ring in rings])
+    ring_lengths = np.array([len(ring) for ring in rings])[ring_ids]
+
+    x_min = np.minimum(starts[:, 0], ends[:, 0])
+    x_max = np.maximum(starts[:, 0], ends[:, 0])
+    order = np.argsort(x_min, kind="stable")
+    starts, ends, ring_ids, vertex_ids, ring_lengths, x_min, x_max = (
+        array[order] for array in (starts, ends, ring_ids, vertex_ids, ring_lengths, x_min, x_max)
+    )
+
+    def cross(u, v):
+        return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+    crossing = set()
+    for start in range(0, len(starts), chunk_size):
+        stop = min(start + chunk_size, len(starts))
+        # Later edges start at or after this chunk, so only those starting before
+        # its largest x can overlap it
+        end = np.searchsorted(x_min, x_max[start:stop].max(), side="right")
+        a, b = starts[start:stop, None], ends[start:stop, None]
+        c, d = starts[None, start:end], ends[None, start:end]
+
+        o1 = np.sign(cross(b - a, c - a))
+        o2 = np.sign(cross(b - a, d - a))
+        o3 = np.sign(cross(d - c, a - c))
+        o4 = np.sign(cross(d - c, b - c))
+        hit = (o1 * o2 < 0) & (o3 * o4 < 0)
+
+        same_ring = ring_ids[start:stop, None] == ring_ids[None, start:end]
+        lengths = ring_lengths[start:stop, None]
+        offset = (vertex_ids[None, start:end] - vertex_ids[start:stop, None]) % lengths
+        adjacent = same_ring & ((offset == 1) | (offset == lengths - 1))
+        folded = adjacent & (o1 == 0) & (o2 == 0) & (np.sum((b - a) * (d - c), axis=-1) < 0)
+        hit |= folded
+
+        rows, columns = np.nonzero(hit)
+        crossing.update(zip(ring_ids[start + rows].tolist(), ring_ids[start + columns].tolist()))
+    return crossing
+
+
+def _invalid_rings(rings, simplified):
+    """
+    Return the indices of simplified rings that make a polygon invalid.
+
+    ``rings`` is the exterior ring followed by its holes and ``simplified`` the
+    set of indices of simplified rings. A polygon is valid when no edges cross,
+    every hole lies inside the exterior and no hole lies inside another hole.
+    Problems between original rings are inherited from the mask and ignored.
+    """
+    invalid = set()
+
+    def report(*indices):
+        invalid.update(i for i in indices if i in simplified)
+
+    for i, j in _crossing_rings(rings):
+        report(i, j)
+
+    exterior = rings[0].reshape(-1, 1, 2)
+    holes = rings[1:]
+    for i, hole in enumerate(holes, 1):
+        x, y = hole[0].tolist()
+        if cv2.pointPolygonTest(exterior, (float(x), float(y)), False) < 0:
+            report(0, i)
+
+    if len(holes) > 1:
+        # Only test holes whose first vertex lies in the bounding box of another hole
+        firsts = np.array([hole[0] for hole in holes])
+        minimums = np.array([hole.min(axis=0) for hole in holes])
+        maximums = np.array([hole.max(axis=0) for hole in holes])
+        candidates = np.all(
+            (firsts[:, None] >= minimums[None]) & (firsts[:, None] <= maximums[None]), axis=-1
+        )
+        np.fill_diagonal(candidates, False)
+        for i, j in zip(*np.nonzero(candidates)):
+            x, y = firsts[i].tolist()
+            if cv2.pointPolygonTest(holes[j].reshape(-1, 1, 2), (float(x), float(y)), False) > 0:
+                report(i + 1, j + 1)
+
+    return invalid
+
+
+def _simplify_polygon(exterior, holes, tolerance):
+    """
+    Simplify an exterior ring and its holes without breaking the polygon topology.
+
+    Simplified rings that cross themselves or another ring, holes that escape
+    the exterior or end up in another hole, and exteriors that cut off a hole
+    are replaced by their original rings until no new problem remains.
+    """
+    rings = [exterior] + holes
+    result = [_simplify(ring, tolerance) for ring in rings]
+    simplified = {i for i, ring in enumerate(result) if ring is not rings[i]}
+
+    while simplified:
+        invalid = _invalid_rings(result, simplified)
+        if not invalid:
+            break
+        for i in invalid:
+            result[i] = rings[i]
+        simplified -= invalid
+
+    return result[0], result[1:]
+
+
+def extract_polygons(binary_mask, min_area=100, simplify_tolerance=0.0):
+    """
+    Extract polygons with holes from a binary mask.
+
+    Args:
+        binary_mask (np.ndarray): A binary mask of shape (height, width) with values 0 or 255.
+        min_area (float): Rings with an area below this value (in pixels) are dropped.
+        simplify_tolerance (float): Douglas-Peucker tolerance in pixels. ``0`` disables simplification.
+
+    Returns:
+        list: A list of polygons. Each polygon is a list of closed ``(N, 2)`` int32 rings,
+            the exterior ring first followed by its holes.
+    """
+    contours, hierarchy = cv2.findContours(binary_mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return []
+
+    hierarchy = hierarchy[0]
+
+    # RETR_CCOMP yields a two level hierarchy: exterior rings have no parent and
+    # holes point to the contour index of their exterior ring.
+    exteriors = {}
+    holes = {}
+    for i, contour in enumerate(contours):
+        if len(contour) < 3:
+            continue  # Skip invalid polygons
+
+        # filter small polygons
+        area = cv2.contourArea(contour, oriented=True)
+        if abs(area) < min_area:
+            continue
+
+        ring = contour.reshape(-1, 2)
+        parent = hierarchy[i][3]
+        if parent == -1:
+            exteriors[i] = _orient(ring, area, exterior=True)
+            holes.setdefault(i, [])
+        else:
+            holes.setdefault(parent, []).append(_orient(ring, area, exterior=False))
+
+    polygons = []
+    for i, exterior in exteriors.items():
+        polygon_holes = holes[i]
+        if simplify_tolerance > 0:
+            exterior, polygon_holes = _simplify_polygon(exterior, polygon_holes, simplify_tolerance)
+        polygons.append([_close(exterior)] + [_close(hole) for hole in polygon_holes])
+
+    return polygons
+
+
+def polygons_to_geojson(polygons):
+    """Convert polygons from `extract_polygons` to a list of GeoJSON-like dictionaries."""
+    return [
+        {
+            "type": "Polygon",
+            "coordinates": [ring.tolist() for ring in polygon]
+        }
+        for polygon in polygons
+    ]
+
+
+def polygons_to_wkb(polygons):
+    """
+    Convert polygons from `extract_polygons` or `georef.georeference` to a
+    little-endian WKB MultiPolygon.
+
+    Returns:
+        bytes: The WKB encoded MultiPolygon. An empty mask gives an empty MultiPolygon.
+    """
+    chunks = [struct.pack("<BII", 1, _WKB_MULTIPOLYGON, len(polygons))]
+    for polygon in polygons:
+        chunks.append(struct.pack("<BII", 1, _WKB_POLYGON, len(polygon)))
+        for ring in polygon:
+            chunks.append(struct.pack("<I", len(ring)))
+            chunks.append(np.ascontiguousarray(ring, dtype="<f8").tobytes())
+    return b"".join(chunks)
+
+
+def polygons_to_flat(polygons):
+    """
+    Convert polygons from `extract_polygons` or `georef.georeference` to flat
+    coordinate arrays.
+
+    Returns:
+        dict: ``coordinates`` is the base64-encoded little-endian array of all ``x, y``
+            pairs, stored as ``dtype`` (``int32`` for pixel coordinates, ``float64`` for
+            map coordinates). Ring ``i`` spans vertices ``ring_offsets[i]:ring_offsets[i + 1]``
+            and polygon ``j`` spans rings ``polygon_offsets[j]:polygon_offsets[j + 1]``.
+    """
+    rings = [ring for polygon in polygons for ring in polygon]
+    dtype = "int32"
+    if any(np.issubdtype(ring.dtype, np.floating) for ring in rings):
+        dtype = "float64"
+
+    if rings:
+        coordinates = np.concatenate(rings, axis=0)
+    else:
+        coordinates = np.empty((0, 2))
+    coordinates = coordinates.astype(np.dtype(dtype).newbyteorder("<"))
+
+    ring_offsets = np.cumsum([0] + [len(ring) for ring in rings])
+    polygon_offsets = np.cumsum([0] + [len(polygon) for polygon in polygons])
+
+    return {
+        "coordinates": base64.b64encode(coordinates.tobytes()).decode("utf-8"),
+        "dtype": dtype,
+        "ring_offsets": ring_offsets.tolist(),
+        "polygon_offsets": polygon_offsets.tolist(),
+    }
+
+
+def encode_polygons(polygons, geometry_format="geojson"):
+    """
+    Encode polygons from `extract_polygons` in the requested geometry format.
+
+    ``geojson`` gives a list of GeoJSON-like dictionaries, ``wkb`` a base64-encoded
+    WKB MultiPolygon and ``flat`` the dictionary described in `polygons_to_flat`.
+    """
+    if geometry_format == "geojson":
+        return polygons_to_geojson(polygons)
+    elif geometry_format == "wkb":
+        return base64.b64encode(polygons_to_wkb(polygons)).decode("utf-8")
+    elif geometry_format == "flat":
+        return polygons_to_flat(polygons)
+    else:
+        raise ValueError(f"Unknown geometry format {geometry_format}")
+
+
+def mask_to_polygon(binary_mask, min_area=100, simplify_tolerance=0.0):
+    """
+    Converts a binary mask (0, 255) to a list of polygons in GeoJSON format, considering holes.
+
+    Args:
+        binary_mask (np.ndarray): A binary mask of shape (height, width) with values 0 or 255.
+        min_area (float): Rings with an area below this value (in pixels) are dropped.
+        simplify_tolerance (float): Douglas-Peucker tolerance in pixels. ``0`` disables simplification.
+
+    Returns:
+        list: A list of GeoJSON-like dictionaries, each containing a polygon representation with holes.
+    """
+    polygons = extract_polygons(binary_mask, min_area, simplify_tolerance)
+    return polygons_to_geojson(polygons)
+
+
+def polygon_to_mask(polygons, width, height):
+    """
+    Converts a list of polygons in GeoJSON format to a binary mask (0, 255), considering holes.
+
+    Only the bounding box of the polygons is rasterized.
+
+    Args:
+        polygons (list): A list of GeoJSON-like dictionaries, each containing a polygon representation.
+        width (int): The width of the output mask.
+        height (int): The height of the output mask.
+
+    Returns:
+        np.ndarray: A binary mask of shape (height, width) with values 0 or 255.
+    """
+    binary_mask = np.zeros((height, width), dtype=np.uint8)
+
+    polygons = [
+        [np.array(ring, dtype=np.int32).reshape(-1, 2) for ring in polygon["coordinates"]]
+        for polygon in polygons
+        if polygon["type"] == "Polygon" and polygon["coordinates"]
+    ]
+    if not polygons:
+        return binary_mask
+
+    exteriors = np.concatenate([polygon[0] for polygon in polygons], axis=0)
+    x0, y0 = np.maximum(exteriors.min(axis=0), 0)
+    x1, y1 = np.minimum(exteriors.max(axis=0) + 1, (width, height))
+    if x1 <= x0 or y1 <= y0:
+        return binary_mask
+
+    roi = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    for polygon in polygons:
+        cv2.fillPoly(roi, polygon[:1], 255, offset=(int(-x0), int(-y0)))
+        if len(polygon) > 1:
+            cv2.fillPoly(roi, polygon[1:], 0, offset=(int(-x0), int(-y0)))
+
+    binary_mask[y0:y1, x0:x1] = roi
+    return binary_mask
@@ -0,0 +1,118 @@
+"""
+On-demand capture of torch profiler traces.
+
+The profiler is armed for the next N segment requests, optionally only for one
+model. Each profiled request writes a Chrome trace (open it in
+``chrome://tracing`` or https://ui.perfetto.dev) and an operator summary table
+to the profile directory. The oldest profiles are deleted once ``max_profiles``
+is exceeded.
+"""
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import torch
+
+
+TRACE_SUFFIX = ".trace.json"
+SUMMARY_SUFFIX = ".ops.txt"
+
+
+class Profiler:
+    def __init__(self, directory, row_limit=50, max_profiles=20):
+        self.directory = directory
+        self.row_limit = row_limit
+        self.max_profiles = max_profiles
+        self.remaining = 0
+        self.model_id = None
+        self._lock = threading.Lock()
+        # torch.profiler does not support concurrent sessions
+        self._session_lock = threading.Lock()
+
+    def arm(self, requests, model_id=None):
+        """Profile the next ``requests`` segment requests (of ``model_id`` only, if given)."""
+        with self._lock:
+            self.remaining = requests
+            self.model_id = model_id
+        return self.status()
+
+    def status(self):
+        with self._lock:
+            return {"remaining": self.remaining, "model_id": self.model_id}
+
+    def _take(self, model_id):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            if self.model_id is not None and self.model_id != model_id:
+                return False
+            self.remaining -= 1
+            return True
+
+    @contextmanager
+    def capture(self, model_id):
+        """Profile the enclosed block if the profiler is armed for ``model_id``."""
+        if not self._take(model_id):
+            yield
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        with self._session_lock:
+            with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+                yield
+            self._save(prof, model_id)
+            self._prune()
+
+    def _save(self, prof, model_id):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S"),
+            re.sub(r"[^A-Za-z0-9_.-]", "_", model_id),
+            uuid.uuid4().hex[:8],
+        )
+        prof.export_chrome_trace(os.path.join(self.directory, name + TRACE_SUFFIX))
+
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        table = prof.key_averages(group_by_input_shape=True).table(
+            sort_by=sort_by, row_limit=self.row_limit
+        )
+        with open(os.path.join(self.directory, name + SUMMARY_SUFFIX), "w") as f:
+            f.write(table)
+
+    def _prune(self):
+        # Names start with the capture time, so they sort oldest first
+        names = sorted(
+            entry.name[:-len(TRACE_SUFFIX)] for entry in os.scandir(self.directory)
+            if entry.name.endswith(TRACE_SUFFIX)
+        )
+        for name in names[:max(len(names) - self.max_profiles, 0)]:
+            for suffix in (TRACE_SUFFIX, SUMMARY_SUFFIX):
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list_files(self):
+        """Return the profile files, newest first."""
+        if not os.path.isdir(self.directory):
+            return []
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith((TRACE_SUFFIX, SUMMARY_SUFFIX)):
+                stat = entry.stat()
+                files.append({"name": entry.name, "size": stat.st_size, "created": stat.st_mtime})
+        files.sort(key=lambda f: f["created"], reverse=True)
+        return files
+
+    def get_path(self, name):
+        """Return the path of the profile file ``name``, or None if there is no such file."""
+        if name != os.path.basename(name) or not name.endswith((TRACE_SUFFIX, SUMMARY_SUFFIX)):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
@@ -0,0 +1,87 @@
+"""
+Replay a captured segment request through `server.segment` for profiling.
+
+Run from the server directory, next to the ``weights`` folder::
+
+    python replay.py captures/20250101-120000-1a2b3c4d --repeat 10
+    python replay.py captures/20250101-120000-1a2b3c4d --profile trace.json
+
+Prints the stage timings of each run, averaged over the repeats, next to the
+timings recorded by the server, and the IoU of the replayed mask with the
+captured one.
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from capture import load_capture
+from server import new_stage_timer, segment
+
+
+def replay(arrays, metadata, model_id, timer=None):
+    return segment(
+        model_id,
+        arrays["image"],
+        metadata["request"]["clicks"],
+        arrays.get("prev_mask"),
+        timer,
+    )
+
+
+def iou(mask, other):
+    union = np.logical_or(mask > 0, other > 0).sum()
+    if union == 0:
+        return 1.0
+    return np.logical_and(mask > 0, other > 0).sum() / union
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="Path of the capture, with or without suffix")
+    parser.add_argument("--model", help="Replay with another model than the captured one")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of untimed runs")
+    parser.add_argument("--profile", metavar="TRACE", help="Write a Chrome trace of one run")
+    args = parser.parse_args()
+
+    arrays, metadata = load_capture(args.capture)
+    model_id = args.model or metadata["request"]["model_id"]
+    height, width = arrays["image"].shape[:2]
+    print(f"Capture {metadata.get('name')}: model {model_id}, image {width}x{height}, "
+          f"{len(metadata['request']['clicks'])} clicks, "
+          f"captured for {metadata.get('reason')} at {metadata.get('latency', 0) * 1000:.1f} ms")
+
+    for _ in range(args.warmup):
+        replay(arrays, metadata, model_id)
+
+    totals = {}
+    pred_mask = None
+    for _ in range(args.repeat):
+        timer = new_stage_timer()
+        start = time.perf_counter()
+        pred_mask = replay(arrays, metadata, model_id, timer)
+        timer.add("total", start, time.perf_counter())
+        for name, duration in timer.durations.items():
+            totals[name] = totals.get(name, 0.0) + duration
+
+    captured = metadata.get("timings", {})
+    print(f"{'stage':<24}{'replay ms':>12}{'captured ms':>14}")
+    for name, duration in totals.items():
+        captured_ms = f"{captured[name] * 1000:.2f}" if name in captured else "-"
+        print(f"{name:<24}{duration / max(args.repeat, 1) * 1000:>12.2f}{captured_ms:>14}")
+
+    if pred_mask is not None and "pred_mask" in arrays:
+        print(f"IoU with the captured mask: {iou(pred_mask, arrays['pred_mask']):.4f}")
+
+    if args.profile:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        with torch.profiler.profile(activities=activities, record_shapes=True) as prof:
+            replay(arrays, metadata, model_id)
+        prof.export_chrome_trace(args.profile)
+        print(f"Chrome trace written to {args.profile}")
+
+
+if __name__ == "__main__":
+    main()
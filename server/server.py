@@ -1,58 +1,107 @@
 import os
 import base64
+import hashlib
 import time
+import threading
+import uuid
 from collections import OrderedDict
+from typing import List, Literal, Optional, Union
 import numpy as np
 import cv2
 import torch
-from fastapi.responses import JSONResponse
-from fastapi import FastAPI
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from isegm.inference.predictors import get_predictor as build_predictor
+from pydantic import BaseModel, Field
+from isegm.inference.predictors import get_predictor as build_predictor, SAMPredictor
 from isegm.inference import utils
 from isegm.inference import clicker
+from polygonize import extract_polygons, encode_polygons, polygon_to_mask
+from georef import georeference, geotransform_from_extent, offset_geotransform
+from maskcodec import encode_mask, decode_mask, crop_to_roi, paste_roi
+from compression import CompressionMiddleware
+from metrics import (
+    StageTimer, RequestTimingMiddleware, REQUEST_SECONDS, QUEUE_DEPTH, INFERENCE_ACTIVE,
+    PREDICTOR_POOL_SIZE, PREDICTOR_POOL_CAPACITY, register_cuda_memory,
+)
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from profiling import Profiler
+from capture import CaptureRecorder
+from tracing import tracer_from_env, format_traceparent
 import yaml
 
 
-DEBUG = False
-
+WEIGHTS_DIR = os.getenv("WEIGHTS_DIR", "weights")
 
 MODELS = OrderedDict()
 
-# Load model information from YAML file
-with open(os.path.join("weights", "models.yaml"), "r") as yaml_file:
-    models_yaml = yaml.safe_load(yaml_file)
-    for model_name, model_info in models_yaml.items():
-        MODELS[model_name] = model_info
+# Load model information from YAML file. Without it the server starts without models,
+# e.g. for the benchmarks which register their own predictors.
+models_yaml_path = os.path.join(WEIGHTS_DIR, "models.yaml")
+if os.path.exists(models_yaml_path):
+    with open(models_yaml_path, "r") as yaml_file:
+        models_yaml = yaml.safe_load(yaml_file) or {}
+        for model_name, model_info in models_yaml.items():
+            MODELS[model_name] = model_info
 
-DEVICE = "cuda"
+DEVICE = os.getenv("DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
 PREDICTOR_POOL_CACHE_SIZE = 5
 PREDICTOR_POOL = OrderedDict()
 
+# Predictors keep per-image state, so inference requests are run one at a time
+INFERENCE_LOCK = threading.Lock()
+
+PREDICTOR_POOL_SIZE.set_function(lambda: len(PREDICTOR_POOL))
+PREDICTOR_POOL_CAPACITY.set(PREDICTOR_POOL_CACHE_SIZE)
+if torch.cuda.is_available():
+    register_cuda_memory(torch)
+
+# Cache of predicted masks, used as previous masks of the following clicks
+MASK_CACHE_SIZE = int(os.getenv("MASK_CACHE_SIZE", 64))
+MASK_CACHE = OrderedDict()
+MASK_CACHE_LOCK = threading.Lock()
+
+# Cache of decoded request images keyed by their content hash, so clients can skip
+# re-uploading an unchanged canvas
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", 4))
+IMAGE_CACHE = OrderedDict()
+IMAGE_CACHE_LOCK = threading.Lock()
+
+# Torch profiler, armed on demand with POST /v1/debug/profile
+PROFILER = Profiler(os.getenv("PROFILE_DIR", "profiles"), max_profiles=int(os.getenv("PROFILE_MAX", 20)))
+
+# Recorder of slow or sampled requests, replayed offline with replay.py
+CAPTURE_LATENCY_THRESHOLD = os.getenv("CAPTURE_LATENCY_THRESHOLD")
+CAPTURE = CaptureRecorder(
+    os.getenv("CAPTURE_DIR", "captures"),
+    max_captures=int(os.getenv("CAPTURE_MAX", 100)),
+    latency_threshold=float(CAPTURE_LATENCY_THRESHOLD) if CAPTURE_LATENCY_THRESHOLD else None,
+    sample_rate=float(os.getenv("CAPTURE_SAMPLE_RATE", 0.0)),
+)
 
-def get_predictor(model_name):
-    if model_name in PREDICTOR_POOL:
-        return PREDICTOR_POOL[model_name]
+# Exporter of request spans, continuing the trace of the plugin's traceparent header
+TRACER = tracer_from_env()
 
-    model_info = MODELS.get(model_name)
-    if model_info is None:
-        raise ValueError(f"No model with name {model_name}")
+# Magnitude of the logits used to feed a binary previous mask to SAM
+SAM_MASK_LOGIT = 10.0
 
+
+def load_model(model_name, model_info):
+    """Load the network of a model from the weights folder and return it with its predictor mode."""
     if model_name == "SAM":
         from segment_anything import sam_model_registry
 
         model = sam_model_registry["default"](
-            checkpoint=os.path.join("weights", model_info["weights"])
+            checkpoint=os.path.join(WEIGHTS_DIR, model_info["weights"])
         )
         model.to(DEVICE)
 
         mode = "SAM"
     else:
         model = utils.load_is_model(
-            os.path.join("weights", model_info["weights"]),
+            os.path.join(WEIGHTS_DIR, model_info["weights"]),
             DEVICE,
             True if "RITM" in model_name else False,
             cpu_dist_maps=True,
@@ -60,166 +109,204 @@ def get_predictor(model_name):
 
         mode = "NoBRS"
 
+    return model, mode
+
+
+def create_predictor(model, mode, zoom_in_size=448, with_flip=True, compile=False):
+    """
+    Wrap a network in the predictor used by the server.
+
+    The keyword arguments are the speed settings compared by `benchmarks.evaluate`,
+    ``zoom_in_size=None`` disables ZoomIn.
+    """
+    zoom_in_params = None
+    if zoom_in_size is not None:
+        zoom_in_params = {"target_size": (zoom_in_size, zoom_in_size), "skip_clicks": -1}
+
     predictor = build_predictor(
         model,
         mode,
         DEVICE,
-        zoom_in_params={"target_size": (448, 448), "skip_clicks": -1},
+        with_flip=with_flip,
+        zoom_in_params=zoom_in_params,
         predictor_params={
             "net_clicks_limit": 20,
             "cascade_step": 0,
             "cascade_adaptive": False,
         },
+        compile=compile,
     )
 
-    if model_name == "SAM":
+    if mode == "SAM":
         predictor.transforms = []
 
+    return predictor
+
+
+def add_predictor(model_name, predictor):
+    """Add a predictor to the predictor pool, evicting one if the pool is full."""
     if len(PREDICTOR_POOL) >= PREDICTOR_POOL_CACHE_SIZE:
         drop = list(PREDICTOR_POOL.keys())[1]
         del PREDICTOR_POOL[drop]
 
     PREDICTOR_POOL[model_name] = predictor
 
-    return predictor
-
 
-def mask_to_polygon(binary_mask):
-    """
-    Converts a binary mask (0, 255) to a list of polygons in GeoJSON format, considering holes.
+def get_predictor(model_name):
+    if model_name in PREDICTOR_POOL:
+        return PREDICTOR_POOL[model_name]
 
-    Args:
-        binary_mask (np.ndarray): A binary mask of shape (height, width) with values 0 or 255.
+    model_info = MODELS.get(model_name)
+    if model_info is None:
+        raise ValueError(f"No model with name {model_name}")
 
-    Returns:
-        list: A list of GeoJSON-like dictionaries, each containing a polygon representation with holes.
-    """
-    contours, hierarchy = cv2.findContours(binary_mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
-    if hierarchy is None:
-        return []
-
-    hierarchy = hierarchy[0]
-    polygons = []
-
-    for i, contour in enumerate(contours):
-        polygon = contour.squeeze().tolist()
-        if len(polygon) < 3:
-            continue  # Skip invalid polygons
-
-        # filter small polygons
-        if cv2.contourArea(contour) < 100:
-            continue
-
-        # Ensure the polygon is closed
-        if polygon[0] != polygon[-1]:
-            polygon.append(polygon[0])
-
-        # GeoJSON requires exterior rings to be counter-clockwise and holes to be clockwise
-        if hierarchy[i][3] == -1:  # No parent, it's an exterior ring
-            if not is_counter_clockwise(polygon):
-                polygon.reverse()
-            polygons.append({"exterior": polygon, "holes": []})
-        else:  # Has a parent, it's an interior ring (hole)
-            if is_counter_clockwise(polygon):
-                polygon.reverse()
-            parent_index = hierarchy[i][3]
-            if parent_index < len(polygons):  # Ensure the parent exists
-                # Append the hole to the parent polygon
-                polygons[parent_index]["holes"].append(polygon)
-
-    geojson_list = []
-    for poly in polygons:
-        geojson =  {
-            "type": "Polygon",
-            "coordinates": [poly["exterior"]] + poly["holes"]
-        }
-        geojson_list.append(geojson)
+    model, mode = load_model(model_name, model_info)
+    predictor = create_predictor(model, mode)
+    add_predictor(model_name, predictor)
 
-    return geojson_list
+    return predictor
 
 
-def polygon_to_mask(polygons, width, height):
+def sam_mask_input(mask):
     """
-    Converts a list of polygons in GeoJSON format to a binary mask (0, 255), considering holes.
-
-    Args:
-        polygons (list): A list of GeoJSON-like dictionaries, each containing a polygon representation.
-        width (int): The width of the output mask.
-        height (int): The height of the output mask.
+    Convert a full resolution binary mask (0, 255) to SAM's low resolution mask logits.
 
-    Returns:
-        np.ndarray: A binary mask of shape (height, width) with values 0 or 255.
+    SAM expects a 1x256x256 array in the frame of its resized and padded model input.
     """
-    binary_mask = np.zeros((height, width), dtype=np.uint8)
+    height, width = mask.shape
+    scale = 256 / max(height, width)
+    new_height, new_width = int(round(height * scale)), int(round(width * scale))
 
-    for polygon in polygons:
-        if polygon["type"] == "Polygon":
-            coordinates = polygon["coordinates"]
-            exterior = np.array(coordinates[0], dtype=np.int32)
-            cv2.fillPoly(binary_mask, [exterior], 255)
+    low_res = cv2.resize(mask, (new_width, new_height), interpolation=cv2.INTER_AREA)
+    logits = np.full((256, 256), -SAM_MASK_LOGIT, dtype=np.float32)
+    logits[:new_height, :new_width] = np.where(low_res > 127, SAM_MASK_LOGIT, -SAM_MASK_LOGIT)
+    return logits[None]
 
-            for hole in coordinates[1:]:
-                hole_array = np.array(hole, dtype=np.int32)
-                cv2.fillPoly(binary_mask, [hole_array], 0)
 
-    return binary_mask
+def new_stage_timer():
+    """Create a StageTimer that waits for pending CUDA work at stage boundaries."""
+    if DEVICE.startswith("cuda") and torch.cuda.is_available():
+        return StageTimer(synchronize=torch.cuda.synchronize)
+    return StageTimer()
 
 
-def is_counter_clockwise(polygon):
+def segment(model_name, image, click_points, prev_mask=None, timer=None):
     """
-    Determines if a polygon is wound counter-clockwise.
+    Run the predictor of ``model_name`` on ``image`` and return the binary mask (0, 255).
 
-    Args:
-        polygon (list): A list of [x, y] points representing the polygon.
-
-    Returns:
-        bool: True if the polygon is counter-clockwise, False otherwise.
+    ``prev_mask`` is an optional binary mask (0, 255) of the previous result, used by
+    models that are conditioned on their previous prediction. ``timer`` is an optional
+    `metrics.StageTimer` recording the time spent in each stage.
     """
-    area = 0
-    for i in range(len(polygon) - 1):
-        x1, y1 = polygon[i]
-        x2, y2 = polygon[i + 1]
-        area += (x2 - x1) * (y2 + y1)
-    return area > 0
+    if timer is None:
+        timer = new_stage_timer()
 
-
-def segment(model_name, image, click_points, prev_prediction=None):
     clicks = clicker.Clicker()
     for i in click_points:
         clicks.add_click(clicker.Click(is_positive=i[2], coords=(i[1], i[0])))
 
-    predictor = get_predictor(model_name)
+    QUEUE_DEPTH.inc()
+    with timer.stage("queue_wait"):
+        INFERENCE_LOCK.acquire()
+    QUEUE_DEPTH.dec()
+    INFERENCE_ACTIVE.inc()
 
-    predictor.set_input_image(image)
-    if model_name == "SAM":
-        predictor.low_res_masks = prev_prediction
+    predictor = None
+    try:
+        predictor = get_predictor(model_name)
+        predictor.timer = timer
 
-    if torch.is_tensor(prev_prediction):
-        prev_prediction = prev_prediction.to(DEVICE)
+        with timer.stage("set_input_image"):
+            predictor.set_input_image(image)
 
-    with torch.no_grad():
-        pred_prob = predictor.get_prediction(clicks, prev_prediction)
+        prev_prediction = None
+        if prev_mask is not None:
+            with timer.stage("prev_mask_input"):
+                if isinstance(predictor, SAMPredictor):
+                    predictor.low_res_masks = sam_mask_input(prev_mask)
+                else:
+                    prev_prediction = torch.from_numpy(prev_mask).to(DEVICE)
+                    prev_prediction = prev_prediction.float().div_(255).unsqueeze(0).unsqueeze(0)
+
+        with torch.no_grad():
+            pred_prob = predictor.get_prediction(clicks, prev_prediction)
+    finally:
+        if predictor is not None:
+            predictor.timer = None
+        INFERENCE_ACTIVE.dec()
+        INFERENCE_LOCK.release()
+
+    with timer.stage("threshold"):
+        threshold = 0.5
+        while threshold > 0:
+            pred_mask = (pred_prob > threshold).astype(int).astype(np.uint8)
+            if pred_mask.sum() > 0:
+                break
+            else:
+                threshold -= 0.05
+
+        pred_mask *= 255
+    return pred_mask
+
+
+def cache_mask(mask):
+    """Store a binary mask in the mask cache and return its id."""
+    roi, offset = crop_to_roi(mask)
+    entry = (np.packbits(roi > 0), roi.shape, offset, mask.shape)
+    mask_id = uuid.uuid4().hex
+
+    with MASK_CACHE_LOCK:
+        MASK_CACHE[mask_id] = entry
+        while len(MASK_CACHE) > MASK_CACHE_SIZE:
+            MASK_CACHE.popitem(last=False)
+
+    return mask_id
+
+
+def get_cached_mask(mask_id, width, height):
+    """Return a cached binary mask, or None if it is unknown or has a different size."""
+    with MASK_CACHE_LOCK:
+        entry = MASK_CACHE.get(mask_id)
+        if entry is not None:
+            MASK_CACHE.move_to_end(mask_id)
+
+    if entry is None:
+        return None
+
+    bits, roi_shape, offset, shape = entry
+    if shape != (height, width):
+        return None
+
+    roi = np.unpackbits(bits, count=roi_shape[0] * roi_shape[1]).reshape(roi_shape) * 255
+    return paste_roi(roi, offset, width, height)
+
+
+def hash_image_bytes(data):
+    """Content hash of the raw channel-first image bytes of a request."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
 
-    if model_name == "SAM":
-        prev_prediction = getattr(predictor, "low_res_masks")
-    else:
-        prev_prediction = predictor.prev_prediction
-        prev_prediction = prev_prediction.detach().cpu()
 
-    threshold = 0.5
-    while threshold > 0:
-        pred_mask = (pred_prob > threshold).astype(int).astype(np.uint8)
-        if pred_mask.sum() > 0:
-            break
-        else:
-            threshold -= 0.05
+def cache_image(image_hash, image):
+    with IMAGE_CACHE_LOCK:
+        IMAGE_CACHE[image_hash] = image
+        IMAGE_CACHE.move_to_end(image_hash)
+        while len(IMAGE_CACHE) > IMAGE_CACHE_SIZE:
+            IMAGE_CACHE.popitem(last=False)
 
-    pred_mask *= 255
-    cnts = mask_to_polygon(pred_mask)
-    return cnts
 
+def get_cached_image(image_hash, width, height, channel):
+    """Return a cached image, or None if it is unknown or has a different shape."""
+    with IMAGE_CACHE_LOCK:
+        image = IMAGE_CACHE.get(image_hash)
+        if image is not None:
+            IMAGE_CACHE.move_to_end(image_hash)
 
-app = FastAPI()
+    if image is None or image.shape != (height, width, channel):
+        return None
+    return image
+
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -229,6 +316,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", 1024)),
+    max_request_size=int(os.getenv("MAX_REQUEST_BYTES", 128 * 1024 * 1024)),
+)
+
 bearer_token = os.getenv("BEARER_TOKEN", None)
 if bearer_token:
     security = HTTPBearer()
@@ -245,6 +338,9 @@ if bearer_token:
         response = await call_next(request)
         return response
 
+# Added last so it wraps all other middleware and sees the request first
+app.add_middleware(RequestTimingMiddleware)
+
 
 class ModelResponse(BaseModel):
     id: str
@@ -255,16 +351,37 @@ class ModelResponse(BaseModel):
 
 class SegmentRequest(BaseModel):
     model_id: str
-    image: str
+    image: str = ""
+    image_hash: Optional[str] = None
     clicks: list
-    previous_mask: list
+    previous_mask: Union[list, dict] = []
+    previous_mask_id: Optional[str] = None
+    cache_mask: bool = False
     width: int
     height: int
     channel: int
+    simplify_tolerance: float = 0.0
+    geometry_format: Literal["geojson", "wkb", "flat"] = "geojson"
+    geotransform: Optional[List[float]] = None
+    extent: Optional[List[float]] = None
+    crs: Optional[str] = None
+    target_crs: Optional[str] = None
+    output: Literal["polygon", "mask"] = "polygon"
+    mask_format: Literal["rle", "png"] = "rle"
+
+
+class ProfileRequest(BaseModel):
+    requests: int = Field(1, ge=1, le=100)
+    model_id: Optional[str] = None
 
 
 class SegmentResponse(BaseModel):
-    segmentation: list
+    segmentation: Optional[Union[list, str, dict]] = None
+    geometry_format: str
+    crs: Optional[str] = None
+    mask: Optional[dict] = None
+    mask_id: Optional[str] = None
+    image_hash: Optional[str] = None
     model_used: str
     processing_time: float
 
@@ -280,65 +397,224 @@ def get_models():
         }
         for k, v in MODELS.items()
     ]
-    return models
+    return ORJSONResponse(models)
 
 
-@app.post("/v1/segment", response_model=SegmentResponse)
-@app.exception_handler(RequestValidationError)
-def segment_endpoint(request: SegmentRequest):
-    # Parse image from base64
-    width = request.width
-    height = request.height
-    channel = request.channel
-    image = np.frombuffer(
-        base64.b64decode(request.image),
-        dtype=np.uint8
-    ).reshape((channel, height, width)).transpose((1, 2, 0))
-
-    if len(request.previous_mask) > 0:
-        prev_mask = polygon_to_mask(
-            request.previous_mask, width, height
-        )
+@app.get("/v1/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-        prev_mask = torch.from_numpy(prev_mask)
-        prev_mask = prev_mask.unsqueeze(0).unsqueeze(0)
-    else:
-        prev_mask = None
+
+def require_debug_access():
+    # The debug endpoints are only available behind the bearer token middleware
+    if not bearer_token:
+        raise HTTPException(status_code=403, detail="Debug endpoints require BEARER_TOKEN")
+
+
+@app.post("/v1/debug/profile", dependencies=[Depends(require_debug_access)])
+def arm_profiler(request: ProfileRequest):
+    if request.model_id is not None and request.model_id not in MODELS:
+        raise HTTPException(status_code=400, detail=f"No model with name {request.model_id}")
+    return ORJSONResponse(PROFILER.arm(request.requests, request.model_id))
+
+
+@app.get("/v1/debug/profile", dependencies=[Depends(require_debug_access)])
+def list_profiles():
+    return ORJSONResponse(dict(PROFILER.status(), files=PROFILER.list_files()))
+
+
+@app.get("/v1/debug/profile/{name}", dependencies=[Depends(require_debug_access)])
+def download_profile(name: str):
+    path = PROFILER.get_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"No profile named {name}")
+    return FileResponse(path, filename=name)
+
+
+def get_request_geotransform(request):
+    """Return the geotransform of the request image, or None if it is not georeferenced."""
+    if request.geotransform is not None:
+        if len(request.geotransform) != 6:
+            raise HTTPException(status_code=400, detail="geotransform must have 6 values")
+        return request.geotransform
+
+    if request.extent is not None:
+        if len(request.extent) != 4:
+            raise HTTPException(status_code=400, detail="extent must have 4 values")
+        return geotransform_from_extent(request.extent, request.width, request.height)
+
+    return None
+
+
+def get_request_image(request):
+    """
+    Return the image of the request (height, width, channel).
+
+    With ``image_hash`` the image is kept in the image cache, and a request without
+    ``image`` is served from it. Unknown hashes are answered with 409 so the client
+    sends the image again.
+    """
+    width, height, channel = request.width, request.height, request.channel
+    use_cache = request.image_hash is not None and IMAGE_CACHE_SIZE > 0
+
+    if not request.image:
+        image = get_cached_image(request.image_hash, width, height, channel) if use_cache else None
+        if image is None:
+            raise HTTPException(status_code=409, detail="Unknown image_hash, send the image")
+        return image
+
+    data = base64.b64decode(request.image)
+    if len(data) != width * height * channel:
+        raise HTTPException(status_code=400, detail="Image size does not match width, height and channel")
+    if use_cache and hash_image_bytes(data) != request.image_hash:
+        raise HTTPException(status_code=400, detail="image_hash does not match the image")
+
+    image = np.frombuffer(data, dtype=np.uint8).reshape((channel, height, width)).transpose((1, 2, 0))
+    if use_cache:
+        cache_image(request.image_hash, image)
+    return image
+
+
+def get_request_previous_mask(request):
+    """Return the previous mask of the request as a binary mask (0, 255), or None."""
+    width, height = request.width, request.height
+
+    if request.previous_mask_id:
+        prev_mask = get_cached_mask(request.previous_mask_id, width, height)
+        if prev_mask is not None:
+            return prev_mask
+
+    try:
+        if isinstance(request.previous_mask, dict):
+            return decode_mask(request.previous_mask, width, height)
+        elif len(request.previous_mask) > 0:
+            return polygon_to_mask(request.previous_mask, width, height)
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid previous_mask: {e}")
+
+    return None
+
+
+def run_segment_request(request, timer):
+    """
+    Run a segment request.
+
+    Returns:
+        tuple: The content of the response and the arrays of the request for capturing
+            (``image``, ``prev_mask`` and ``pred_mask``).
+    """
+    # Parse image from base64, or take it from the image cache
+    with timer.stage("image_decode"):
+        image = get_request_image(request)
+
+    with timer.stage("previous_mask_decode"):
+        prev_mask = get_request_previous_mask(request)
+
+    geotransform = get_request_geotransform(request)
+    if request.target_crs and not request.crs:
+        # Without a source CRS nothing can be reprojected to the target CRS
+        raise HTTPException(status_code=400, detail="target_crs requires crs")
 
     processing_time = time.time()
-    cnts = segment(
-        request.model_id, image, request.clicks, prev_mask
+    pred_mask = segment(
+        request.model_id, image, request.clicks, prev_mask, timer
     )
+
+    mask_id = None
+    if request.cache_mask and MASK_CACHE_SIZE > 0:
+        with timer.stage("cache_mask"):
+            mask_id = cache_mask(pred_mask)
+
+    segmentation = None
+    mask = None
+    crs = None
+    if request.output == "mask":
+        with timer.stage("mask_encode"):
+            mask = encode_mask(pred_mask, request.mask_format)
+        if geotransform is not None:
+            # The mask grid is not reprojected, it stays in the CRS of the request
+            mask["geotransform"] = offset_geotransform(geotransform, *mask["offset"])
+            mask["crs"] = request.crs
+    else:
+        with timer.stage("mask_to_polygon"):
+            polygons = extract_polygons(
+                pred_mask, simplify_tolerance=request.simplify_tolerance
+            )
+
+        # Georeference the polygons if the image location is known
+        if geotransform is not None:
+            with timer.stage("georeference"):
+                try:
+                    polygons = georeference(
+                        polygons, geotransform, request.crs, request.target_crs
+                    )
+                except Exception as e:
+                    raise HTTPException(status_code=400, detail=f"Failed to georeference: {e}")
+            crs = request.target_crs or request.crs
+        with timer.stage("geometry_encode"):
+            segmentation = encode_polygons(polygons, request.geometry_format)
     processing_time = time.time() - processing_time
 
-    # Debugging block to save images and clicks on segmentation map
-    if DEBUG:
-        if prev_mask is not None:
-            debug_prev_mask_path = "debug_prev_mask.png"
-            cv2.imwrite(debug_prev_mask_path, prev_mask.squeeze().cpu().numpy())
-        else:
-            # create a blank image
-            prev_mask = np.zeros((height, width), dtype=np.uint8)
-            cv2.imwrite("debug_prev_mask.png", prev_mask)
-
-        debug_image_path = "debug_image.png"
-        cv2.imwrite(debug_image_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
-
-        debug_segmentation_path = "debug_segmentation.png"
-        segmentation_mask = polygon_to_mask(cnts, width, height)
-        segmentation_mask = cv2.cvtColor(segmentation_mask, cv2.COLOR_GRAY2RGB)
-
-        # Add clicks to the segmentation map for debugging
-        for click in request.clicks:
-            x, y, is_positive = int(click[0]), int(click[1]), int(click[2])
-            color = (0, 255, 0) if is_positive else (0, 0, 255)
-            cv2.circle(segmentation_mask, (x, y), 5, color, -1)
-
-        cv2.imwrite(debug_segmentation_path, segmentation_mask)
-
-    response = {
-        "segmentation": cnts,
+    content = {
+        "segmentation": segmentation,
+        "geometry_format": request.geometry_format,
+        "crs": crs,
+        "mask": mask,
+        "mask_id": mask_id,
+        "image_hash": request.image_hash if request.image_hash and IMAGE_CACHE_SIZE > 0 else None,
         "model_used": request.model_id,
         "processing_time": processing_time,
     }
+    arrays = {"image": image, "prev_mask": prev_mask, "pred_mask": pred_mask}
+    return content, arrays
+
+
+@app.post("/v1/segment", response_model=SegmentResponse)
+@app.exception_handler(RequestValidationError)
+def segment_endpoint(request: SegmentRequest, http_request: Request):
+    start = time.perf_counter()
+    timer = new_stage_timer()
+    trace = TRACER.start_request(http_request.headers.get("traceparent"))
+
+    # Body reading, decompression, JSON parsing and validation
+    received_at = getattr(http_request.state, "received_at", None)
+    if received_at is not None:
+        timer.add("request_parse", received_at, time.perf_counter())
+
+    with PROFILER.capture(request.model_id):
+        content, arrays = run_segment_request(request, timer)
+
+    # Return the response directly to skip re-validation against the response model
+    with timer.stage("serialize"):
+        response = ORJSONResponse(content)
+
+    response.headers["Server-Timing"] = timer.server_timing()
+    timer.observe(request.model_id)
+    end = time.perf_counter()
+    latency = end - (received_at if received_at is not None else start)
+    REQUEST_SECONDS.labels(request.model_id).observe(latency)
+
+    if TRACER.enabled:
+        response.headers["traceresponse"] = format_traceparent(trace[0], trace[2])
+        TRACER.record_request(
+            trace, "POST /v1/segment", received_at if received_at is not None else start, end,
+            timer, {
+                "segmap.model_id": request.model_id,
+                "segmap.image.width": request.width,
+                "segmap.image.height": request.height,
+                "segmap.clicks": len(request.clicks),
+                "segmap.output": request.output,
+            },
+        )
+
+    reason = CAPTURE.should_capture(latency)
+    if reason is not None:
+        metadata = {
+            "reason": reason,
+            "created": time.time(),
+            "latency": latency,
+            "timings": timer.durations,
+            "request": request.model_dump(exclude={"image", "previous_mask"}),
+        }
+        CAPTURE.submit(arrays, metadata)
     return response
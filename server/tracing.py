@@ -0,0 +1,234 @@
+"""
+Tracing of segment requests with W3C trace context propagation.
+
+The QGIS plugin sends a ``traceparent`` header with every segment request. The
+server continues that trace: the request becomes a server span whose parent is
+the plugin's upload span, and every stage recorded by the request's
+`metrics.StageTimer` becomes a child span of it. Requests without a
+``traceparent`` header start a new trace.
+
+Spans are encoded in the OTLP/JSON format and exported by a background thread,
+either to an OTLP/HTTP collector (``/v1/traces``) or appended to a JSON lines
+file, one export request per line. When the exporter falls behind, traces are
+dropped instead of blocking requests.
+"""
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+
+
+def new_trace_id():
+    return os.urandom(16).hex()
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+def parse_traceparent(value):
+    """
+    Parse a ``traceparent`` header.
+
+    Returns:
+        tuple: The trace id, the parent span id and the trace flags, or None if the
+            header is missing or invalid.
+    """
+    match = TRACEPARENT_RE.match((value or "").strip().lower())
+    if match is None:
+        return None
+    trace_id, span_id, flags = match.groups()
+    if trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return trace_id, span_id, int(flags, 16)
+
+
+def format_traceparent(trace_id, span_id, flags=1):
+    return f"00-{trace_id}-{span_id}-{flags:02x}"
+
+
+def encode_attributes(attributes):
+    """Encode a dict as OTLP key/value attributes."""
+    encoded = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            encoded_value = {"boolValue": value}
+        elif isinstance(value, int):
+            encoded_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            encoded_value = {"doubleValue": value}
+        else:
+            encoded_value = {"stringValue": str(value)}
+        encoded.append({"key": key, "value": encoded_value})
+    return encoded
+
+
+class FileExporter:
+    """Appends OTLP/JSON export requests to a JSON lines file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, request):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(request, separators=(",", ":")) + "\n")
+
+
+class OTLPHttpExporter:
+    """Posts OTLP/JSON export requests to the ``/v1/traces`` endpoint of a collector."""
+
+    def __init__(self, endpoint, timeout=5.0):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.timeout = timeout
+
+    def export(self, request):
+        http_request = urllib.request.Request(
+            self.url,
+            data=json.dumps(request).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+            response.read()
+
+
+class Tracer:
+    def __init__(self, exporter=None, service_name="segmap-server", queue_size=64):
+        self.exporter = exporter
+        self.service_name = service_name
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._failing = False
+        # Offset from time.perf_counter to the Unix epoch in ns, the stages are
+        # timed with perf_counter but OTLP spans use wall clock timestamps
+        self._epoch_offset = time.time_ns() - int(time.perf_counter() * 1e9)
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def _unix_nano(self, perf_counter):
+        return str(int(perf_counter * 1e9) + self._epoch_offset)
+
+    def start_request(self, traceparent):
+        """
+        Return the trace id, the parent span id and the span id of a request.
+
+        The trace of a valid ``traceparent`` header is continued, otherwise a new
+        trace is started.
+        """
+        parent = parse_traceparent(traceparent)
+        if parent is None:
+            return new_trace_id(), None, new_span_id()
+        trace_id, parent_span_id, _ = parent
+        return trace_id, parent_span_id, new_span_id()
+
+    def record_request(self, context, name, start, end, timer, attributes=None):
+        """
+        Export a request span and one child span per stage of ``timer``.
+
+        Args:
+            context (tuple): The ids returned by `start_request`.
+            name (str): The name of the request span.
+            start (float): The `time.perf_counter` time the request was received.
+            end (float): The `time.perf_counter` time the response was ready.
+            timer (metrics.StageTimer): The stages of the request.
+            attributes (dict): Attributes of the request span.
+        """
+        if not self.enabled:
+            return
+        trace_id, parent_span_id, span_id = context
+
+        spans = [{
+            "traceId": trace_id,
+            "spanId": span_id,
+            "parentSpanId": parent_span_id or "",
+            "name": name,
+            "kind": SPAN_KIND_SERVER,
+            "startTimeUnixNano": self._unix_nano(start),
+            "endTimeUnixNano": self._unix_nano(end),
+            "attributes": encode_attributes(attributes or {}),
+        }]
+        for stage, stage_start, stage_end in timer.records:
+            spans.append({
+                "traceId": trace_id,
+                "spanId": new_span_id(),
+                "parentSpanId": span_id,
+                "name": stage,
+                "kind": SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": self._unix_nano(stage_start),
+                "endTimeUnixNano": self._unix_nano(stage_end),
+            })
+
+        self._submit({
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": encode_attributes({"service.name": self.service_name}),
+                },
+                "scopeSpans": [{"scope": {"name": "segmap"}, "spans": spans}],
+            }],
+        })
+
+    def _submit(self, request):
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            try:
+                self.exporter.export(request)
+                self._failing = False
+            except Exception as e:
+                # Report an unreachable exporter once rather than for every request
+                if not self._failing:
+                    self._failing = True
+                    logger.warning("Failed to export trace: %s", e)
+
+
+def tracer_from_env():
+    """
+    Create the tracer configured by the environment.
+
+    ``TRACE_EXPORTER`` is ``otlp`` (to ``OTEL_EXPORTER_OTLP_ENDPOINT``, by default
+    ``http://localhost:4318``), ``file`` (to ``TRACE_FILE``, by default
+    ``traces/traces.jsonl``) or unset to disable tracing.
+    """
+    kind = os.getenv("TRACE_EXPORTER", "").lower()
+    service_name = os.getenv("OTEL_SERVICE_NAME", "segmap-server")
+    if kind == "otlp":
+        endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "http://localhost:4318")
+        return Tracer(OTLPHttpExporter(endpoint), service_name)
+    if kind == "file":
+        return Tracer(FileExporter(os.getenv("TRACE_FILE", "traces/traces.jsonl")), service_name)
+    if kind:
+        raise ValueError(f"Unknown TRACE_EXPORTER {kind}, expected otlp or file")
+    return Tracer(None, service_name)